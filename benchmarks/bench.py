@@ -0,0 +1,332 @@
+"""
+Benchmarks for the executor and state machine definitions.
+
+Micro-benchmarks time definition parsing, serialization and hashing on a large
+definition, a single executor hop (hydrate, run_task, dispatch), and measure
+the encoded size of the executor context. Macro-benchmarks run executions end
+to end through the local components, and count the calls they make to the
+local stand-ins for AWS services.
+
+Results are printed as JSON. Each result is checked against the limits in
+thresholds.json (or --thresholds), and the exit status is non-zero if any is
+exceeded, so a change that makes hops slower or contexts bigger fails.
+
+    python benchmarks/bench.py [--filter NAME] [--output FILE] [--thresholds FILE]
+"""
+
+from __future__ import absolute_import
+
+import argparse
+import contextlib
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from heaviside import cache, codec, eventloop, executor, local, states
+
+DEFAULT_THRESHOLDS = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'thresholds.json')
+
+BENCHMARKS = []
+
+def benchmark(function):
+    BENCHMARKS.append(function)
+    return function
+
+@contextlib.contextmanager
+def quiet():
+    """LocalLogger writes log lines to stdout; keep them out of the timings and the JSON results."""
+    stdout = sys.stdout
+    with open(os.devnull, 'w') as devnull:
+        sys.stdout = devnull
+        try:
+            yield
+        finally:
+            sys.stdout = stdout
+
+def time_per_op(function, number, repeat=5):
+    """Best time per call over several repeats, like timeit."""
+    best = None
+    for _ in xrange(repeat):
+        start = time.time()
+        for _ in xrange(number):
+            function()
+        elapsed = (time.time() - start) / number
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+def large_definition(num_states=200):
+    """A chain of Tasks with catchers, broken up by Parallel states."""
+    definition = {
+        "Comment": "benchmark",
+        "StartAt": "State0",
+        "States": {},
+    }
+    for i in xrange(num_states):
+        name = "State{}".format(i)
+        next_name = "State{}".format(i + 1) if i + 1 < num_states else "Done"
+        if i % 10 == 5:
+            definition["States"][name] = {
+                "Type": "Parallel",
+                "Next": next_name,
+                "Branches": [
+                    {"StartAt": "B", "States": {"B": {"Type": "Task", "Resource": "branch-{}".format(b), "End": True}}}
+                    for b in xrange(3)
+                ],
+            }
+        else:
+            definition["States"][name] = {
+                "Type": "Task",
+                "Resource": "arn:aws:lambda:us-east-1:123456789012:function:task-{}".format(i),
+                "Next": next_name,
+                "Catch": [{"ErrorEquals": ["States.ALL"], "Next": "Failed"}],
+            }
+    definition["States"]["Done"] = {"Type": "Succeed"}
+    definition["States"]["Failed"] = {"Type": "Fail", "Error": "Failed", "Cause": "benchmark"}
+    return definition
+
+LINEAR_DEFINITION = {
+    "StartAt": "A",
+    "States": {
+        "A": {"Type": "Task", "Resource": "a", "Next": "B"},
+        "B": {"Type": "Task", "Resource": "b", "Next": "C"},
+        "C": {"Type": "Task", "Resource": "c", "End": True},
+    },
+}
+
+class CapturingDispatcher(local.LocalTaskDispatcher):
+    """Records dispatches instead of running them, so hops can be driven one at a time."""
+    def __init__(self, *args, **kwargs):
+        super(CapturingDispatcher, self).__init__(*args, **kwargs)
+        self.sent = []
+    
+    def dispatch(self, resource, input, context):
+        self.sent.append((resource, input, context))
+
+def capturing_components():
+    comps = local.create_components(executor.Executor)
+    comps["task_dispatcher"] = CapturingDispatcher(executor.Executor,
+                                                   comps["definition_store"],
+                                                   comps["execution_store"],
+                                                   comps["logger_factory"],
+                                                   fan_in_store=comps["fan_in_store"])
+    return comps
+
+@benchmark
+def definition_from_json():
+    definition = large_definition()
+    seconds = time_per_op(lambda: states.StateMachine.from_json(definition), 20)
+    return {"seconds_per_op": seconds}
+
+@benchmark
+def definition_to_json():
+    machine = states.StateMachine.from_json(large_definition())
+    return {"seconds_per_op": time_per_op(machine.to_json, 50)}
+
+@benchmark
+def definition_disk_cache():
+    """Loading and compiling a definition from the disk cache, as a cold container does,
+    against parsing and compiling the JSON body it would otherwise fetch."""
+    machine = states.StateMachine.from_json(large_definition())
+    body = machine.get_canonical_json()
+    directory = tempfile.mkdtemp()
+    try:
+        disk_cache = cache.DiskDefinitionCache(directory)
+        disk_cache.put(machine.get_hash(), machine)
+        seconds = time_per_op(lambda: disk_cache.get(machine.get_hash()).compile(), 20)
+        parse_seconds = time_per_op(lambda: states.StateMachine.from_json(json.loads(body)).compile(), 20)
+        return {
+            "seconds_per_op": seconds,
+            "parse_seconds_per_op": parse_seconds,
+            "ratio": seconds / parse_seconds,
+            "bytes": disk_cache.size_bytes(),
+        }
+    finally:
+        shutil.rmtree(directory)
+
+@benchmark
+def definition_get_hash():
+    machine = states.StateMachine.from_json(large_definition())
+    def get_hash():
+        machine._hash = None
+        machine.get_hash()
+    return {"seconds_per_op": time_per_op(get_hash, 50)}
+
+@benchmark
+def executor_hop():
+    comps = capturing_components()
+    dispatcher = comps["task_dispatcher"]
+    with quiet():
+        executor.Executor.create(LINEAR_DEFINITION, **comps).dispatch({"value": 1})
+    _, input, context = dispatcher.sent[0]
+    
+    def hop():
+        ex = executor.Executor.hydrate(context, **comps)
+        ex.run_task(lambda: input, lambda e: 'States.TaskFailed')
+        del dispatcher.sent[:]
+    
+    with quiet():
+        seconds = time_per_op(hop, 200)
+    return {"seconds_per_op": seconds}
+
+@benchmark
+def context_size():
+    comps = capturing_components()
+    with quiet():
+        executor.Executor.create(LINEAR_DEFINITION, **comps).dispatch({"value": 1})
+    _, _, context = comps["task_dispatcher"].sent[0]
+    context = dict(context)
+    context["x-heaviside-sm-bucket"] = "heaviside-state-machine-bucket"
+    return {
+        "bytes": codec.get_codec('compact').encoded_size(context),
+        "json_bytes": codec.get_codec('json').encoded_size(context),
+    }
+
+def run_executions(comps, count):
+    with quiet():
+        executions = [executor.Executor.create(LINEAR_DEFINITION, **comps) for _ in xrange(count)]
+        start = time.time()
+        for i, ex in enumerate(executions):
+            ex.dispatch({"value": i})
+        comps["task_dispatcher"].join()
+        elapsed = time.time() - start
+    return {
+        "executions": count,
+        "seconds": elapsed,
+        "executions_per_second": count / elapsed,
+        "errors": comps["task_dispatcher"].errors,
+    }
+
+def fake_session():
+    """A boto3 session with placeholder credentials, for the local fake services."""
+    import boto3
+    return boto3.Session(aws_access_key_id='fake', aws_secret_access_key='fake', region_name='us-east-1')
+
+@benchmark
+def cloudwatch_log_batching():
+    """PutLogEvents calls per hop of linear executions logging to the fake
+    CloudWatch Logs, at DEBUG. Each hop should send its events in one call with a
+    sequence token that is still current."""
+    from heaviside import aws
+    server = local.FakeLogsServer().start()
+    try:
+        comps = local.create_components(executor.Executor)
+        comps["logger_factory"] = aws.CloudWatchLoggerFactory(
+            fake_session(), log_group_name='bench', endpoint_url=server.endpoint_url, level='DEBUG')
+        comps["task_dispatcher"].logger_factory = comps["logger_factory"]
+        count = 20
+        result = run_executions(comps, count)
+        hops = count * (len(LINEAR_DEFINITION["States"]) + 1)
+        return {
+            "errors": result["errors"],
+            "hops": hops,
+            "put_calls_per_hop": server.calls['PutLogEvents'] / float(hops),
+            "streams": len(server.streams),
+        }
+    finally:
+        server.stop()
+
+@benchmark
+def local_executions():
+    return run_executions(local.create_components(executor.Executor), 1000)
+
+@benchmark
+def eventloop_executions():
+    return run_executions(eventloop.create_components(executor.Executor, latency=0.1), 1000)
+
+COALESCED_DEFINITION = {
+    "StartAt": "A",
+    "States": {
+        "A": {"Type": "Task", "Resource": "a", "Next": "Tag"},
+        "Tag": {"Type": "Pass", "Result": "tagged", "ResultPath": "$.tag", "Next": "Route"},
+        "Route": {"Type": "Choice", "Choices": [{"Variable": "$.tag", "StringEquals": "tagged", "Next": "B"}]},
+        "B": {"Type": "Task", "Resource": "b", "Next": "Fork", "ResultPath": "$.b"},
+        "Fork": {
+            "Type": "Parallel",
+            "End": True,
+            "Branches": [
+                {"StartAt": "C", "States": {"C": {"Type": "Task", "Resource": "c", "End": True}}}
+                for _ in xrange(2)
+            ],
+        },
+    },
+}
+
+@benchmark
+def central_store_writes():
+    """Writes to the state table with the DynamoDB execution store on the fake
+    table. The changes each hop makes, through Pass and Choice states, should be
+    written once: a hop ending in a dispatch writes the execution once, and the
+    start and Parallel branches add their own items, which are deleted when they
+    finish, leaving one item per execution."""
+    from heaviside import aws
+    table = local.FakeDynamoDBTable()
+    comps = eventloop.create_components(executor.Executor)
+    comps["execution_store"] = aws.DynamoDBExecutionStore(table=table)
+    comps["task_dispatcher"].execution_store = comps["execution_store"]
+    count = 100
+    with quiet():
+        for i in xrange(count):
+            executor.Executor.create(COALESCED_DEFINITION, **comps).dispatch({"value": i})
+        comps["task_dispatcher"].join()
+    # writes: the start dispatching A, A dispatching B, B starting the Parallel,
+    # each branch created and deleted, and the last branch finishing the execution
+    expected = 3 + 2 * 2 + 1
+    return {
+        "errors": comps["task_dispatcher"].errors,
+        "writes_per_execution": table.writes / float(count),
+        "excess_writes_per_execution": table.writes / float(count) - expected,
+        "items_per_execution": len(table.items) / float(count),
+    }
+
+def check(name, result, thresholds):
+    """Compare a result to its thresholds: max_<field> and min_<field> bound result[field]."""
+    failures = []
+    for key, limit in thresholds.get(name, {}).iteritems():
+        bound, field = key.split('_', 1)
+        value = result.get(field)
+        if value is None:
+            continue
+        if (bound == 'max' and value > limit) or (bound == 'min' and value < limit):
+            failures.append("{} {} is {}, limit {}".format(name, field, value, limit))
+    return failures
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description="Run the heaviside benchmarks")
+    parser.add_argument('--filter', help="only run benchmarks whose name contains this")
+    parser.add_argument('--output', help="also write the results to this file")
+    parser.add_argument('--thresholds', default=DEFAULT_THRESHOLDS)
+    args = parser.parse_args(args)
+    
+    thresholds = {}
+    if args.thresholds and os.path.exists(args.thresholds):
+        with open(args.thresholds) as fp:
+            thresholds = json.load(fp)
+    
+    results = {}
+    failures = []
+    for function in BENCHMARKS:
+        name = function.__name__
+        if args.filter and args.filter not in name:
+            continue
+        results[name] = function()
+        failures.extend(check(name, results[name], thresholds))
+    
+    report = {
+        "python": sys.version.split()[0],
+        "results": results,
+        "failures": failures,
+    }
+    output = json.dumps(report, indent=2, sort_keys=True)
+    print output
+    if args.output:
+        with open(args.output, 'w') as fp:
+            fp.write(output)
+    return 1 if failures else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
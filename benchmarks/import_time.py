@@ -0,0 +1,77 @@
+"""
+Measures the cost of `import heaviside` in a fresh interpreter, and checks
+that importing the package doesn't load boto3 or the executor.
+
+Each sample is a new interpreter, timed around the import itself (like the
+cumulative figure from `python -X importtime`). Exits non-zero if the best
+sample is over the threshold or an unwanted module was loaded.
+
+    python benchmarks/import_time.py [--runs N] [--max-ms MS]
+"""
+
+from __future__ import absolute_import
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+SRC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src')
+
+DEFAULT_RUNS = 20
+DEFAULT_MAX_MS = 25.
+
+UNWANTED_MODULES = [
+    'boto3',
+    'botocore',
+    'heaviside.aws',
+    'heaviside.executor',
+    'heaviside.local',
+]
+
+PROBE = """
+import json, sys, time
+start = time.time()
+import heaviside
+elapsed = time.time() - start
+print(json.dumps({"ms": elapsed * 1000, "modules": sorted(sys.modules)}))
+"""
+
+def sample(python):
+    env = dict(os.environ)
+    env['PYTHONPATH'] = SRC_DIR
+    env['PYTHONDONTWRITEBYTECODE'] = ''
+    output = subprocess.check_output([python, '-c', PROBE], env=env)
+    return json.loads(output)
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description="Benchmark the import time of heaviside")
+    parser.add_argument('--runs', type=int, default=DEFAULT_RUNS)
+    parser.add_argument('--max-ms', type=float, default=DEFAULT_MAX_MS)
+    parser.add_argument('--python', default=sys.executable)
+    args = parser.parse_args(args)
+    
+    # the first run compiles bytecode; don't count it
+    sample(args.python)
+    
+    samples = [sample(args.python) for _ in range(args.runs)]
+    times = sorted(s['ms'] for s in samples)
+    loaded = sorted(set(module for s in samples for module in s['modules'] if module in UNWANTED_MODULES))
+    
+    result = {
+        "benchmark": "import_heaviside",
+        "runs": args.runs,
+        "min_ms": times[0],
+        "median_ms": times[len(times) // 2],
+        "max_ms": times[-1],
+        "threshold_ms": args.max_ms,
+        "unwanted_modules": loaded,
+    }
+    result["passed"] = result["min_ms"] <= args.max_ms and not loaded
+    
+    print json.dumps(result, indent=2, sort_keys=True)
+    return 0 if result["passed"] else 1
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -4,5 +4,9 @@ Because https://en.wikipedia.org/wiki/Heaviside_function
 
 from __future__ import absolute_import
 
-from .decorator import handler
-from .executor import is_heaviside_execution
\ No newline at end of file
+from .decorator import handler, register_task
+
+def is_heaviside_execution(context):
+    # imported here to keep the executor out of the import of the package
+    from .executor import is_heaviside_execution
+    return is_heaviside_execution(context)
@@ -6,47 +6,146 @@ Created on Oct 29, 2017
 
 import time
 import json
-import base64
+import math
+import os
+import re
+import collections
+import threading
 
 import boto3
+import boto3.dynamodb.conditions
+import botocore.config
+import botocore.exceptions
+import concurrent.futures
 
-from . import components, states, local
+from . import components, states, local, cache, codec
 
-def create_components(boto3_session=None):
+ENV_CENTRAL_EXECUTION_STORE = 'HEAVISIDE_CENTRAL_EXECUTION_STORE'
+
+def create_components(boto3_session=None, metrics=None, central_execution_store=None):
+    """With central_execution_store (or HEAVISIDE_CENTRAL_EXECUTION_STORE set),
+    executions are kept in the state table instead of in the context."""
     boto3_session = boto3_session or boto3.Session()
+    if central_execution_store is None:
+        central_execution_store = bool(os.environ.get(ENV_CENTRAL_EXECUTION_STORE))
+    
+    if metrics is None:
+        metrics = EMFMetricsSink() if os.environ.get(EMFMetricsSink.ENV_NAMESPACE) else components.NULL_METRICS
+    instrument_session(boto3_session, metrics)
     
-    definition_store = S3DefinitionStore(boto3_session)
+    definition_store = S3DefinitionStore(boto3_session, metrics=metrics)
     
-    execution_store = ClientContextAndDynamoDBExecutionStore()
+    blob_store = S3BlobStore(boto3_session, definition_store=definition_store)
     
-    logger_factory = local.LocalLoggerFactory()
+    if central_execution_store:
+        execution_store = DynamoDBExecutionStore(boto3_session, blob_store=blob_store, metrics=metrics)
+    else:
+        execution_store = ClientContextAndDynamoDBExecutionStore(blob_store=blob_store, metrics=metrics)
     
+    if os.environ.get(CloudWatchLoggerFactory.ENV_LOG_GROUP):
+        logger_factory = CloudWatchLoggerFactory(boto3_session)
+    else:
+        logger_factory = local.LocalLoggerFactory()
     
-    task_dispatcher = LambdaTaskDispatcher(boto3_session)
+    delay_queue = None
+    if os.environ.get(SQSDelayQueue.ENV_QUEUE_URL):
+        delay_queue = SQSDelayQueue(boto3_session, blob_store=blob_store, metrics=metrics)
     
+    task_dispatcher = LambdaTaskDispatcher(boto3_session, metrics=metrics, delay_queue=delay_queue)
+    
+    fan_in_store = DynamoDBFanInStore(boto3_session, blob_store=blob_store, metrics=metrics)
     
     return {
         "definition_store": definition_store,
         "execution_store": execution_store,
         "logger_factory": logger_factory,
         "task_dispatcher": task_dispatcher,
+        "fan_in_store": fan_in_store,
+        "metrics": metrics,
     }
 
+def instrument_session(boto3_session, metrics):
+    """Count the AWS calls made by clients created from the session from now on,
+    by service and operation, with their latency and errors."""
+    if not metrics.enabled:
+        return
+    
+    def before_call(model, context, **kwargs):
+        context['heaviside-call-start'] = time.time()
+    
+    def after_call(http_response, model, context, **kwargs):
+        dimensions = {
+            "Service": model.service_model.service_name,
+            "Operation": model.name,
+        }
+        metrics.increment('AWSCalls', dimensions=dimensions)
+        if http_response.status_code >= 400:
+            metrics.increment('AWSCallErrors', dimensions=dimensions)
+        start = context.get('heaviside-call-start')
+        if start is not None:
+            metrics.observe('AWSCallLatency', (time.time() - start) * 1000, dimensions=dimensions)
+    
+    boto3_session.events.register('before-call', before_call, unique_id='heaviside-metrics-before-call')
+    boto3_session.events.register('after-call', after_call, unique_id='heaviside-metrics-after-call')
+
 def create_and_configure_components(definition_bucket_name, boto3_session=None):
     comps = create_components(boto3_session)
     comps["definition_store"]._configure_bucket(definition_bucket_name)
     return comps
 
+_COMPONENTS = {}
+_COMPONENTS_LOCK = threading.Lock()
+
+def get_components(definition_bucket_name=None, region_name=None):
+    """Get components built once per process for the given configuration, so
+    warm containers reuse their session, clients and caches. The components
+    hold no per-execution state; executors hydrate them from each request's context."""
+    region_name = region_name or os.environ.get('AWS_REGION') or os.environ.get('AWS_DEFAULT_REGION')
+    key = (definition_bucket_name, region_name)
+    with _COMPONENTS_LOCK:
+        comps = _COMPONENTS.get(key)
+        if comps is None:
+            session = boto3.Session(region_name=region_name)
+            if definition_bucket_name:
+                comps = create_and_configure_components(definition_bucket_name, session)
+            else:
+                comps = create_components(session)
+            _COMPONENTS[key] = comps
+    return dict(comps)
+
+def clear_component_cache():
+    with _COMPONENTS_LOCK:
+        cached = _COMPONENTS.values()
+        _COMPONENTS.clear()
+    for comps in cached:
+        comps["task_dispatcher"].close()
+
 class S3DefinitionStore(components.DefinitionStore):
-    _DEFINITION_CACHE = {}
+    _DEFINITION_CACHE = cache.DefinitionCache.from_environment()
     
     @classmethod
-    def _check_definition_cache(cls, definition_id):
-        return cls._DEFINITION_CACHE.get(definition_id)
+    def configure_definition_cache(cls, definition_cache):
+        """Replace the process-wide definition cache shared by stores that weren't given their own."""
+        cls._DEFINITION_CACHE = definition_cache
     
-    @classmethod
-    def _cache_definition(cls, definition_id, definition):
-        cls._DEFINITION_CACHE[definition_id] = definition
+    def _check_definition_cache(self, definition_id):
+        definition = self.definition_cache.get(definition_id)
+        if self.metrics.enabled:
+            self.metrics.increment('DefinitionCacheHits' if definition is not None else 'DefinitionCacheMisses')
+        return definition
+    
+    def _cache_definition(self, definition_id, definition, size=None, verify=True):
+        self.definition_cache.put(definition_id, definition, size=size, verify=verify)
+    
+    _DISK_CACHE = cache.DiskDefinitionCache.from_environment()
+    
+    def _check_disk_cache(self, definition_id):
+        if self.disk_cache is None:
+            return None
+        definition = self.disk_cache.get(definition_id)
+        if self.metrics.enabled:
+            self.metrics.increment('DefinitionDiskCacheHits' if definition is not None else 'DefinitionDiskCacheMisses')
+        return definition
     
     DEFINITION_KEY_PREFIX = 'state_machine_definitions/'
     
@@ -57,12 +156,24 @@ class S3DefinitionStore(components.DefinitionStore):
     CONTEXT_DEFINITION_BUCKET_KEY = 'x-heaviside-sm-bucket'
     CONTEXT_DEFINITION_ID_KEY = 'x-heaviside-sm-def-id'
     
-    def __init__(self, boto3_session=None):
+    def __init__(self, boto3_session=None, definition_cache=None, disk_cache=False, metrics=None):
+        """disk_cache is a DiskDefinitionCache, None for no disk cache, or False
+        for the process-wide one (configured by HEAVISIDE_DEFINITION_DISK_CACHE)."""
         self.session = boto3_session or boto3.Session()
+        self._definition_cache = definition_cache
+        self.disk_cache = disk_cache if disk_cache is not False else self._DISK_CACHE
+        self.metrics = metrics or components.NULL_METRICS
         
+        self.s3 = None
         self.bucket_name = None
         self.bucket = None
     
+    @property
+    def definition_cache(self):
+        if self._definition_cache is not None:
+            return self._definition_cache
+        return self._DEFINITION_CACHE
+    
     def get_context(self):
         return {
             self.CONTEXT_DEFINITION_BUCKET_KEY: self.bucket_name
@@ -72,58 +183,158 @@ class S3DefinitionStore(components.DefinitionStore):
         self._configure_bucket(context[self.CONTEXT_DEFINITION_BUCKET_KEY])
     
     def _configure_bucket(self, bucket_name):
+        if self.bucket is not None and bucket_name == self.bucket_name:
+            return
+        if self.s3 is None:
+            self.s3 = self.session.resource('s3')
         self.bucket_name = bucket_name
-        self.bucket = self.session.resource('s3').Bucket(self.bucket_name)
+        self.bucket = self.s3.Bucket(self.bucket_name)
+    
+    # (bucket, definition id) pairs known to be in S3, least recently used first
+    MAX_STORED_DEFINITIONS = 1024
+    _STORED_DEFINITIONS = collections.OrderedDict()
+    _STORED_DEFINITIONS_LOCK = threading.Lock()
+    
+    @classmethod
+    def _known_stored(cls, stored_key):
+        with cls._STORED_DEFINITIONS_LOCK:
+            if cls._STORED_DEFINITIONS.pop(stored_key, None) is None:
+                return False
+            cls._STORED_DEFINITIONS[stored_key] = True
+            return True
+    
+    @classmethod
+    def _add_stored(cls, stored_key):
+        with cls._STORED_DEFINITIONS_LOCK:
+            cls._STORED_DEFINITIONS.pop(stored_key, None)
+            cls._STORED_DEFINITIONS[stored_key] = True
+            while len(cls._STORED_DEFINITIONS) > cls.MAX_STORED_DEFINITIONS:
+                cls._STORED_DEFINITIONS.popitem(last=False)
+    
+    def _is_stored(self, key):
+        """Check whether a definition object already exists in S3.
+        Definitions are content-addressed, so an existing object never needs rewriting.
+        Without s3:ListBucket, S3 answers 403 rather than 404 for a missing object,
+        so that is treated as not stored too."""
+        try:
+            self.bucket.meta.client.head_object(Bucket=self.bucket_name, Key=key)
+        except botocore.exceptions.ClientError as e:
+            if e.response.get('Error', {}).get('Code') in ('404', 'NoSuchKey', 'NotFound', '403', 'Forbidden'):
+                return False
+            raise
+        return True
     
     def put_anonymous(self, definition):
-        print '[put anon]'
+        logger = local.component_logger()
         definition_id = definition.get_hash()
         key = self.definition_key(definition_id)
         
-        response = self.bucket.Object(key).put(
-            Body=json.dumps(definition.to_json()),
-            Metadata={self.CONTEXT_DEFINITION_ID_KEY: definition_id})
-        
-        print key, json.dumps(response)
+        body = None
+        stored_key = (self.bucket_name, definition_id)
+        if self._known_stored(stored_key):
+            logger.debug('definition already stored', definition=definition_id)
+        else:
+            body = definition.get_canonical_json()
+            if not self._is_stored(key):
+                response = self.bucket.Object(key).put(
+                    Body=body,
+                    Metadata={self.CONTEXT_DEFINITION_ID_KEY: definition_id})
+                
+                logger.debug('stored definition', key=key, response=response)
+            
+            self._add_stored(stored_key)
         
-        self._cache_definition(definition_id, definition)
+        # cached even when the upload is skipped, as the memory cache may have evicted it
+        if definition_id not in self.definition_cache:
+            self._cache_definition(definition_id, definition, size=len(body) if body is not None else None,
+                                   verify=False)
         
-        print self._DEFINITION_CACHE
+        logger.debug('definition cache', stats=self.definition_cache.stats)
         
         return definition_id
     
     def hydrate_definition(self, definition_id):
-        print '[hydrate def] {}'.format(definition_id)
         definition = self._check_definition_cache(definition_id)
-        if not definition:
-            key = self.definition_key(definition_id)
-            response = self.bucket.Object(key).get()
-            definition = states.StateMachine.from_json(json.load(response['Body']))
-            self._cache_definition(definition_id, definition)
-        else:
-            print 'cached'
+        if definition:
+            return definition
+        
+        definition = self._check_disk_cache(definition_id)
+        if definition:
+            definition.compile()
+            self._cache_definition(definition_id, definition, verify=False)
+            return definition
+        
+        local.component_logger().debug('loading definition', definition=definition_id)
+        key = self.definition_key(definition_id)
+        response = self.bucket.Object(key).get()
+        body = response['Body'].read()
+        definition = states.StateMachine.from_json(json.loads(body))
+        self._cache_definition(definition_id, definition, size=len(body))
+        if self.disk_cache is not None:
+            # only after the memory cache has checked it against its id
+            self.disk_cache.put(definition_id, definition)
         return definition
 
+class S3BlobStore(components.BlobStore):
+    """Stores overflowed state data in S3. Unless a bucket is given, it uses the
+    definition store's bucket. References are s3:// URIs, so readers need no configuration."""
+    KEY_PREFIX = 'state_data/'
+    
+    def __init__(self, boto3_session=None, bucket_name=None, definition_store=None):
+        self.session = boto3_session or boto3.Session()
+        self.bucket_name = bucket_name
+        self.definition_store = definition_store
+        self.s3 = None
+    
+    def _client(self):
+        if self.s3 is None:
+            self.s3 = self.session.client('s3')
+        return self.s3
+    
+    def put(self, key, body):
+        bucket_name = self.bucket_name or self.definition_store.bucket_name
+        key = '{}{}'.format(self.KEY_PREFIX, key)
+        self._client().put_object(Bucket=bucket_name, Key=key, Body=body)
+        return 's3://{}/{}'.format(bucket_name, key)
+    
+    def put_file(self, key, fileobj):
+        bucket_name = self.bucket_name or self.definition_store.bucket_name
+        key = '{}{}'.format(self.KEY_PREFIX, key)
+        # a multipart upload for large files, so the body is never read into memory whole
+        self._client().upload_fileobj(fileobj, bucket_name, key)
+        return 's3://{}/{}'.format(bucket_name, key)
+    
+    def get(self, ref):
+        if not ref.startswith('s3://'):
+            raise ValueError("Not an S3 reference: {}".format(ref))
+        bucket_name, key = ref[len('s3://'):].split('/', 1)
+        return self._client().get_object(Bucket=bucket_name, Key=key)['Body'].read()
+
 class ClientContextAndDynamoDBExecutionStore(components.ExecutionStore):
+    def __init__(self, blob_store=None, overflow_threshold=components.StateDataOverflow.DEFAULT_THRESHOLD, metrics=None):
+        self.overflow = components.StateDataOverflow(blob_store, overflow_threshold, metrics=metrics)
+    
     def execution_factory(self, execution_id, definition_store):
-        return self.Execution(execution_id, definition_store)
+        return self.Execution(execution_id, definition_store, self.overflow)
     
     class Execution(components.Execution):
-        def __init__(self, execution_id, definition_store):
+        def __init__(self, execution_id, definition_store, overflow=None):
             components.Execution.__init__(self, execution_id, definition_store)
             
+            self.overflow = overflow or components.StateDataOverflow()
+            
             self.current_state = None
             self.result = None
             self.definition_id = None
         
         def get_context(self):
             return {
-                components.Execution.CONTEXT_CURRENT_STATE_KEY: self.current_state.to_json(),
+                components.Execution.CONTEXT_CURRENT_STATE_KEY: self.overflow.state_to_json(self.execution_id, self.current_state),
                 components.Execution.CONTEXT_DEFINITION_ID_KEY: self.definition_id,
             }
         
         def hydrate(self, context):
-            self.current_state = components.State.from_json(context[self.CONTEXT_CURRENT_STATE_KEY])
+            self.current_state = self.overflow.state_from_json(context[self.CONTEXT_CURRENT_STATE_KEY])
             self.definition_id = context[self.CONTEXT_DEFINITION_ID_KEY]
         
         def initialize(self, definition):
@@ -140,6 +351,9 @@ class ClientContextAndDynamoDBExecutionStore(components.ExecutionStore):
         def update_state_data(self, data):
             self.current_state.data = data
         
+        def update_state_retries(self, retries):
+            self.current_state.retries = retries
+        
         def set_result(self, result):
             self.current_state = None
             self.result = result
@@ -147,74 +361,886 @@ class ClientContextAndDynamoDBExecutionStore(components.ExecutionStore):
         def get_current_state_and_result(self):
             return self.current_state, self.result
 
-class CloudWatchLogger(components.ExecutorComponent):
-    CONTEXT_LOG_SEQUENCE_TOKEN_KEY = 'x-heaviside-log-seq'
+class DynamoDBExecutionStore(components.ExecutionStore):
+    """Keeps executions in the state table (StateTable in template.yaml), so the
+    context only carries the execution id.
     
-    def log_group_name(self):
-        return 'heaviside'
+    An execution is one item, keyed by its id, holding its definition id, its
+    current state and its result, and a version. Changes are kept in memory
+    until the executor flushes at the end of its hop, and are then written
+    with a single put, conditional on the version read (or on the item not
+    existing, for a new execution). A second executor for the same hop, like
+    a duplicate delivery, fails with ExecutionConflict instead of advancing
+    the execution twice. The context carries the version each dispatch was
+    made at, so a stale delivery is refused when it is hydrated.
+    Branch executions are deleted when they finish, once their result is in
+    the fan-in; a delivery for one that is gone is stale too.
+    Large state data is moved to the blob store.
+    """
+    ENV_TABLE_NAME = 'StateTable'
     
-    def log_stream_name(self):
-        return '{}'.format(self.execution_id)
+    HASH_KEY = 'state_machine_id'
+    RANGE_KEY = 'state_id'
+    EXECUTION_RANGE_KEY = '#execution'
+    
+    CONTEXT_VERSION_KEY = 'x-heaviside-sm-version'
     
-    def __init__(self, boto3_session, execution_id, executor_id):
+    def __init__(self, boto3_session=None, table_name=None, table=None, blob_store=None,
+                 overflow_threshold=components.StateDataOverflow.DEFAULT_THRESHOLD, metrics=None):
+        """table is a boto3 Table resource, or a stand-in like local.FakeDynamoDBTable."""
         self.session = boto3_session
+        self.table_name = table_name
+        self._table = table
+        self.overflow = components.StateDataOverflow(blob_store, overflow_threshold, metrics=metrics)
+    
+    @property
+    def table(self):
+        if self._table is None:
+            table_name = self.table_name or os.environ[self.ENV_TABLE_NAME]
+            self._table = (self.session or boto3.Session()).resource('dynamodb').Table(table_name)
+        return self._table
+    
+    def execution_factory(self, execution_id, definition_store):
+        return self.Execution(execution_id, definition_store, self)
+    
+    def key(self, execution_id):
+        return {
+            self.HASH_KEY: execution_id,
+            self.RANGE_KEY: self.EXECUTION_RANGE_KEY,
+        }
+    
+    class Execution(components.Execution):
+        def __init__(self, execution_id, definition_store, store):
+            components.Execution.__init__(self, execution_id, definition_store)
+            self.store = store
+            
+            self.current_state = None
+            self.result = None
+            self.definition_id = None
+            # the version read, or None for an execution not written yet
+            self.version = None
+            self._dirty = False
+        
+        def get_context(self):
+            return {
+                self.store.CONTEXT_VERSION_KEY: self.version,
+            }
+        
+        def hydrate(self, context):
+            version = context.get(self.store.CONTEXT_VERSION_KEY)
+            try:
+                self._load()
+            except KeyError:
+                if version is None:
+                    raise
+                raise components.ExecutionConflict(
+                    "Execution {} has finished and been removed".format(self.execution_id))
+            if version is not None and version != self.version:
+                raise components.ExecutionConflict(
+                    "Execution {} is at version {}, not {}".format(self.execution_id, self.version, version))
+        
+        def _load(self):
+            item = self.store.table.get_item(Key=self.store.key(self.execution_id), ConsistentRead=True).get('Item')
+            if item is None:
+                raise KeyError("Execution {} not found".format(self.execution_id))
+            self.definition_id = item['definition_id']
+            self.version = int(item['version'])
+            self.current_state = None
+            if 'state' in item:
+                self.current_state = self.store.overflow.state_from_json(json.loads(item['state']))
+            self.result = None
+            if 'result' in item:
+                self.result = components.Result.from_json(json.loads(item['result']))
+            self._dirty = False
+        
+        def initialize(self, definition):
+            self.definition_id = self.definition_store.put_anonymous(definition)
+            self.current_state = None
+            self.result = None
+            self.version = None
+            self._dirty = True
+        
+        def attach(self, definition):
+            self._load()
+        
+        def get_definition(self):
+            return self.definition_store.hydrate_definition(self.definition_id)
+        
+        def change_state(self, new_state_name, data=None):
+            self.current_state = components.State(new_state_name, data=data)
+            self._dirty = True
+        
+        def update_state_data(self, data):
+            self.current_state.data = data
+            self._dirty = True
+        
+        def update_state_retries(self, retries):
+            self.current_state.retries = retries
+            self._dirty = True
+        
+        def set_result(self, result):
+            self.current_state = None
+            self.result = result
+            self._dirty = True
+        
+        def get_current_state_and_result(self):
+            return self.current_state, self.result
+        
+        def flush(self):
+            if not self._dirty:
+                return
+            item = self.store.key(self.execution_id)
+            item['definition_id'] = self.definition_id
+            item['version'] = (self.version or 0) + 1
+            if self.current_state is not None:
+                item['state'] = json.dumps(self.store.overflow.state_to_json(self.execution_id, self.current_state))
+            if self.result is not None:
+                item['result'] = json.dumps(self.result.to_json())
+            
+            if self.version is None:
+                condition = {
+                    'ConditionExpression': 'attribute_not_exists(#key)',
+                    'ExpressionAttributeNames': {'#key': self.store.HASH_KEY},
+                }
+            else:
+                condition = {
+                    'ConditionExpression': '#version = :version',
+                    'ExpressionAttributeNames': {'#version': 'version'},
+                    'ExpressionAttributeValues': {':version': self.version},
+                }
+            try:
+                self.store.table.put_item(Item=item, **condition)
+            except botocore.exceptions.ClientError as e:
+                if e.response.get('Error', {}).get('Code') == 'ConditionalCheckFailedException':
+                    raise components.ExecutionConflict(
+                        "Execution {} was changed since version {}".format(self.execution_id, self.version))
+                raise
+            self.version = item['version']
+            self._dirty = False
+        
+        def delete(self):
+            self.store.table.delete_item(Key=self.store.key(self.execution_id))
+            self._dirty = False
+
+class DynamoDBFanInStore(components.FanInStore):
+    """Fan-in coordination in the state table (StateTable in template.yaml).
+    
+    Each fan-in has a counter item keyed by the owning execution and the fan-in id,
+    holding the number of branches remaining and the set of branches recorded.
+    Branch outputs are separate items, keyed by the fan-in id and the branch index,
+    so large fan-outs don't run into the item size limit. Recording an output
+    decrements the counter with a conditional update, so exactly one branch sees 0.
+    Inputs of branches not started yet are also separate items, claimed in order
+    by incrementing the counter item's next index.
+    The outputs are read a page at a time when they are collected; with a blob
+    store, a large result is written to it rather than held in memory.
+    """
+    ENV_TABLE_NAME = 'StateTable'
+    
+    HASH_KEY = 'state_machine_id'
+    RANGE_KEY = 'state_id'
+    
+    def __init__(self, boto3_session=None, table_name=None, blob_store=None, metrics=None):
+        self.session = boto3_session or boto3.Session()
+        self.table_name = table_name
+        self._table = None
+        if blob_store is not None:
+            self.overflow = components.StateDataOverflow(blob_store, self.OUTPUT_THRESHOLD, metrics=metrics)
+    
+    @property
+    def table(self):
+        if self._table is None:
+            table_name = self.table_name or os.environ[self.ENV_TABLE_NAME]
+            self._table = self.session.resource('dynamodb').Table(table_name)
+        return self._table
+    
+    def _output_key(self, owner_id, fan_in_id, index):
+        return {
+            self.HASH_KEY: owner_id,
+            self.RANGE_KEY: '{}#{:08d}'.format(fan_in_id, index),
+        }
+    
+    def _pending_key(self, owner_id, fan_in_id, index):
+        return {
+            self.HASH_KEY: owner_id,
+            self.RANGE_KEY: '{}@{:08d}'.format(fan_in_id, index),
+        }
+    
+    def _counter_key(self, owner_id, fan_in_id):
+        return {
+            self.HASH_KEY: owner_id,
+            self.RANGE_KEY: fan_in_id,
+        }
+    
+    @classmethod
+    def _is_condition_failure(cls, error):
+        return error.response.get('Error', {}).get('Code') == 'ConditionalCheckFailedException'
+    
+    def create_fan_in(self, owner_id, fan_in_id, count, pending_inputs=None, owner_input=None):
+        pending_inputs = pending_inputs or []
+        first_pending = count - len(pending_inputs)
+        if pending_inputs:
+            with self.table.batch_writer() as batch:
+                for offset, input in enumerate(pending_inputs):
+                    item = self._pending_key(owner_id, fan_in_id, first_pending + offset)
+                    item['input'] = json.dumps(input)
+                    batch.put_item(Item=item)
+        
+        item = self._counter_key(owner_id, fan_in_id)
+        item['remaining'] = count
+        item['branch_count'] = count
+        item['next_index'] = first_pending
+        if owner_input is not None:
+            item['owner_input'] = json.dumps(owner_input)
+        self.table.put_item(Item=item)
+    
+    def claim_pending(self, owner_id, fan_in_id):
+        try:
+            response = self.table.update_item(
+                Key=self._counter_key(owner_id, fan_in_id),
+                UpdateExpression='ADD #next :one',
+                ConditionExpression='attribute_not_exists(#failed) AND #next < #count',
+                ExpressionAttributeNames={
+                    '#next': 'next_index',
+                    '#count': 'branch_count',
+                    '#failed': 'failed',
+                },
+                ExpressionAttributeValues={':one': 1},
+                ReturnValues='UPDATED_OLD')
+        except botocore.exceptions.ClientError as e:
+            if self._is_condition_failure(e):
+                return None
+            raise
+        index = int(response['Attributes']['next_index'])
+        key = self._pending_key(owner_id, fan_in_id, index)
+        item = self.table.get_item(Key=key, ConsistentRead=True).get('Item')
+        if item is None:
+            # the fan-in failed and was deleted after the claim
+            return None
+        self.table.delete_item(Key=key)
+        return index, json.loads(item['input'])
+    
+    def record_output(self, owner_id, fan_in_id, index, output):
+        # the output is written before the count, so the last branch finds every output;
+        # it is removed again if the count refuses it
+        item = self._output_key(owner_id, fan_in_id, index)
+        item['output'] = json.dumps(output)
+        self.table.put_item(Item=item)
+        
+        try:
+            response = self.table.update_item(
+                Key=self._counter_key(owner_id, fan_in_id),
+                UpdateExpression='ADD #remaining :dec, #done :index',
+                ConditionExpression='attribute_not_exists(#failed) AND #remaining > :zero AND NOT contains(#done, :i)',
+                ExpressionAttributeNames={
+                    '#remaining': 'remaining',
+                    '#done': 'done',
+                    '#failed': 'failed',
+                },
+                ExpressionAttributeValues={
+                    ':dec': -1,
+                    ':zero': 0,
+                    ':index': set([index]),
+                    ':i': index,
+                },
+                ReturnValues='UPDATED_NEW')
+        except botocore.exceptions.ClientError as e:
+            if not self._is_condition_failure(e):
+                raise
+            if not self._is_recorded(owner_id, fan_in_id, index):
+                # the fan-in has failed or been deleted, and won't collect the output
+                self.table.delete_item(Key=self._output_key(owner_id, fan_in_id, index))
+            return None
+        return int(response['Attributes']['remaining'])
+    
+    def _is_recorded(self, owner_id, fan_in_id, index):
+        """Whether the branch's output was recorded by an earlier delivery, in a
+        fan-in that is still collecting."""
+        item = self.table.get_item(
+            Key=self._counter_key(owner_id, fan_in_id),
+            ProjectionExpression='#done, #failed',
+            ExpressionAttributeNames={'#done': 'done', '#failed': 'failed'},
+            ConsistentRead=True).get('Item')
+        return item is not None and 'failed' not in item and index in item.get('done', ())
+    
+    def record_failure(self, owner_id, fan_in_id, index, error):
+        try:
+            self.table.update_item(
+                Key=self._counter_key(owner_id, fan_in_id),
+                UpdateExpression='SET #failed = :error',
+                # not on a deleted fan-in, which the update would otherwise recreate
+                ConditionExpression='attribute_exists(#count) AND attribute_not_exists(#failed)',
+                ExpressionAttributeNames={
+                    '#count': 'branch_count',
+                    '#failed': 'failed',
+                },
+                ExpressionAttributeValues={':error': error or 'States.BranchFailed'})
+        except botocore.exceptions.ClientError as e:
+            if self._is_condition_failure(e):
+                return False
+            raise
+        return True
+    
+    def _query_items(self, owner_id, fan_in_id, separator):
+        """The fan-in's output items (separator '#') or pending input items ('@')."""
+        kwargs = {
+            'KeyConditionExpression':
+                boto3.dynamodb.conditions.Key(self.HASH_KEY).eq(owner_id)
+                & boto3.dynamodb.conditions.Key(self.RANGE_KEY).begins_with(fan_in_id + separator),
+            'ConsistentRead': True,
+        }
+        while True:
+            response = self.table.query(**kwargs)
+            for item in response['Items']:
+                yield item
+            if 'LastEvaluatedKey' not in response:
+                break
+            kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+    
+    def iter_outputs(self, owner_id, fan_in_id):
+        # range keys are zero-padded, so the query returns branches in order
+        for item in self._query_items(owner_id, fan_in_id, '#'):
+            yield json.loads(item['output'])
+    
+    def get_owner_input(self, owner_id, fan_in_id):
+        item = self.table.get_item(
+            Key=self._counter_key(owner_id, fan_in_id),
+            ProjectionExpression='owner_input',
+            ConsistentRead=True).get('Item', {})
+        return json.loads(item['owner_input']) if 'owner_input' in item else None
+    
+    def delete_fan_in(self, owner_id, fan_in_id):
+        """Delete the counter, the outputs, and the inputs of branches a failed
+        fan-in never started."""
+        with self.table.batch_writer() as batch:
+            for separator in ('#', '@'):
+                for item in self._query_items(owner_id, fan_in_id, separator):
+                    batch.delete_item(Key=dict((key, item[key]) for key in (self.HASH_KEY, self.RANGE_KEY)))
+            batch.delete_item(Key=self._counter_key(owner_id, fan_in_id))
+
+class BufferedCloudWatchLogger(components.Logger):
+    """Logs to a CloudWatch Logs stream per execution.
+    
+    Events are buffered and sent in as few PutLogEvents calls as the service's
+    batch limits allow: when the buffer fills, and when flush() is called at the
+    end of the handler. The sequence token is carried in the context; the executor
+    flushes the log before it builds the context for each dispatch, so the token
+    is current. When it is stale anyway (events logged after the dispatch were sent
+    at the end of the handler), the token the service expects is used instead, and
+    a missing stream is created.
+    """
+    CONTEXT_LOG_SEQUENCE_TOKEN_KEY = 'x-heaviside-log-seq'
+    
+    DEFAULT_LOG_GROUP_NAME = 'heaviside'
+    
+    MAX_BATCH_EVENTS = 10000
+    MAX_BATCH_BYTES = 1048576
+    EVENT_OVERHEAD_BYTES = 26
+    MAX_EVENT_BYTES = 262144 - EVENT_OVERHEAD_BYTES
+    
+    MAX_ATTEMPTS = 5
+    
+    _EXPECTED_TOKEN = re.compile(r'sequenceToken(?: is)?: (\S+)')
+    
+    def __init__(self, logs_client, execution_id, executor_id,
+                 log_group_name=None,
+                 level=components.Logger.INFO,
+                 max_batch_events=MAX_BATCH_EVENTS,
+                 max_batch_bytes=MAX_BATCH_BYTES,
+                 clock=None):
+        self.logs = logs_client
         
         self.execution_id = execution_id
         self.executor_id = executor_id
+        self.level = level
+        
+        self._log_group_name = log_group_name or self.DEFAULT_LOG_GROUP_NAME
+        self.max_batch_events = max_batch_events
+        self.max_batch_bytes = max_batch_bytes
+        self.clock = clock or time.time
         
-        self.logs = boto3.client('logs')
         self.sequence_token = None
+        self._events = []
+        self._bytes = 0
+        
+        self.batches_sent = 0
+        self.events_sent = 0
+    
+    def log_group_name(self):
+        return self._log_group_name
+    
+    def log_stream_name(self):
+        return '{}'.format(self.execution_id)
     
     def get_context(self):
+        if self.sequence_token is None:
+            return {}
         return {
             self.CONTEXT_LOG_SEQUENCE_TOKEN_KEY: self.sequence_token,
         }
     
     def hydrate(self, context):
-        self.sequence_token = context[self.CONTEXT_LOG_SEQUENCE_TOKEN_KEY]
+        self.sequence_token = context.get(self.CONTEXT_LOG_SEQUENCE_TOKEN_KEY)
+    
+    def initialize(self):
+        pass
     
     def log(self, message):
+        if not isinstance(message, unicode):
+            message = message.decode('utf-8', 'replace')
+        encoded_size = len(message.encode('utf-8'))
+        if encoded_size > self.MAX_EVENT_BYTES:
+            message = message.encode('utf-8')[:self.MAX_EVENT_BYTES].decode('utf-8', 'ignore')
+            encoded_size = len(message.encode('utf-8'))
+        size = encoded_size + self.EVENT_OVERHEAD_BYTES
+        
+        if self._events and (len(self._events) >= self.max_batch_events
+                             or self._bytes + size > self.max_batch_bytes):
+            self.flush()
+        
+        self._events.append({
+            'timestamp': int(self.clock() * 1000),
+            'message': message,
+        })
+        self._bytes += size
+    
+    def flush(self):
+        if not self._events:
+            return
+        events, self._events, self._bytes = self._events, [], 0
+        events.sort(key=lambda event: event['timestamp'])
+        
+        error = None
+        for _ in xrange(self.MAX_ATTEMPTS):
+            kwargs = {
+                "logGroupName": self.log_group_name(),
+                "logStreamName": self.log_stream_name(),
+                "logEvents": events,
+            }
+            if self.sequence_token:
+                kwargs["sequenceToken"] = self.sequence_token
+            
+            try:
+                response = self.logs.put_log_events(**kwargs)
+            except botocore.exceptions.ClientError as e:
+                error = e
+                code = e.response.get('Error', {}).get('Code')
+                if code == 'InvalidSequenceTokenException':
+                    self.sequence_token = self._expected_sequence_token(e)
+                elif code == 'DataAlreadyAcceptedException':
+                    self.sequence_token = self._expected_sequence_token(e)
+                    return
+                elif code == 'ResourceNotFoundException':
+                    self._create_log_stream()
+                    self.sequence_token = None
+                else:
+                    break
+            else:
+                self.sequence_token = response.get('nextSequenceToken')
+                self.batches_sent += 1
+                self.events_sent += len(events)
+                return
+        
+        # a task shouldn't fail because its log couldn't be written
+        local.component_logger().error('dropped {} log events', len(events),
+                                       stream=self.log_stream_name(), error=str(error))
+    
+    def _expected_sequence_token(self, error):
+        token = error.response.get('expectedSequenceToken')
+        if token is None:
+            match = self._EXPECTED_TOKEN.search(error.response.get('Error', {}).get('Message', ''))
+            token = match.group(1) if match else None
+        if token == 'null':
+            return None
+        return token
+    
+    def _create_log_stream(self):
         kwargs = {
             "logGroupName": self.log_group_name(),
             "logStreamName": self.log_stream_name(),
-            "logEvents": [
-                {
-                    'timestamp': long(time.time()),
-                    'message': message,
-                },
-            ],
         }
-        
-        if self.sequence_token:
-            kwargs["sequenceToken"] = self.sequence_token
-        
-        response = self.logs.put_log_events(**kwargs)
-        
-        self.sequence_token = response["sequenceToken"]
+        try:
+            self.logs.create_log_stream(**kwargs)
+        except botocore.exceptions.ClientError as e:
+            code = e.response.get('Error', {}).get('Code')
+            if code == 'ResourceNotFoundException':
+                self._create_if_missing(self.logs.create_log_group, logGroupName=self.log_group_name())
+                self._create_if_missing(self.logs.create_log_stream, **kwargs)
+            elif code != 'ResourceAlreadyExistsException':
+                raise
     
-    def initialize(self):
-        pass
+    def _create_if_missing(self, create, **kwargs):
+        try:
+            create(**kwargs)
+        except botocore.exceptions.ClientError as e:
+            if e.response.get('Error', {}).get('Code') != 'ResourceAlreadyExistsException':
+                raise
+
+CloudWatchLogger = BufferedCloudWatchLogger
 
-class CloudWatchLoggerFactory(object):
-    def __init__(self, boto3_session=None):
+class CloudWatchLoggerFactory(components.LoggerFactory):
+    """Creates BufferedCloudWatchLoggers sharing one Logs client. The log group
+    defaults to the HEAVISIDE_LOG_GROUP environment variable."""
+    ENV_LOG_GROUP = 'HEAVISIDE_LOG_GROUP'
+    
+    def __init__(self, boto3_session=None, log_group_name=None, endpoint_url=None, level=None, sample_rate=None):
+        super(CloudWatchLoggerFactory, self).__init__(level=level, sample_rate=sample_rate)
         self.session = boto3_session or boto3.Session()
+        self.log_group_name = log_group_name or os.environ.get(self.ENV_LOG_GROUP)
+        self.logs = self.session.client('logs', endpoint_url=endpoint_url)
     
     def logger_factory(self, execution_id, executor_id):
-        return CloudWatchLogger()
+        return BufferedCloudWatchLogger(self.logs, execution_id, executor_id,
+                                        log_group_name=self.log_group_name,
+                                        level=self.get_level(execution_id))
+
+class DispatchStats(object):
+    def __init__(self):
+        self.invocations = 0
+        self.errors = 0
+        self.total_latency = 0.
+        self.max_latency = 0.
+    
+    def record(self, latency, error=False):
+        self.invocations += 1
+        if error:
+            self.errors += 1
+        self.total_latency += latency
+        self.max_latency = max(self.max_latency, latency)
+    
+    def to_json(self):
+        return {
+            "Invocations": self.invocations,
+            "Errors": self.errors,
+            "MeanLatency": self.total_latency / self.invocations if self.invocations else None,
+            "MaxLatency": self.max_latency,
+        }
 
 class LambdaTaskDispatcher(components.TaskDispatcher):
-    def __init__(self, boto3_session=None):
+    """Invokes task Lambdas.
+    
+    With the Event invocation type, the dispatching Lambda doesn't wait for the
+    task to finish. Lambda drops the ClientContext on Event invocations, so the
+    context is carried in the payload instead and unwrapped by the decorator.
+    
+    Lambda clients are shared by all dispatchers in the process with the same
+    credentials, region, endpoint and pool size, so warm containers reuse their
+    connections. Fan-out dispatches run on a thread pool, shut down by close().
+    
+    Delayed dispatches (retries) and waiting executions go through the delay
+    queue, if there is one, so no Lambda waits for them.
+    """
+    INVOCATION_TYPE_REQUEST_RESPONSE = 'RequestResponse'
+    INVOCATION_TYPE_EVENT = 'Event'
+    
+    ENV_INVOCATION_TYPE = 'HEAVISIDE_INVOCATION_TYPE'
+    
+    DEFAULT_MAX_WORKERS = 10
+    
+    # refreshed credentials make new clients, so only the most recent are kept
+    MAX_CLIENTS = 16
+    
+    _CLIENTS = collections.OrderedDict()
+    _CLIENTS_LOCK = threading.Lock()
+    
+    @classmethod
+    def _get_client(cls, session, endpoint_url, max_pool_connections):
+        credentials = session.get_credentials()
+        access_key = credentials.access_key if credentials is not None else None
+        key = (session.profile_name, access_key, session.region_name, endpoint_url, max_pool_connections)
+        with cls._CLIENTS_LOCK:
+            client = cls._CLIENTS.pop(key, None)
+            if client is None:
+                client = session.client('lambda',
+                    endpoint_url=endpoint_url,
+                    config=botocore.config.Config(max_pool_connections=max_pool_connections))
+            cls._CLIENTS[key] = client
+            while len(cls._CLIENTS) > cls.MAX_CLIENTS:
+                cls._CLIENTS.popitem(last=False)
+        return client
+    
+    def __init__(self, boto3_session=None, context_codec=None,
+                 invocation_type=None, max_workers=DEFAULT_MAX_WORKERS, endpoint_url=None, metrics=None,
+                 delay_queue=None):
         self.session = boto3_session or boto3.Session()
-        self.lambda_svc = self.session.client('lambda')
+        self.metrics = metrics or components.NULL_METRICS
+        self.delay_queue = delay_queue
+        self.lambda_svc = self._get_client(self.session, endpoint_url, max_workers)
+        self.context_codec = context_codec or codec.get_codec()
+        self.invocation_type = (invocation_type
+                                or os.environ.get(self.ENV_INVOCATION_TYPE)
+                                or self.INVOCATION_TYPE_REQUEST_RESPONSE)
+        self.max_workers = max_workers
+        self._pool = None
+        
+        self.last_context_size = None
+        self.max_context_size = 0
+        
+        self._stats = collections.defaultdict(DispatchStats)
+        self._stats_lock = threading.Lock()
+    
+    def stats(self):
+        with self._stats_lock:
+            return dict((resource, stats.to_json()) for resource, stats in self._stats.iteritems())
+    
+    def close(self):
+        """Shut down the fan-out thread pool, waiting for its dispatches."""
+        pool, self._pool = self._pool, None
+        if pool is not None:
+            pool.shutdown(wait=True)
     
     def dispatch(self, resource, input, context):
+        custom = self.context_codec.encode(context)
+        
         kwargs = {
             "FunctionName": resource,
-            "Payload": json.dumps({'baz': 'bar'}),
-            "InvocationType": "RequestResponse",
-            "ClientContext": base64.b64encode(json.dumps({"custom": context})),
+            "InvocationType": self.invocation_type,
         }
+        
+        if self.invocation_type == self.INVOCATION_TYPE_EVENT:
+            kwargs["Payload"] = json.dumps(codec.wrap_payload(input, custom))
+            if self.metrics.enabled:
+                self.metrics.observe('ContextBytes', len(json.dumps(custom)),
+                                     unit=components.MetricsSink.UNIT_BYTES)
+        else:
+            client_context = codec.encode_client_context(custom)
+            
+            self.last_context_size = len(client_context)
+            self.max_context_size = max(self.max_context_size, self.last_context_size)
+            local.component_logger().debug('client context: {} bytes ({})',
+                                           self.last_context_size, self.context_codec.NAME)
+            if self.metrics.enabled:
+                self.metrics.observe('ContextBytes', self.last_context_size,
+                                     unit=components.MetricsSink.UNIT_BYTES)
+            if self.last_context_size > codec.CLIENT_CONTEXT_LIMIT:
+                raise ValueError("Client context is {} bytes, over the {} byte limit".format(
+                    self.last_context_size, codec.CLIENT_CONTEXT_LIMIT))
+            
+            kwargs["Payload"] = json.dumps(input)
+            kwargs["ClientContext"] = client_context
+        
         #kwargs["InvocationType"] = "DryRun"
-        result = self.lambda_svc.invoke(**kwargs)
-        print result['StatusCode'], result
-        
\ No newline at end of file
+        start = time.time()
+        try:
+            result = self.lambda_svc.invoke(**kwargs)
+        except Exception:
+            with self._stats_lock:
+                self._stats[resource].record(time.time() - start, error=True)
+            self._record_dispatch(resource, start, error=True)
+            raise
+        with self._stats_lock:
+            self._stats[resource].record(time.time() - start, error='FunctionError' in result)
+        self._record_dispatch(resource, start, error='FunctionError' in result)
+        local.component_logger().debug('invoked', resource=resource, status_code=result['StatusCode'])
+    
+    def can_schedule(self):
+        return self.delay_queue is not None
+    
+    def dispatch_later(self, resource, input, context, delay):
+        if self.delay_queue is None:
+            raise ValueError("Retries need a delay queue (set {})".format(SQSDelayQueue.ENV_QUEUE_URL))
+        self.delay_queue.send({
+            "Resource": resource,
+            "Input": input,
+            "Context": self.context_codec.encode(context),
+        }, delay)
+    
+    def resume_later(self, input, context, delay):
+        if self.delay_queue is None:
+            raise ValueError("Wait states need a delay queue (set {})".format(SQSDelayQueue.ENV_QUEUE_URL))
+        self.delay_queue.send({
+            "Input": input,
+            "Context": self.context_codec.encode(context),
+        }, delay)
+    
+    def _record_dispatch(self, resource, start, error):
+        if not self.metrics.enabled:
+            return
+        dimensions = {"Resource": resource}
+        self.metrics.increment('Dispatches', dimensions=dimensions)
+        self.metrics.observe('DispatchLatency', (time.time() - start) * 1000, dimensions=dimensions)
+        if error:
+            self.metrics.increment('DispatchErrors', dimensions=dimensions)
+    
+    def dispatch_many(self, dispatches):
+        dispatches = list(dispatches)
+        if len(dispatches) <= 1:
+            return super(LambdaTaskDispatcher, self).dispatch_many(dispatches)
+        if self._pool is None:
+            self._pool = concurrent.futures.ThreadPoolExecutor(max_workers=self.max_workers)
+        futures = [self._pool.submit(self.dispatch, resource, input, context)
+                   for resource, input, context in dispatches]
+        return [future.exception() for future in futures]
+
+class SQSDelayQueue(object):
+    """Delivers messages after a delay through an SQS queue (DelayQueue in
+    template.yaml), consumed by delay_handler. SQS can delay a message by at
+    most 15 minutes, so each message carries the time it is due, and one that
+    arrives early is sent again for the time remaining. SQS messages are limited
+    to 256KB, so an Input over MAX_INLINE_BYTES is moved to the blob store."""
+    ENV_QUEUE_URL = 'HEAVISIDE_DELAY_QUEUE'
+    
+    MAX_DELAY_SECONDS = 900
+    MAX_INLINE_BYTES = 192 * 1024
+    
+    def __init__(self, boto3_session=None, queue_url=None, endpoint_url=None, clock=None,
+                 blob_store=None, metrics=None):
+        self.session = boto3_session or boto3.Session()
+        self.queue_url = queue_url or os.environ[self.ENV_QUEUE_URL]
+        self.sqs = self.session.client('sqs', endpoint_url=endpoint_url)
+        self.clock = clock or time.time
+        self.overflow = components.StateDataOverflow(blob_store, self.MAX_INLINE_BYTES, metrics=metrics)
+    
+    def send(self, message, delay):
+        message = dict(message)
+        message["Due"] = self.clock() + delay
+        ref = self.overflow.put_data('delayed', message["Input"])
+        if ref is not None:
+            message["InputRef"] = ref
+            del message["Input"]
+        self._send(message)
+    
+    def _send(self, message):
+        delay = int(math.ceil(message["Due"] - self.clock()))
+        self.sqs.send_message(
+            QueueUrl=self.queue_url,
+            MessageBody=json.dumps(message),
+            DelaySeconds=max(0, min(delay, self.MAX_DELAY_SECONDS)))
+    
+    def receive(self, body):
+        """Return the message in a received body if it is due; otherwise send it
+        on again and return None."""
+        message = json.loads(body)
+        if message["Due"] - self.clock() >= 1:
+            self._send(message)
+            return None
+        if "InputRef" in message:
+            message["Input"] = self.overflow.load_data(message.pop("InputRef"))
+        return message
+
+def delay_handler(event, context):
+    """Lambda handler for the delay queue: dispatches the delayed Tasks and
+    resumes the waiting executions that are due.
+    Records are handled one at a time, and the ones that failed are reported
+    in batchItemFailures (ReportBatchItemFailures in template.yaml), so only
+    they are delivered again."""
+    comps = get_components()
+    failures = []
+    try:
+        for record in event["Records"]:
+            try:
+                _handle_delayed(comps, record["body"])
+            except Exception as e:
+                local.component_logger().error('delayed message failed',
+                                               message_id=record.get("messageId"), error=str(e))
+                failures.append({"itemIdentifier": record["messageId"]})
+    finally:
+        comps["metrics"].flush()
+    return {"batchItemFailures": failures}
+
+def _handle_delayed(comps, body):
+    from . import executor
+    
+    task_dispatcher = comps["task_dispatcher"]
+    message = task_dispatcher.delay_queue.receive(body)
+    if message is None:
+        return
+    heaviside_context = codec.decode_context(message["Context"])
+    if "Resource" in message:
+        task_dispatcher.dispatch(message["Resource"], message["Input"], heaviside_context)
+        return
+    try:
+        ex = executor.Executor.hydrate(heaviside_context, **comps)
+        try:
+            ex.resume(message["Input"])
+        finally:
+            ex.logger.flush()
+    except components.ExecutionConflict as e:
+        # a duplicate of a message the execution has already moved past
+        local.component_logger().warning('stale delayed message', error=str(e))
+
+class EMFMetricsSink(components.MetricsSink):
+    """Writes metrics as CloudWatch embedded metric format log lines, which CloudWatch
+    turns into metrics with no API calls from the Lambda. Observations are buffered,
+    grouped by dimensions, until flush() is called at the end of the handler;
+    counters are summed, and histogram values are sent as arrays of up to 100 values.
+    The namespace defaults to the HEAVISIDE_METRICS_NAMESPACE environment variable."""
+    ENV_NAMESPACE = 'HEAVISIDE_METRICS_NAMESPACE'
+    DEFAULT_NAMESPACE = 'heaviside'
+    
+    MAX_VALUES = 100
+    MAX_METRICS = 100
+    
+    def __init__(self, namespace=None, writer=None, clock=None):
+        self.namespace = namespace or os.environ.get(self.ENV_NAMESPACE) or self.DEFAULT_NAMESPACE
+        self.writer = writer or self._write
+        self.clock = clock or time.time
+        
+        self._counters = collections.defaultdict(collections.Counter)
+        self._values = collections.defaultdict(lambda: collections.defaultdict(list))
+        self._units = {}
+        self._lock = threading.Lock()
+    
+    @classmethod
+    def _write(cls, line):
+        print line
+    
+    @classmethod
+    def _key(cls, dimensions):
+        return tuple(sorted(dimensions.iteritems())) if dimensions else ()
+    
+    def increment(self, name, value=1, dimensions=None):
+        with self._lock:
+            self._counters[self._key(dimensions)][name] += value
+            self._units[name] = self.UNIT_COUNT
+    
+    def observe(self, name, value, unit=components.MetricsSink.UNIT_MILLISECONDS, dimensions=None):
+        with self._lock:
+            self._values[self._key(dimensions)][name].append(value)
+            self._units[name] = unit
+    
+    def flush(self):
+        with self._lock:
+            counters, self._counters = self._counters, collections.defaultdict(collections.Counter)
+            values, self._values = self._values, collections.defaultdict(lambda: collections.defaultdict(list))
+            units = dict(self._units)
+        
+        timestamp = int(self.clock() * 1000)
+        for key in set(counters) | set(values):
+            metrics = dict(counters.get(key, {}))
+            for name, observed in values.get(key, {}).iteritems():
+                metrics[name] = observed
+            for line in self._documents(timestamp, dict(key), metrics, units):
+                self.writer(line)
+    
+    def _documents(self, timestamp, dimensions, metrics, units):
+        names = sorted(metrics)
+        for start in xrange(0, len(names), self.MAX_METRICS):
+            chunk = names[start:start + self.MAX_METRICS]
+            # split long value arrays across documents, MAX_VALUES at a time
+            offset = 0
+            while True:
+                document = dict(dimensions)
+                definitions = []
+                for name in chunk:
+                    value = metrics[name]
+                    if isinstance(value, list):
+                        value = value[offset:offset + self.MAX_VALUES]
+                        if not value:
+                            continue
+                    elif offset:
+                        continue
+                    document[name] = value
+                    definitions.append({"Name": name, "Unit": units.get(name, self.UNIT_COUNT)})
+                if not definitions:
+                    break
+                document["_aws"] = {
+                    "Timestamp": timestamp,
+                    "CloudWatchMetrics": [{
+                        "Namespace": self.namespace,
+                        "Dimensions": [sorted(dimensions)],
+                        "Metrics": definitions,
+                    }],
+                }
+                yield json.dumps(document, separators=(',', ':'))
+                offset += self.MAX_VALUES
@@ -0,0 +1,326 @@
+"""
+Bounded caches for parsed state machine definitions: in memory, and on local
+disk (Lambda's /tmp), which outlives the memory cache of a container that is
+recycled but is quicker to read than S3.
+
+Definitions are cached by their content hash, so an entry can only be wrong
+if it was stored under the wrong id; entries are checked against their id
+when they are loaded into the memory cache, and only checked definitions are
+written to disk.
+"""
+
+from __future__ import absolute_import
+
+import collections
+import cPickle
+import errno
+import os
+import re
+import stat
+import tempfile
+import threading
+import time
+
+class DefinitionHashMismatch(ValueError):
+    pass
+
+class DefinitionCache(object):
+    """LRU cache bounded by entry count and by (approximate) serialized size,
+    with an optional time-to-live. Safe to share between definition stores and threads."""
+    
+    DEFAULT_MAX_ENTRIES = 256
+    DEFAULT_MAX_BYTES = 16 * 1024 * 1024
+    
+    ENV_MAX_ENTRIES = 'HEAVISIDE_DEFINITION_CACHE_ENTRIES'
+    ENV_MAX_BYTES = 'HEAVISIDE_DEFINITION_CACHE_BYTES'
+    ENV_TTL_SECONDS = 'HEAVISIDE_DEFINITION_CACHE_TTL'
+    
+    @classmethod
+    def from_environment(cls, environ=None):
+        """Create a cache sized from environment variables, falling back to the defaults."""
+        environ = os.environ if environ is None else environ
+        def get(key, default, type):
+            value = environ.get(key)
+            return type(value) if value else default
+        return cls(
+            max_entries = get(cls.ENV_MAX_ENTRIES, cls.DEFAULT_MAX_ENTRIES, int),
+            max_bytes = get(cls.ENV_MAX_BYTES, cls.DEFAULT_MAX_BYTES, int),
+            ttl_seconds = get(cls.ENV_TTL_SECONDS, None, float),
+        )
+    
+    def __init__(self, max_entries=DEFAULT_MAX_ENTRIES, max_bytes=DEFAULT_MAX_BYTES, ttl_seconds=None, clock=None):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl_seconds = ttl_seconds
+        self.clock = clock or time.time
+        
+        self._entries = collections.OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+    
+    def __len__(self):
+        return len(self._entries)
+    
+    def __contains__(self, definition_id):
+        return definition_id in self._entries
+    
+    @property
+    def size_bytes(self):
+        return self._bytes
+    
+    def get(self, definition_id):
+        with self._lock:
+            entry = self._entries.pop(definition_id, None)
+            if entry is None:
+                self.misses += 1
+                return None
+            definition, size, expires = entry
+            if expires is not None and expires <= self.clock():
+                self._bytes -= size
+                self.expirations += 1
+                self.misses += 1
+                return None
+            self._entries[definition_id] = entry
+            self.hits += 1
+            return definition
+    
+    def put(self, definition_id, definition, size=None, verify=True):
+        """Cache a definition. size is its serialized size in bytes; it is computed if not given.
+        If verify is set, the definition's hash must match definition_id."""
+        if verify and definition.get_hash() != definition_id:
+            raise DefinitionHashMismatch("Definition does not match id {}".format(definition_id))
+        if size is None:
+            size = len(definition.get_canonical_json())
+        if self.max_bytes is not None and size > self.max_bytes:
+            return
+        
+        expires = self.clock() + self.ttl_seconds if self.ttl_seconds is not None else None
+        
+        with self._lock:
+            old = self._entries.pop(definition_id, None)
+            if old is not None:
+                self._bytes -= old[1]
+            self._entries[definition_id] = (definition, size, expires)
+            self._bytes += size
+            self._evict()
+    
+    def _evict(self):
+        while self._entries and (
+                (self.max_entries is not None and len(self._entries) > self.max_entries)
+                or
+                (self.max_bytes is not None and self._bytes > self.max_bytes)):
+            _, (_, size, _) = self._entries.popitem(last=False)
+            self._bytes -= size
+            self.evictions += 1
+    
+    def discard(self, definition_id):
+        with self._lock:
+            entry = self._entries.pop(definition_id, None)
+            if entry is not None:
+                self._bytes -= entry[1]
+    
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+    
+    def stats(self):
+        return {
+            "entries": len(self._entries),
+            "bytes": self._bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+        }
+
+class DiskDefinitionCache(object):
+    """Parsed definitions pickled to a directory, one file per definition id.
+    Files are written to a temporary name and renamed into place, so readers,
+    including other processes, never see a partial file, and concurrent writers
+    of the same id write the same content. The directory is bounded by size,
+    evicting the least recently read files.
+
+    Only the parsed definitions are stored; they are compiled again when loaded.
+    The directory is created private to the user, as loading a file runs it, and
+    an existing directory is only used if it is owned by the user and no one
+    else can write to it; otherwise the cache stays disabled."""
+    
+    DEFAULT_DIRECTORY = os.path.join(tempfile.gettempdir(), 'heaviside-definitions')
+    DEFAULT_MAX_BYTES = 64 * 1024 * 1024
+    
+    ENV_DIRECTORY = 'HEAVISIDE_DEFINITION_DISK_CACHE'
+    ENV_MAX_BYTES = 'HEAVISIDE_DEFINITION_DISK_CACHE_BYTES'
+    
+    SUFFIX = '.pickle'
+    
+    _ID = re.compile(r'^[0-9a-f]+$')
+    
+    @classmethod
+    def from_environment(cls, environ=None):
+        """Create a cache in HEAVISIDE_DEFINITION_DISK_CACHE, or the default directory
+        if it isn't set. Return None if it is set but empty, disabling the disk cache."""
+        environ = os.environ if environ is None else environ
+        directory = environ.get(cls.ENV_DIRECTORY, cls.DEFAULT_DIRECTORY)
+        if not directory:
+            return None
+        max_bytes = environ.get(cls.ENV_MAX_BYTES)
+        return cls(directory, max_bytes=int(max_bytes) if max_bytes else cls.DEFAULT_MAX_BYTES)
+    
+    def __init__(self, directory=DEFAULT_DIRECTORY, max_bytes=DEFAULT_MAX_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        
+        self._lock = threading.Lock()
+        # whether the directory is safe to load from, once it has been checked
+        self._trusted = None
+        
+        self.hits = 0
+        self.misses = 0
+        self.writes = 0
+        self.evictions = 0
+        self.errors = 0
+    
+    def _path(self, definition_id):
+        if not self._ID.match(definition_id):
+            raise ValueError("Invalid definition id {!r}".format(definition_id))
+        return os.path.join(self.directory, definition_id + self.SUFFIX)
+    
+    def get(self, definition_id):
+        path = self._path(definition_id)
+        if not self._is_trusted():
+            self.misses += 1
+            return None
+        try:
+            with open(path, 'rb') as fp:
+                definition = cPickle.load(fp)
+        except IOError as e:
+            if e.errno != errno.ENOENT:
+                self.errors += 1
+            self.misses += 1
+            return None
+        except Exception:
+            # a file from another version of the code, or damaged; it's rewritten on the next put
+            self.errors += 1
+            self.misses += 1
+            self._remove(path)
+            return None
+        try:
+            os.utime(path, None)
+        except OSError:
+            pass
+        self.hits += 1
+        return definition
+    
+    def put(self, definition_id, definition):
+        """Write a definition, unless it's already on disk. The definition must match definition_id."""
+        path = self._path(definition_id)
+        if os.path.exists(path):
+            return
+        body = cPickle.dumps(definition, cPickle.HIGHEST_PROTOCOL)
+        if self.max_bytes is not None and len(body) > self.max_bytes:
+            return
+        try:
+            self._ensure_directory()
+            if not self._is_trusted():
+                return
+            fd, temp_path = tempfile.mkstemp(prefix='.', suffix='.tmp', dir=self.directory)
+            try:
+                with os.fdopen(fd, 'wb') as fp:
+                    fp.write(body)
+                os.rename(temp_path, path)
+            except Exception:
+                self._remove(temp_path)
+                raise
+        except (IOError, OSError):
+            # a full or read-only disk only costs the next cold start a fetch
+            self.errors += 1
+            return
+        self.writes += 1
+        self._evict()
+    
+    def _ensure_directory(self):
+        try:
+            os.makedirs(self.directory, 0o700)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+    
+    def _is_trusted(self):
+        """Check that the directory is a directory, not a link, owned by this user
+        and not writable by group or others, so no one else can plant a pickle in it.
+        A directory that doesn't exist yet isn't trusted until it has been created."""
+        if self._trusted is not None:
+            return self._trusted
+        try:
+            st = os.lstat(self.directory)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                self.errors += 1
+            return False
+        self._trusted = (stat.S_ISDIR(st.st_mode)
+                         and (not hasattr(os, 'getuid') or st.st_uid == os.getuid())
+                         and st.st_mode & 0o022 == 0)
+        if not self._trusted:
+            self.errors += 1
+        return self._trusted
+    
+    def _remove(self, path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+    
+    def _files(self):
+        """(mtime, size, path) of each file in the directory, including abandoned temporary files."""
+        files = []
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            files.append((stat.st_mtime, stat.st_size, path))
+        return files
+    
+    def _evict(self):
+        if self.max_bytes is None:
+            return
+        with self._lock:
+            files = self._files()
+            total = sum(size for _, size, _ in files)
+            files.sort()
+            while files and total > self.max_bytes:
+                _, size, path = files.pop(0)
+                self._remove(path)
+                total -= size
+                self.evictions += 1
+    
+    def size_bytes(self):
+        try:
+            return sum(size for _, size, _ in self._files())
+        except OSError:
+            return 0
+    
+    def clear(self):
+        try:
+            files = self._files()
+        except OSError:
+            return
+        for _, _, path in files:
+            self._remove(path)
+    
+    def stats(self):
+        return {
+            "directory": self.directory,
+            "hits": self.hits,
+            "misses": self.misses,
+            "writes": self.writes,
+            "evictions": self.evictions,
+            "errors": self.errors,
+        }
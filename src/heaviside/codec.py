@@ -0,0 +1,154 @@
+"""
+Codecs for carrying the executor context in a Lambda ClientContext.
+
+The ClientContext is base64-encoded JSON limited to about 3KB, and the executor
+context is sent on every hop. The compact codec replaces the long context keys
+with short tags, serializes without whitespace, deflates the result when that
+makes it smaller, and sends it as a single versioned binary field. Decoding
+looks at the version, so any registered codec can be read regardless of which
+one the sender was configured with.
+"""
+
+from __future__ import absolute_import
+
+import base64
+import json
+import os
+import zlib
+
+CLIENT_CONTEXT_LIMIT = 3583
+
+ENCODED_CONTEXT_KEY = 'x-hs'
+
+ENV_CODEC = 'HEAVISIDE_CONTEXT_CODEC'
+
+_TAGS = {
+    'x-heaviside-sm-eid': 'e',
+    'x-heaviside-sm-cstate': 's',
+    'x-heaviside-sm-def': 'd',
+    'x-heaviside-sm-bucket': 'b',
+    'x-heaviside-log-seq': 'l',
+    'x-heaviside-sm-frames': 'f',
+    'x-heaviside-sm-deadline': 't',
+    'x-heaviside-sm-tdeadline': 'u',
+    'x-heaviside-sm-iref': 'i',
+    'x-heaviside-sm-version': 'v',
+}
+_KEYS = dict((tag, key) for key, tag in _TAGS.iteritems())
+
+def register_tag(key, tag):
+    """Register a short tag for a context key. Keys without a tag are sent as-is."""
+    if _TAGS.get(key, tag) != tag or _KEYS.get(tag, key) != key:
+        raise ValueError("Tag {} for {} conflicts with an existing tag".format(tag, key))
+    _TAGS[key] = tag
+    _KEYS[tag] = key
+
+def encode_client_context(custom):
+    return base64.b64encode(json.dumps({"custom": custom}, separators=(',', ':')))
+
+class ContextCodec(object):
+    NAME = None
+    VERSION = None
+    
+    def encode(self, context):
+        """Return the ClientContext custom dict for a context."""
+        raise NotImplementedError
+    
+    def decode(self, custom):
+        raise NotImplementedError
+    
+    def client_context(self, context):
+        """Return the base64-encoded ClientContext for a context."""
+        return encode_client_context(self.encode(context))
+    
+    def encoded_size(self, context):
+        return len(self.client_context(context))
+
+class JSONContextCodec(ContextCodec):
+    """The original format: the context dict is the custom dict."""
+    NAME = 'json'
+    VERSION = 0
+    
+    def encode(self, context):
+        return context
+    
+    def decode(self, custom):
+        return custom
+
+class CompactContextCodec(ContextCodec):
+    NAME = 'compact'
+    VERSION = 1
+    
+    FLAG_DEFLATED = 0x01
+    
+    def __init__(self, compress=True, compression_level=9):
+        self.compress = compress
+        self.compression_level = compression_level
+    
+    def encode(self, context):
+        tagged = dict((_TAGS.get(key, key), value) for key, value in context.iteritems())
+        payload = json.dumps(tagged, separators=(',', ':'))
+        flags = 0
+        if self.compress:
+            deflated = zlib.compress(payload, self.compression_level)[2:-4]
+            if len(deflated) < len(payload):
+                payload = deflated
+                flags |= self.FLAG_DEFLATED
+        data = chr(self.VERSION) + chr(flags) + payload
+        return {ENCODED_CONTEXT_KEY: base64.b64encode(data)}
+    
+    def decode(self, custom):
+        data = base64.b64decode(custom[ENCODED_CONTEXT_KEY])
+        version, flags, payload = ord(data[0]), ord(data[1]), data[2:]
+        if version != self.VERSION:
+            raise ValueError("Cannot decode context version {}".format(version))
+        if flags & self.FLAG_DEFLATED:
+            payload = zlib.decompress(payload, -zlib.MAX_WBITS)
+        tagged = json.loads(payload)
+        return dict((_KEYS.get(tag, tag), value) for tag, value in tagged.iteritems())
+
+_CODECS_BY_NAME = {}
+_CODECS_BY_VERSION = {}
+
+def register_codec(codec):
+    _CODECS_BY_NAME[codec.NAME] = codec
+    _CODECS_BY_VERSION[codec.VERSION] = codec
+
+register_codec(JSONContextCodec())
+register_codec(CompactContextCodec())
+
+def get_codec(name=None):
+    """Get a codec by name, defaulting to the one named by HEAVISIDE_CONTEXT_CODEC, or the compact codec."""
+    name = name or os.environ.get(ENV_CODEC) or CompactContextCodec.NAME
+    try:
+        return _CODECS_BY_NAME[name]
+    except KeyError:
+        raise ValueError("Unknown context codec {}".format(name))
+
+def decode_context(custom):
+    """Decode a ClientContext custom dict written by any registered codec."""
+    if ENCODED_CONTEXT_KEY not in custom:
+        return _CODECS_BY_VERSION[JSONContextCodec.VERSION].decode(custom)
+    version = ord(base64.b64decode(custom[ENCODED_CONTEXT_KEY][:4])[0])
+    try:
+        codec = _CODECS_BY_VERSION[version]
+    except KeyError:
+        raise ValueError("Unknown context codec version {}".format(version))
+    return codec.decode(custom)
+
+PAYLOAD_INPUT_KEY = 'x-hs-input'
+PAYLOAD_CONTEXT_KEY = 'x-hs-context'
+
+def wrap_payload(input, custom):
+    """Put the encoded context in the invocation payload alongside the input.
+    Lambda drops the ClientContext on asynchronous (Event) invocations."""
+    return {
+        PAYLOAD_INPUT_KEY: input,
+        PAYLOAD_CONTEXT_KEY: custom,
+    }
+
+def unwrap_payload(event):
+    """Return the input and the encoded context (or None) from an invocation payload."""
+    if isinstance(event, dict) and PAYLOAD_CONTEXT_KEY in event:
+        return event.get(PAYLOAD_INPUT_KEY), event[PAYLOAD_CONTEXT_KEY]
+    return event, None
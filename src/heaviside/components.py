@@ -6,21 +6,56 @@ Created on Oct 29, 2017
 
 from __future__ import absolute_import
 
+import hashlib
+import itertools
+import json
+import os
+import tempfile
+import time
+import zlib
+
 class State(object):
     @classmethod
-    def from_json(cls, obj):
-        return cls(obj['Name'], data=obj.get('Data'))
+    def from_json(cls, obj, data_loader=None):
+        return cls(obj['Name'], data=obj.get('Data'), data_ref=obj.get('DataRef'), data_loader=data_loader,
+                   retries=obj.get('Retries'))
     
-    def __init__(self, name, data=None):
+    def __init__(self, name, data=None, data_ref=None, data_loader=None, retries=None):
+        """If data_ref is given, the data is stored elsewhere and is only
+        fetched with data_loader when it is first read. retries counts the
+        attempts made so far by each of the state's retriers."""
         self.name = name
-        self.data = data
+        self.retries = retries
+        self._data = data
+        self.data_ref = data_ref
+        self._data_loader = data_loader
+        self._data_loaded = data_ref is None
+    
+    @property
+    def data(self):
+        if not self._data_loaded:
+            if self._data_loader is None:
+                raise ValueError("No loader for state data {}".format(self.data_ref))
+            self._data = self._data_loader(self.data_ref)
+            self._data_loaded = True
+        return self._data
+    
+    @data.setter
+    def data(self, data):
+        self._data = data
+        self.data_ref = None
+        self._data_loaded = True
     
     def to_json(self):
         obj = {
             'Name': self.name
         }
-        if self.data is not None:
-            obj['Data'] = self.data
+        if self.data_ref is not None:
+            obj['DataRef'] = self.data_ref
+        elif self._data is not None:
+            obj['Data'] = self._data
+        if self.retries:
+            obj['Retries'] = self.retries
         return obj
 
 class Result(object):
@@ -31,11 +66,13 @@ class Result(object):
     
     @classmethod
     def from_json(cls, obj):
-        return cls(obj["Status"], obj.get("Output"))
+        return cls(obj["Status"], obj.get("Output"), error=obj.get("Error"), cause=obj.get("Cause"))
     
-    def __init__(self, status, output=None):
+    def __init__(self, status, output=None, error=None, cause=None):
         self.status = status
         self.output = output
+        self.error = error
+        self.cause = cause
     
     def to_json(self):
         obj = {
@@ -43,8 +80,112 @@ class Result(object):
         }
         if self.output is not None:
             obj["Output"] = self.output
+        if self.error is not None:
+            obj["Error"] = self.error
+        if self.cause is not None:
+            obj["Cause"] = self.cause
         return obj
 
+class BlobStore(object):
+    """Storage for values too large to carry in the client context."""
+    def put(self, key, body):
+        """Store the body and return a reference to it."""
+        raise NotImplementedError
+    
+    def put_file(self, key, fileobj):
+        """Store the contents of a file object, read from its current position."""
+        return self.put(key, fileobj.read())
+    
+    def get(self, ref):
+        raise NotImplementedError
+
+class DataRef(object):
+    """State data kept in a blob store, passed on instead of the data itself."""
+    def __init__(self, ref):
+        self.ref = ref
+
+class StateDataOverflow(object):
+    """Moves state data above a size threshold out of the context and into a
+    blob store (a claim check), leaving only a reference that is resolved when
+    the data is read. Without a blob store, data is always carried inline."""
+    DEFAULT_THRESHOLD = 1536
+    
+    def __init__(self, blob_store=None, threshold=DEFAULT_THRESHOLD, metrics=None):
+        self.blob_store = blob_store
+        self.threshold = threshold
+        self.metrics = metrics or NULL_METRICS
+    
+    def state_to_json(self, execution_id, state):
+        obj = state.to_json()
+        if 'Data' not in obj:
+            return obj
+        ref = self.put_data(execution_id, obj['Data'])
+        if ref is None:
+            return obj
+        # keeps the loaded data, so serializing the state again doesn't re-upload it
+        state.data_ref = ref
+        return state.to_json()
+    
+    def state_from_json(self, obj):
+        return State.from_json(obj, data_loader=self.load_data)
+    
+    def put_data(self, owner, data):
+        """Store data above the threshold in the blob store, under the owner (an
+        execution id) and its hash, and return the reference. Return None for
+        data that is carried inline."""
+        if self.blob_store is None:
+            return None
+        body = json.dumps(data, separators=(',', ':'))
+        if len(body) <= self.threshold:
+            return None
+        key = '{}/{}'.format(owner, hashlib.sha256(body).hexdigest())
+        ref = self.blob_store.put(key, body)
+        if self.metrics.enabled:
+            self.metrics.increment('StateDataOverflows')
+            self.metrics.observe('StateDataOverflowBytes', len(body), unit=MetricsSink.UNIT_BYTES)
+        return ref
+    
+    # data written to a blob store is buffered in memory up to this size, then in a temporary file
+    SPOOL_BYTES = 1024 * 1024
+    
+    def put_items(self, owner, items):
+        """Return the items as a list if it is under the threshold or there is no
+        blob store. Otherwise write them to the blob store as a JSON array as they
+        are produced, without holding them all, and return a DataRef."""
+        items = iter(items)
+        if self.blob_store is None:
+            return list(items)
+        inline = []
+        encoded = []
+        size = 2
+        for item in items:
+            inline.append(item)
+            encoded.append(json.dumps(item, separators=(',', ':')))
+            size += len(encoded[-1]) + 1
+            if size > self.threshold:
+                break
+        else:
+            return inline
+        
+        digest = hashlib.sha256()
+        size = 0
+        with tempfile.SpooledTemporaryFile(self.SPOOL_BYTES) as body:
+            for chunk in itertools.chain(['[', ','.join(encoded)],
+                                         (',' + json.dumps(item, separators=(',', ':')) for item in items),
+                                         [']']):
+                digest.update(chunk)
+                body.write(chunk)
+                size += len(chunk)
+            body.seek(0)
+            ref = self.blob_store.put_file('{}/{}'.format(owner, digest.hexdigest()), body)
+        if self.metrics.enabled:
+            self.metrics.increment('StateDataOverflows')
+            self.metrics.observe('StateDataOverflowBytes', size, unit=MetricsSink.UNIT_BYTES)
+        return DataRef(ref)
+    
+    def load_data(self, ref):
+        return json.loads(self.blob_store.get(ref))
+
 class ExecutorComponent(object):
     def get_context(self):
         raise NotImplementedError
@@ -59,6 +200,11 @@ class DefinitionStore(ExecutorComponent):
     def hydrate_definition(self, definition_id):
         raise NotImplementedError
 
+class ExecutionConflict(RuntimeError):
+    """The execution was changed by another executor since it was read, for
+    example by a duplicate delivery of the same task."""
+    pass
+
 class Execution(ExecutorComponent):
     CONTEXT_CURRENT_STATE_KEY = 'x-heaviside-sm-cstate'
     CONTEXT_DEFINITION_ID_KEY = 'x-heaviside-sm-def'
@@ -67,18 +213,38 @@ class Execution(ExecutorComponent):
         self.execution_id = execution_id
         self.definition_store = definition_store
     
-    def initialize(self, definition, execution_store):
+    def initialize(self, definition):
         raise NotImplementedError
     
+    def attach(self, definition):
+        """Set up an existing execution whose context isn't at hand, like the
+        owner of a fan-in being continued by its last branch."""
+        self.initialize(definition)
+    
+    def flush(self):
+        """Write the changes made since the last flush. The executor flushes
+        before it hands the execution on (dispatches, schedules or finishes),
+        so stores can coalesce each hop's changes into one write.
+        Raises ExecutionConflict if the execution was changed elsewhere."""
+        pass
+    
+    def delete(self):
+        """Remove a finished branch execution, whose result has been recorded in
+        its fan-in, from stores that keep executions."""
+        pass
+    
     def get_definition(self):
         raise NotImplementedError
     
-    def change_state(self, new_state_name):
+    def change_state(self, new_state_name, data=None):
         raise NotImplementedError
     
     def update_state_data(self, data):
         raise NotImplementedError
     
+    def update_state_retries(self, retries):
+        raise NotImplementedError
+    
     def get_current_state_and_result(self):
         raise NotImplementedError
     
@@ -90,6 +256,32 @@ class ExecutionStore(object):
         raise NotImplementedError
 
 class Logger(ExecutorComponent):
+    """Leveled, structured tracing on top of log().
+    
+    Messages are format strings whose arguments, and any keyword fields, are
+    only evaluated when the message is going to be logged; callable arguments
+    are called then, so expensive values can be passed as lambdas. A disabled
+    message costs one comparison. Records are logged as JSON lines.
+    """
+    DEBUG = 10
+    INFO = 20
+    WARNING = 30
+    ERROR = 40
+    OFF = 100
+    
+    LEVELS = {
+        'DEBUG': DEBUG,
+        'INFO': INFO,
+        'WARNING': WARNING,
+        'ERROR': ERROR,
+        'OFF': OFF,
+    }
+    LEVEL_NAMES = dict((level, name) for name, level in LEVELS.iteritems())
+    
+    level = INFO
+    execution_id = None
+    executor_id = None
+    
     def format(self, execution_id, executor_id, resource, state_name, message):
         return '[{}:{}] {} {}'.format(executor_id[-4:], resource, state_name, message)
     
@@ -98,12 +290,202 @@ class Logger(ExecutorComponent):
     
     def initialize(self):
         raise NotImplementedError
+    
+    def flush(self):
+        """Send any buffered messages. Called at the end of each hop."""
+        pass
+    
+    def is_enabled(self, level):
+        return level >= self.level
+    
+    def trace(self, level, message, *args, **fields):
+        if level < self.level:
+            return
+        self.log(self.format_record(level, message, args, fields))
+    
+    def debug(self, message, *args, **fields):
+        if self.DEBUG >= self.level:
+            self.log(self.format_record(self.DEBUG, message, args, fields))
+    
+    def info(self, message, *args, **fields):
+        if self.INFO >= self.level:
+            self.log(self.format_record(self.INFO, message, args, fields))
+    
+    def warning(self, message, *args, **fields):
+        if self.WARNING >= self.level:
+            self.log(self.format_record(self.WARNING, message, args, fields))
+    
+    def error(self, message, *args, **fields):
+        if self.ERROR >= self.level:
+            self.log(self.format_record(self.ERROR, message, args, fields))
+    
+    def format_record(self, level, message, args, fields):
+        if args:
+            message = message.format(*[arg() if callable(arg) else arg for arg in args])
+        record = {
+            "level": self.LEVEL_NAMES.get(level, level),
+            "message": message,
+        }
+        if self.execution_id is not None:
+            record["execution"] = self.execution_id
+        if self.executor_id is not None:
+            record["executor"] = self.executor_id[-4:]
+        for key, value in fields.iteritems():
+            record[key] = value() if callable(value) else value
+        return json.dumps(record, default=repr)
 
 class LoggerFactory(object):
+    """Creates loggers for executors. The level and sample rate default to the
+    HEAVISIDE_TRACE_LEVEL and HEAVISIDE_TRACE_SAMPLE_RATE environment variables.
+    Sampling is decided per execution id, so every executor of a sampled
+    execution traces, and executions that aren't sampled only log errors."""
+    ENV_LEVEL = 'HEAVISIDE_TRACE_LEVEL'
+    ENV_SAMPLE_RATE = 'HEAVISIDE_TRACE_SAMPLE_RATE'
+    
+    def __init__(self, level=None, sample_rate=None):
+        if level is None:
+            level = os.environ.get(self.ENV_LEVEL) or Logger.INFO
+        if isinstance(level, basestring):
+            level = Logger.LEVELS[level.upper()]
+        self.level = level
+        if sample_rate is None:
+            sample_rate = float(os.environ.get(self.ENV_SAMPLE_RATE) or 1)
+        self.sample_rate = sample_rate
+    
+    def get_level(self, execution_id):
+        if self.sample_rate >= 1 or execution_id is None:
+            return self.level
+        if (zlib.crc32(execution_id) & 0xffffffff) < self.sample_rate * 0x100000000:
+            return self.level
+        return max(self.level, Logger.ERROR)
+    
     def logger_factory(self, execution_id, executor_id):
         raise NotImplementedError
 
+class FanInStore(object):
+    """Collects the outputs of the branches of a fan-out state, so that the last
+    branch to finish can collate them and continue the execution.
+    Fan-ins are identified by the id of the execution that owns the fan-out
+    state and a fan-in id unique to that visit of the state."""
+    def create_fan_in(self, owner_id, fan_in_id, count, pending_inputs=None, owner_input=None):
+        """Create a fan-in for count branches. If pending_inputs is given, the
+        last len(pending_inputs) branches are not started yet; their inputs are
+        stored to be handed out one at a time by claim_pending. If owner_input
+        is given, it is the fan-out state's input, kept for building its output."""
+        raise NotImplementedError
+    
+    def claim_pending(self, owner_id, fan_in_id):
+        """Atomically take the next unstarted branch, returning (index, input),
+        or None if every branch has been started or the fan-in has failed."""
+        raise NotImplementedError
+    
+    def record_output(self, owner_id, fan_in_id, index, output):
+        """Record a branch's output and atomically decrement the number of branches remaining.
+        Returns the number remaining, so the branch that gets 0 is the last one.
+        Returns None if the fan-in has failed or been deleted, or this branch was already recorded."""
+        raise NotImplementedError
+    
+    def record_failure(self, owner_id, fan_in_id, index, error):
+        """Mark the fan-in as failed. Returns True only for the first failure of a
+        fan-in that hasn't been deleted, whose branch is then responsible for
+        failing the fan-out state."""
+        raise NotImplementedError
+    
+    def iter_outputs(self, owner_id, fan_in_id):
+        """Yield the recorded outputs in branch order."""
+        raise NotImplementedError
+    
+    # results above this size are collected into the blob store of stores given one
+    OUTPUT_THRESHOLD = 64 * 1024
+    # a StateDataOverflow, for stores given a blob store
+    overflow = None
+    
+    def collect_outputs(self, owner_id, fan_in_id, collate):
+        """Return the result of the fan-out state, collate (a function from an
+        iterator of the outputs to an iterator of result items) applied to the
+        outputs. A large result is streamed into the blob store and returned as a
+        DataRef, so the executor collecting it never holds all the outputs."""
+        items = collate(self.iter_outputs(owner_id, fan_in_id))
+        if self.overflow is None:
+            return list(items)
+        return self.overflow.put_items(owner_id, items)
+    
+    def load_data(self, data_ref):
+        """Return the data of a DataRef returned by collect_outputs."""
+        return self.overflow.load_data(data_ref.ref)
+    
+    def get_owner_input(self, owner_id, fan_in_id):
+        """Return the owner_input the fan-in was created with, or None."""
+        raise NotImplementedError
+    
+    def delete_fan_in(self, owner_id, fan_in_id):
+        raise NotImplementedError
+
+class MetricsSink(object):
+    """Receives counters and histogram observations from the executor and its components.
+    Dimensions should take few distinct values (state names, resources, operations)
+    so that metrics can be aggregated across executions. Components check enabled
+    before timing anything, so a disabled sink costs nothing on the hot path."""
+    UNIT_COUNT = 'Count'
+    UNIT_MILLISECONDS = 'Milliseconds'
+    UNIT_BYTES = 'Bytes'
+    
+    enabled = True
+    
+    def increment(self, name, value=1, dimensions=None):
+        raise NotImplementedError
+    
+    def observe(self, name, value, unit=UNIT_MILLISECONDS, dimensions=None):
+        raise NotImplementedError
+    
+    def flush(self):
+        """Send any buffered metrics. Called at the end of each hop."""
+        pass
+
+class NullMetricsSink(MetricsSink):
+    enabled = False
+    
+    def increment(self, name, value=1, dimensions=None):
+        pass
+    
+    def observe(self, name, value, unit=MetricsSink.UNIT_MILLISECONDS, dimensions=None):
+        pass
+
+NULL_METRICS = NullMetricsSink()
+
 class TaskDispatcher(object):
+    def time(self):
+        """The dispatcher's clock, which Timestamp waits are measured against."""
+        return time.time()
+    
+    def can_schedule(self):
+        """Whether dispatch_later and resume_later can schedule work, which Retry
+        fields and Wait states need."""
+        return False
+    
     def dispatch(self, resource, input, context):
         raise NotImplementedError
+    
+    def dispatch_later(self, resource, input, context, delay):
+        """Dispatch after delay seconds, for retries. Nothing waits in the meantime."""
+        raise NotImplementedError
+    
+    def resume_later(self, input, context, delay):
+        """After delay seconds, continue the execution in the context, which is
+        in a Wait state, past that state with the given output (Executor.resume).
+        Nothing waits in the meantime."""
+        raise NotImplementedError
+    
+    def dispatch_many(self, dispatches):
+        """Dispatch (resource, input, context) tuples, for fan-out states.
+        Returns the exception raised for each dispatch, or None if it succeeded."""
+        errors = []
+        for resource, input, context in dispatches:
+            try:
+                self.dispatch(resource, input, context)
+            except Exception as e:
+                errors.append(e)
+            else:
+                errors.append(None)
+        return errors
 
@@ -6,36 +6,148 @@ Created on Oct 28, 2017
 
 from __future__ import absolute_import
 
-from . import executor, aws
+import os
 
-def handler(handler_function):
+# executor and aws (and so boto3) are imported only once a heaviside context
+# is seen, so plain invocations and cold starts don't pay for them
+from . import codec
+
+_TASKS = {}
+
+def register_task(resource, function):
+    """Register a Lambda handler, taking (event, context), as able to run the
+    given resource in this process, so that with task fusion it can be run
+    inline instead of invoked. resource is a function name or ARN."""
+    _TASKS[resource] = function
+
+def find_task(resource, tasks=None):
+    """Return the handler registered for a resource, or None.
+    An unqualified (or $LATEST) function ARN also matches its function name."""
+    tasks = _TASKS if tasks is None else tasks
+    task = tasks.get(resource)
+    if task is None and resource.startswith('arn:') and ':function:' in resource:
+        parts = resource.split(':function:', 1)[1].split(':')
+        if len(parts) == 1 or parts[1] == '$LATEST':
+            task = tasks.get(parts[0])
+    return task
+
+def handler(handler_function=None, cache_components=True, resources=None, fusion=None):
     """Decorator to wrap a Lambda handler to enable execution as a state machine.
     Use like:
     @heaviside.handler
     def handler(event, context):
         #proceed as normal
+    
+    The AWS components are built on the first heaviside invocation and reused
+    while the container is warm. To build them on every invocation (e.g., in tests), use:
+    @heaviside.handler(cache_components=False)
+    
+    Task fusion runs following Tasks in this invocation instead of invoking them,
+    when they are for this function, or for a handler registered with
+    register_task or by listing the resources it runs:
+    @heaviside.handler(resources=['other-function'])
+    It is on when fusion is True or HEAVISIDE_FUSION_MAX_STEPS is set; fusion
+    can also be a dict of TaskFusion arguments.
     """
+    if handler_function is None:
+        return lambda handler_function: handler(handler_function,
+                                                cache_components=cache_components,
+                                                resources=resources,
+                                                fusion=fusion)
+    
+    for resource in resources or []:
+        register_task(resource, handler_function)
+    
     def wrapper(event, context):
-        if not (context.client_context
+        event, custom = codec.unwrap_payload(event)
+        
+        if (custom is None
                 and
-                hasattr(context.client_context, 'custom')
+                context.client_context
                 and
-                isinstance(context.client_context.custom, dict)
+                hasattr(context.client_context, 'custom')
                 and
-                executor.is_heaviside_execution(context.client_context.custom)):
+                isinstance(context.client_context.custom, dict)):
+            custom = context.client_context.custom
+        
+        if custom is None:
             return handler_function(event, context)
         
-        heaviside_context = context.client_context.custom
+        heaviside_context = codec.decode_context(custom)
         
-        print heaviside_context
+        from . import executor
         
-        ex = executor.Executor.hydrate(heaviside_context, **aws.create_components())
+        if not executor.is_heaviside_execution(heaviside_context):
+            return handler_function(event, context)
+        
+        from . import aws, local
+        
+        local.component_logger().debug('heaviside context', context=heaviside_context)
+        
+        if cache_components:
+            comps = aws.get_components()
+        else:
+            comps = aws.create_components()
+        
+        from .components import ExecutionConflict
         
-        task_runner = lambda: handler_function(event, context)
         exception_handler = lambda e: 'States.TaskFailed'
         
-        return ex.run_task(task_runner, exception_handler)
+        try:
+            ex = executor.Executor.hydrate(heaviside_context, **comps)
+            try:
+                task_input = ex.task_input(event)
+                task_runner = lambda: handler_function(task_input, context)
+                return ex.run_task(task_runner, exception_handler,
+                                   fusion=_create_fusion(executor, fusion, handler_function, context),
+                                   task_input=task_input,
+                                   remaining_time=_remaining_time(context))
+            finally:
+                ex.logger.flush()
+                ex.metrics.flush()
+        except ExecutionConflict as e:
+            # a duplicate delivery of a dispatch the execution has moved past, refused when
+            # it is hydrated, or when it writes the execution after running the task;
+            # failing would have Lambda retry it and run the task again
+            local.component_logger().warning('stale dispatch', error=str(e))
+            return None
 
     wrapper.__name__ = handler_function.__name__
     return wrapper
 
+def _remaining_time(context):
+    if not hasattr(context, 'get_remaining_time_in_millis'):
+        return None
+    return lambda: context.get_remaining_time_in_millis() / 1000.
+
+def _create_fusion(executor, fusion, handler_function, context):
+    if fusion is None:
+        max_steps = os.environ.get(executor.TaskFusion.ENV_MAX_STEPS)
+        if not max_steps:
+            return None
+        max_seconds = os.environ.get(executor.TaskFusion.ENV_MAX_SECONDS)
+        fusion = {
+            "max_steps": int(max_steps),
+            "max_seconds": float(max_seconds) if max_seconds else None,
+        }
+    elif fusion is False:
+        return None
+    elif fusion is True:
+        fusion = {}
+    
+    own_tasks = {}
+    for resource in (getattr(context, 'function_name', None), getattr(context, 'invoked_function_arn', None)):
+        if resource:
+            own_tasks[resource] = handler_function
+    
+    def find_fusable_task(resource):
+        task = find_task(resource, own_tasks) or find_task(resource)
+        if task is None:
+            return None
+        return lambda input: task(input, context)
+    
+    kwargs = dict(fusion)
+    if _remaining_time(context) is not None:
+        kwargs.setdefault("remaining_time", _remaining_time(context))
+    return executor.TaskFusion(find_fusable_task, **kwargs)
+
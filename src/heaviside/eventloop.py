@@ -0,0 +1,209 @@
+"""
+Single-threaded event loop for running many executions concurrently in one process.
+
+Dispatching a task schedules its hop as a callback on the loop instead of
+running it on a thread, so thousands of executions interleave on one thread,
+in a deterministic order. Task latency can be simulated per resource; with the
+default virtual clock, the loop jumps straight to the next due callback
+instead of sleeping, so simulated waits (including retry delays) cost nothing.
+
+Out of scope: non-blocking (callback or future based) variants of
+DefinitionStore, Execution, TaskDispatcher and Logger, which would let the I/O
+within a hop overlap. The Executor calls its components as straight-line code,
+and would have to be rewritten in continuation-passing style, without asyncio
+on Python 2.7, to use them; on Lambda, where each invocation runs one hop,
+nothing would be gained. Only dispatch goes through the loop here, so hops of
+different executions interleave, but each runs to completion once started.
+"""
+
+from __future__ import absolute_import
+
+import collections
+import heapq
+import itertools
+import time
+import traceback
+
+from . import local
+
+class TimerHandle(object):
+    def __init__(self, when, callback, args):
+        self.when = when
+        self.callback = callback
+        self.args = args
+        self.cancelled = False
+    
+    def cancel(self):
+        self.cancelled = True
+
+class EventLoop(object):
+    def __init__(self, virtual_time=True, start_time=None):
+        self.virtual_time = virtual_time
+        if virtual_time:
+            self._now = start_time if start_time is not None else 0.
+        
+        self._ready = collections.deque()
+        self._timers = []
+        self._sequence = itertools.count()
+        
+        self.callbacks_run = 0
+        self.errors = 0
+        self.max_ready = 0
+        self.max_timers = 0
+    
+    def time(self):
+        if self.virtual_time:
+            return self._now
+        return time.time()
+    
+    def call_soon(self, callback, *args):
+        handle = TimerHandle(None, callback, args)
+        self._ready.append(handle)
+        self.max_ready = max(self.max_ready, len(self._ready))
+        return handle
+    
+    def call_at(self, when, callback, *args):
+        handle = TimerHandle(when, callback, args)
+        heapq.heappush(self._timers, (when, next(self._sequence), handle))
+        self.max_timers = max(self.max_timers, len(self._timers))
+        return handle
+    
+    def call_later(self, delay, callback, *args):
+        if delay <= 0:
+            return self.call_soon(callback, *args)
+        return self.call_at(self.time() + delay, callback, *args)
+    
+    def is_idle(self):
+        return not self._ready and not self._timers
+    
+    def _move_due_timers(self):
+        if not self._ready and self._timers:
+            when = self._timers[0][0]
+            if self.virtual_time:
+                self._now = max(self._now, when)
+            else:
+                delay = when - time.time()
+                if delay > 0:
+                    time.sleep(delay)
+        now = self.time()
+        while self._timers and self._timers[0][0] <= now:
+            _, _, handle = heapq.heappop(self._timers)
+            self._ready.append(handle)
+    
+    def run_once(self):
+        """Run the callbacks that are due, waiting (or jumping the virtual clock) if none are."""
+        self._move_due_timers()
+        for _ in xrange(len(self._ready)):
+            handle = self._ready.popleft()
+            if handle.cancelled:
+                continue
+            self.callbacks_run += 1
+            try:
+                handle.callback(*handle.args)
+            except Exception:
+                self.errors += 1
+                traceback.print_exc()
+    
+    def run_until_idle(self, max_iterations=None):
+        for iteration in itertools.count():
+            if self.is_idle() or (max_iterations is not None and iteration >= max_iterations):
+                break
+            self.run_once()
+    
+    def stats(self):
+        return {
+            "time": self.time(),
+            "callbacks_run": self.callbacks_run,
+            "errors": self.errors,
+            "ready": len(self._ready),
+            "timers": len(self._timers),
+            "max_ready": self.max_ready,
+            "max_timers": self.max_timers,
+        }
+
+class LoopTaskDispatcher(local.LocalTaskDispatcher):
+    """Runs tasks as callbacks on an EventLoop instead of on worker threads.
+    latency is the simulated duration of a task, in seconds, either a number or
+    a function of the resource."""
+    def __init__(self, executor_class,
+               definition_store,
+               execution_store,
+               logger_factory,
+               loop,
+               fan_in_store=None,
+               resources=None,
+               latency=0,
+               default_task=None,
+               exception_handler=None,
+               metrics=None):
+        super(LoopTaskDispatcher, self).__init__(executor_class,
+               definition_store,
+               execution_store,
+               logger_factory,
+               fan_in_store=fan_in_store,
+               resources=resources,
+               workers=0,
+               default_task=default_task,
+               exception_handler=exception_handler,
+               metrics=metrics)
+        self.loop = loop
+        self.latency = latency
+    
+    def get_latency(self, resource):
+        if callable(self.latency):
+            return self.latency(resource)
+        return self.latency
+    
+    def dispatch(self, resource, input, context):
+        self.dispatched += 1
+        if self.first_dispatch_time is None:
+            self.first_dispatch_time = self.loop.time()
+        self.loop.call_later(self.get_latency(resource), self._execute, resource, input, context)
+        self.max_queue_depth = max(self.max_queue_depth, self.dispatched - self.completed)
+        if self.metrics.enabled:
+            self.metrics.increment('Dispatches', dimensions={"Resource": resource})
+    
+    def time(self):
+        return self.loop.time()
+    
+    def dispatch_later(self, resource, input, context, delay):
+        self.loop.call_later(delay, self.dispatch, resource, input, context)
+    
+    def resume_later(self, input, context, delay):
+        self.loop.call_later(delay, self._resume, input, context)
+    
+    def _execute(self, resource, input, context):
+        try:
+            self._run(resource, input, context)
+        except Exception:
+            self.errors += 1
+            self.metrics.increment('DispatchErrors', dimensions={"Resource": resource})
+            raise
+        finally:
+            self.completed += 1
+            self.last_completion_time = self.loop.time()
+    
+    def join(self):
+        self.loop.run_until_idle()
+    
+    def stats(self):
+        stats = super(LoopTaskDispatcher, self).stats()
+        stats["queue_depth"] = self.dispatched - self.completed
+        return stats
+
+def create_components(executor_class, loop=None, central_execution_store=False, resources=None, latency=0, metrics=None):
+    loop = loop or EventLoop()
+    
+    comps = local.create_components(executor_class, central_execution_store=central_execution_store, metrics=metrics)
+    
+    comps["task_dispatcher"] = LoopTaskDispatcher(executor_class,
+                                                  comps["definition_store"],
+                                                  comps["execution_store"],
+                                                  comps["logger_factory"],
+                                                  loop,
+                                                  fan_in_store=comps["fan_in_store"],
+                                                  resources=resources,
+                                                  latency=latency,
+                                                  metrics=comps["metrics"])
+    
+    return comps
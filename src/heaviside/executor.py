@@ -6,44 +6,217 @@ Created on Oct 29, 2017
 
 from __future__ import absolute_import
 
+import json
+import signal
+import threading
+import time
 import uuid
 import itertools
-import json
+import zlib
 
 from . import components, states
+from .states import compiled as compiled_states, dataflow, paths
+
+# run_task's task_input when the caller doesn't know it
+NO_INPUT = object()
 
 def is_heaviside_execution(context):
     return Executor.CONTEXT_EXECUTION_ID_KEY in context
 
+def copy_task_input(input):
+    """A copy of the input for a task run in-process, which may change it as a
+    Lambda may change its event. State data and constant parts of the definition
+    are shared between steps, and must not be changed in place."""
+    return json.loads(json.dumps(input))
+
+class TaskTimedOut(BaseException):
+    """Raised into a task that overran its time limit. It isn't an Exception,
+    so that task code catching Exception doesn't swallow it."""
+    pass
+
+def call_with_time_limit(function, seconds):
+    """Call function, raising TaskTimedOut if it runs for more than seconds.
+    The function can only be cut off on the main thread (where Lambda runs
+    handlers), with SIGALRM; elsewhere it runs to completion, and TaskTimedOut
+    is raised afterwards if it overran."""
+    if seconds is None:
+        return function()
+    if seconds <= 0:
+        raise TaskTimedOut()
+    if not hasattr(signal, 'setitimer') or not isinstance(threading.current_thread(), threading._MainThread):
+        start = time.time()
+        result = function()
+        if time.time() - start > seconds:
+            raise TaskTimedOut()
+        return result
+    
+    def on_alarm(signum, frame):
+        raise TaskTimedOut()
+    previous = signal.signal(signal.SIGALRM, on_alarm)
+    signal.setitimer(signal.ITIMER_REAL, seconds)
+    try:
+        return function()
+    finally:
+        signal.setitimer(signal.ITIMER_REAL, 0)
+        signal.signal(signal.SIGALRM, previous)
+
+class TaskFusion(object):
+    """Lets an executor run the following Tasks of a hop in-process instead of
+    dispatching them, when their resource can be run here.
+    
+    find_task maps a resource to a function of the task input, or None if the
+    resource can't run here. Fusion stops after max_steps inline tasks, after
+    max_seconds, or when remaining_time (a function returning the seconds left
+    to the current invocation) drops below min_remaining_seconds plus the
+    longest inline task so far; the next Task is then dispatched as usual.
+    """
+    DEFAULT_MAX_STEPS = 10
+    DEFAULT_MIN_REMAINING_SECONDS = 5.
+    
+    ENV_MAX_STEPS = 'HEAVISIDE_FUSION_MAX_STEPS'
+    ENV_MAX_SECONDS = 'HEAVISIDE_FUSION_MAX_SECONDS'
+    
+    def __init__(self, find_task,
+                 max_steps=DEFAULT_MAX_STEPS,
+                 max_seconds=None,
+                 remaining_time=None,
+                 min_remaining_seconds=DEFAULT_MIN_REMAINING_SECONDS,
+                 clock=None):
+        self.find_task = find_task
+        self.max_steps = max_steps
+        self.max_seconds = max_seconds
+        self.remaining_time = remaining_time
+        self.min_remaining_seconds = min_remaining_seconds
+        self.clock = clock or time.time
+        
+        self.start_time = self.clock()
+        self.steps = 0
+        self.longest_step = 0.
+        self._step_start = None
+    
+    def claim(self, resource):
+        """Return the function to run resource inline, or None if it should be dispatched."""
+        if self.steps >= self.max_steps:
+            return None
+        now = self.clock()
+        if self.max_seconds is not None and now - self.start_time >= self.max_seconds:
+            return None
+        if (self.remaining_time is not None
+                and self.remaining_time() < self.min_remaining_seconds + self.longest_step):
+            return None
+        task = self.find_task(resource)
+        if task is None:
+            return None
+        self.steps += 1
+        return task
+    
+    def step_started(self):
+        self._step_start = self.clock()
+    
+    def step_finished(self):
+        self.longest_step = max(self.longest_step, self.clock() - self._step_start)
+
 class Executor(object):
     @classmethod
     def create(cls, definition,
                definition_store,
                execution_store,
                logger_factory,
-               task_dispatcher):
+               task_dispatcher,
+               fan_in_store=None,
+               metrics=None):
         execution_id = uuid.uuid4().hex
         
         if not isinstance(definition, states.StateMachine):
             definition = states.StateMachine.from_json(definition)
+        cls._check_dispatcher(definition, task_dispatcher)
         
         execution = execution_store.execution_factory(execution_id, definition_store)
         execution.initialize(definition)
         
+        deadline = None
+        if definition.timeout_seconds is not None:
+            deadline = task_dispatcher.time() + definition.timeout_seconds
+        
         return cls(
             execution_id,
             execution,
             definition_store,
             execution_store,
             logger_factory,
-            task_dispatcher)
+            task_dispatcher,
+            fan_in_store=fan_in_store,
+            metrics=metrics,
+            deadline=deadline)
+    
+    @classmethod
+    def _check_dispatcher(cls, definition, task_dispatcher):
+        """Refuse a definition the task dispatcher couldn't run to the end."""
+        if definition.needs_scheduling() and not task_dispatcher.can_schedule():
+            raise ValueError("The definition has Wait states or retries, but the task dispatcher can't schedule")
+    
+    @classmethod
+    def start_many(cls, definition, inputs,
+                   definition_store,
+                   execution_store,
+                   logger_factory,
+                   task_dispatcher,
+                   fan_in_store=None,
+                   metrics=None):
+        """Start an execution of the definition for each input. The definition is
+        parsed and stored once, and the first dispatches of all the executions are
+        sent together through the task dispatcher's dispatch_many.
+        Returns (execution_id, error) for each input, in order: error is None if the
+        execution was started, or the exception that stopped it; a failure doesn't
+        stop the other executions. execution_id is None if it couldn't be created;
+        an execution that was created but couldn't be dispatched is recorded as failed.
+        The executions are written one by one: the writes are conditional, which
+        BatchWriteItem doesn't support, and a TransactWriteItems call takes at most
+        25 items and fails as a whole."""
+        if not isinstance(definition, states.StateMachine):
+            definition = states.StateMachine.from_json(definition)
+        cls._check_dispatcher(definition, task_dispatcher)
+        definition_store.put_anonymous(definition)
+        
+        results = []
+        pending = []
+        for input in inputs:
+            executor = None
+            try:
+                executor = cls.create(definition,
+                                      definition_store,
+                                      execution_store,
+                                      logger_factory,
+                                      task_dispatcher,
+                                      fan_in_store=fan_in_store,
+                                      metrics=metrics)
+                executor._pending_dispatches = []
+                executor.dispatch(input)
+            except Exception as e:
+                results.append([executor.execution_id if executor is not None else None, e])
+                continue
+            finally:
+                if executor is not None:
+                    executor.logger.flush()
+            pending.extend((len(results), executor, dispatch) for dispatch in executor._pending_dispatches)
+            results.append([executor.execution_id, None])
+        
+        errors = task_dispatcher.dispatch_many([dispatch for _, _, dispatch in pending])
+        for (index, executor, _), error in zip(pending, errors):
+            if error is not None:
+                results[index][1] = error
+                executor._fail_start(error)
+        
+        return [tuple(result) for result in results]
     
     @classmethod
     def hydrate(cls, context,
                definition_store,
                execution_store,
                logger_factory,
-               task_dispatcher):
+               task_dispatcher,
+               fan_in_store=None,
+               metrics=None):
         
         execution_id = context[cls.CONTEXT_EXECUTION_ID_KEY]
         
@@ -52,13 +225,21 @@ class Executor(object):
         execution = execution_store.execution_factory(execution_id, definition_store)
         execution.hydrate(context)
         
-        return cls(
+        executor = cls(
             execution_id,
             execution,
             definition_store,
             execution_store,
             logger_factory,
-            task_dispatcher)
+            task_dispatcher,
+            fan_in_store=fan_in_store,
+            metrics=metrics,
+            frames=context.get(cls.CONTEXT_FRAMES_KEY),
+            deadline=context.get(cls.CONTEXT_DEADLINE_KEY))
+        executor._task_deadline = context.get(cls.CONTEXT_TASK_DEADLINE_KEY)
+        executor._input_ref = context.get(cls.CONTEXT_INPUT_REF_KEY)
+        executor.logger.hydrate(context)
+        return executor
     
     def __init__(self,
                  execution_id,
@@ -66,119 +247,683 @@ class Executor(object):
                  definition_store,
                  execution_store,
                  logger_factory,
-                 task_dispatcher):
+                 task_dispatcher,
+                 fan_in_store=None,
+                 metrics=None,
+                 frames=None,
+                 deadline=None):
+        """frames is the path from the top-level execution to the branch this
+        executor runs: for each enclosing fan-out state, the owning execution,
+        the state, the branch index and the fan-in id.
+        deadline is when the execution times out, in seconds since the epoch
+        by the task dispatcher's clock, from the definition's TimeoutSeconds."""
         self.execution_id = execution_id
         self.execution = execution
-        self.definition = execution.get_definition()
+        self.frames = frames or []
+        self.deadline = deadline
+        self._task_deadline = None
+        self._input_ref = None
+        self.root_definition = execution.get_definition()
+        self.definition = self.root_definition
+        for frame in self.frames:
+            self.definition = self.definition.states[frame['State']].branch_definition(frame['Branch'])
+        self.compiled = self.definition.compile()
+        self._current_state_id = None
+        self._pending_dispatches = None
+        self.fusion = None
+        self._fused_task = None
         
         self.executor_id = uuid.uuid4().hex
-        print 'created executor {}'.format(self.executor_id[-4:])
         
         self.execution = execution
         
         self.definition_store=definition_store
         self.execution_store=execution_store
+        self.logger_factory=logger_factory
         self.logger=logger_factory.logger_factory(self.execution_id, self.executor_id)
+        self.logger.debug('created executor')
         self.task_dispatcher=task_dispatcher
+        self.fan_in_store=fan_in_store
+        self.metrics=metrics or components.NULL_METRICS
+    
+    def _components(self):
+        return {
+            "definition_store": self.definition_store,
+            "execution_store": self.execution_store,
+            "logger_factory": self.logger_factory,
+            "task_dispatcher": self.task_dispatcher,
+            "fan_in_store": self.fan_in_store,
+            "metrics": self.metrics,
+        }
     
     CONTEXT_EXECUTION_ID_KEY = 'x-heaviside-sm-eid'
+    CONTEXT_FRAMES_KEY = 'x-heaviside-sm-frames'
+    CONTEXT_DEADLINE_KEY = 'x-heaviside-sm-deadline'
+    CONTEXT_TASK_DEADLINE_KEY = 'x-heaviside-sm-tdeadline'
+    CONTEXT_INPUT_REF_KEY = 'x-heaviside-sm-iref'
+    
+    # no Task is dispatched with less than this left before the execution's deadline
+    MIN_DISPATCH_SECONDS = 1.
+    # time left in a Lambda invocation after a task is cut off, to dispatch what follows
+    INVOCATION_MARGIN_SECONDS = 1.
     
     def get_context(self):
         context = {
             self.CONTEXT_EXECUTION_ID_KEY: self.execution_id,
         }
+        if self.frames:
+            context[self.CONTEXT_FRAMES_KEY] = self.frames
+        if self.deadline is not None:
+            context[self.CONTEXT_DEADLINE_KEY] = self.deadline
+        if self._task_deadline is not None:
+            context[self.CONTEXT_TASK_DEADLINE_KEY] = self._task_deadline
         context.update(self.definition_store.get_context())
         context.update(self.execution.get_context())
         context.update(self.logger.get_context())
         return context
     
     def log_state(self):
+        if not self.logger.is_enabled(self.logger.DEBUG):
+            return
         state, result = self.execution.get_current_state_and_result()
-        s = []
-        s.append('\nvvv               vvv')
-#         s.append('execution: {}'.format(self.execution_id[-4:]))
-        s.append('executor: {}'.format(self.executor_id[-4:]))
-        
-        if state:
-            s.append('state:' + json.dumps(state.to_json(), indent=2))
-        
-        if result:
-            s.extend(['result:', json.dumps(result.to_json())])
-        
-        s.append('^^^               ^^^\n')
-        print '\n'.join(s)
+        self.logger.debug('state',
+                          state=state.to_json() if state else None,
+                          result=result.to_json() if result else None)
     
     def dispatch(self, input):
         """Run the state machine up to the next Task state, which will be async invoked."""
-        print '[dispatch] {} input: {}'.format(self.executor_id[-4:], input)
+        self.logger.debug('dispatch', input=input)
         current_state, result = self.execution.get_current_state_and_result()
         self.log_state()
         if current_state is None:
             if result:
-                print 'has result'
+                self.logger.debug('has result')
                 return result.to_json()
             else:
-                print 'initializing', self.definition.start_at
-                self.execution.change_state(self.definition.start_at)
+                self.logger.debug('initializing {}', self.definition.start_at)
+                state_id = self.compiled.start_id
+                self._enter_state(state_id)
                 self.log_state()
+        else:
+            state_id = self.compiled.state_id(current_state.name)
+            self._current_state_id = state_id
+        self._run(state_id, input)
+    
+    def _enter_state(self, state_id, data=None):
+        """Make state_id the current state. data is kept with it, for states
+        whose output is built from their input."""
+        if state_id != self._current_state_id:
+            self.execution.change_state(self.compiled.names[state_id], data=data)
+            self._current_state_id = state_id
+        elif data is not None:
+            self.execution.update_state_data(data)
+    
+    def _context_object(self, state_id):
+        """The context object ($$ paths), built only if a path uses it."""
+        return lambda: {
+            "Execution": {"Id": self.execution_id},
+            "State": {"Name": self.compiled.names[state_id]},
+        }
+    
+    def _past_deadline(self):
+        return self.deadline is not None and self.task_dispatcher.time() >= self.deadline
+    
+    def _time_out(self):
+        self._finish(components.Result(components.Result.STATUS_TIMED_OUT, error='States.Timeout',
+                                       cause='Execution would not finish within its TimeoutSeconds'))
+    
+    def _fail_start(self, error):
+        """Record that the execution's first dispatch failed, so an execution
+        already written isn't left waiting for a task that will never run."""
+        self.execution.set_result(components.Result(components.Result.STATUS_FAILED,
+                                                    error='States.Runtime', cause=str(error)))
+        try:
+            self.execution.flush()
+        except Exception as e:
+            self.logger.warning('failed execution not recorded', error=str(e))
+        finally:
+            self.logger.flush()
+    
+    def _fail_runtime(self, error):
+        self._finish(components.Result(components.Result.STATUS_FAILED,
+                                       error='States.Runtime', cause=str(error)))
+    
+    def _effective_input(self, state_id, input):
+        """InputPath and Parameters. Raises PathNotFound."""
+        io = self.compiled.io[state_id]
+        if io.is_identity:
+            return input
+        return io.effective_input(input, self._context_object(state_id))
+    
+    def _raw_input(self, state_id, input):
+        """The input to keep for building the state's output, if it needs it."""
+        return input if self.compiled.needs_raw_input[state_id] else None
+    
+    def _run(self, state_id, input):
+        compiled = self.compiled
+        handlers = self._STATE_HANDLERS
+        trace = self.logger.is_enabled(self.logger.DEBUG)
+        timed = self.metrics.enabled
         for i in itertools.count():
-            current_state, result = self.execution.get_current_state_and_result()
-            
-            print 'loop', self.executor_id[-4:], i, current_state.name
-            state_def = self.definition.states[current_state.name]
-            print 'state def', json.dumps(state_def.to_json())
-            if isinstance(state_def, states.SucceedState):
-                print 'succeed'
-                self.execution.set_result(components.Result(components.Result.STATUS_SUCCEEDED))
-                self.log_state()
-                break
-            elif isinstance(state_def, states.FailState):
-                print 'fail'
-                self.execution.set_result(components.Result(components.Result.STATUS_FAILED))
-                self.log_state()
-                break
-            elif isinstance(state_def, states.TaskState):
-                print 'task'
-                self.task_dispatcher.dispatch(state_def.resource, input, self.get_context())
-                break
+            if trace:
+                self.logger.debug('loop {} {}', i, compiled.names[state_id])
+            if timed:
+                start = time.time()
+                next_step = handlers[compiled.kinds[state_id]](self, state_id, input)
+                self.metrics.observe('StateTime', (time.time() - start) * 1000,
+                                     dimensions={"State": compiled.names[state_id]})
             else:
-                raise TypeError("No matching type for {}".format(state_def))
+                next_step = handlers[compiled.kinds[state_id]](self, state_id, input)
+            if next_step is None:
+                break
+            state_id, input = next_step
+    
+    def _flush(self):
+        """Write the execution and the buffered log before the execution is handed
+        on, so the context built next carries the log's current sequence token."""
+        self.execution.flush()
+        self.logger.flush()
+    
+    def task_input(self, input):
+        """The input of the current Task: the one it was invoked with, or the
+        data it was dispatched with by reference."""
+        if self._input_ref is None:
+            return input
+        return self._load_data(components.DataRef(self._input_ref))
+    
+    def _load_data(self, data_ref):
+        return self.fan_in_store.load_data(data_ref)
+    
+    def _outgoing(self, input):
+        """The input and context to dispatch a Task with. Data kept in the blob
+        store is sent as its reference, in the context."""
+        context = self.get_context()
+        if isinstance(input, components.DataRef):
+            context[self.CONTEXT_INPUT_REF_KEY] = input.ref
+            input = None
+        return input, context
+    
+    def _send(self, resource, input):
+        self._flush()
+        input, context = self._outgoing(input)
+        if self._pending_dispatches is not None:
+            self._pending_dispatches.append((resource, input, context))
+        else:
+            self.task_dispatcher.dispatch(resource, input, context)
+    
+    def _run_succeed(self, state_id, input):
+        try:
+            output = self.compiled.io[state_id].filter_output(self._effective_input(state_id, input))
+        except paths.PathNotFound as e:
+            return self._fail_runtime(e)
+        self._finish(components.Result(components.Result.STATUS_SUCCEEDED, output))
     
-    def run_task(self, task_function, exception_handler):
+    def _run_fail(self, state_id, input):
+        state_def = self.compiled.states[state_id]
+        self._finish(components.Result(components.Result.STATUS_FAILED,
+                                       error=state_def.error, cause=state_def.cause))
+    
+    def _run_task(self, state_id, input):
+        now = self.task_dispatcher.time()
+        if self.deadline is not None and self.deadline - now < self.MIN_DISPATCH_SECONDS:
+            return self._time_out()
+        try:
+            task_input = self._effective_input(state_id, input)
+        except paths.PathNotFound as e:
+            return self._fail_runtime(e)
+        time_limit = self.compiled.states[state_id].get_time_limit()
+        self._task_deadline = now + time_limit if time_limit is not None else None
+        # the raw input travels with the state until the task's result comes back
+        self._enter_state(state_id, self._raw_input(state_id, input))
+        if self._run_fused(state_id, task_input):
+            return
+        self._send(self.compiled.states[state_id].resource, task_input)
+    
+    def _run_parallel(self, state_id, input):
+        try:
+            branch_input = self._effective_input(state_id, input)
+        except paths.PathNotFound as e:
+            return self._fail_runtime(e)
+        self._enter_state(state_id)
+        state_def = self.compiled.states[state_id]
+        state_name = self.compiled.names[state_id]
+        
+        raw_input = self._raw_input(state_id, input)
+        fan_in_id = '{}:{}'.format(state_name, uuid.uuid4().hex)
+        self.fan_in_store.create_fan_in(self.execution_id, fan_in_id, len(state_def.branches),
+                                        owner_input=raw_input)
+        
+        return self._start_branches(state_id, fan_in_id, enumerate([branch_input] * len(state_def.branches)),
+                                    raw_input)
+    
+    def _run_map(self, state_id, input):
+        state_def = self.compiled.states[state_id]
+        try:
+            inputs = state_def.get_iteration_inputs(self._effective_input(state_id, input))
+        except paths.PathNotFound as e:
+            return self._fail_runtime(e)
+        if not inputs:
+            return self._complete(state_id, input, [])
+        
+        self._enter_state(state_id)
+        state_name = self.compiled.names[state_id]
+        
+        # iterations beyond the concurrency window are started as others finish
+        window = state_def.max_concurrency or len(inputs)
+        
+        raw_input = self._raw_input(state_id, input)
+        fan_in_id = '{}:{}'.format(state_name, uuid.uuid4().hex)
+        self.fan_in_store.create_fan_in(self.execution_id, fan_in_id, len(inputs),
+                                        pending_inputs=inputs[window:],
+                                        owner_input=raw_input)
+        
+        return self._start_branches(state_id, fan_in_id, enumerate(inputs[:window]), raw_input)
+    
+    def _start_branches(self, state_id, fan_in_id, indexed_inputs, raw_input):
+        """Start the fan-out state's branches. Branches that can't be dispatched
+        fail the fan-in, so the ones that were stop when they finish; returns the
+        next step if this executor is then the one to handle the error."""
+        self._flush()
+        state_name = self.compiled.names[state_id]
+        # the branches' first dispatches are collected and sent together
+        pending = []
+        branches = []
+        for index, input in indexed_inputs:
+            branch = self._spawn_branch({
+                "Execution": self.execution_id,
+                "State": state_name,
+                "Branch": index,
+                "FanIn": fan_in_id,
+            })
+            branch._pending_dispatches = pending
+            dispatched = len(pending)
+            branch.dispatch(input)
+            branches.extend([(index, branch)] * (len(pending) - dispatched))
+        
+        errors = self.task_dispatcher.dispatch_many(pending)
+        failed = [(index, branch, error) for (index, branch), error in zip(branches, errors) if error is not None]
+        if not failed:
+            return None
+        first_failure = False
+        for index, branch, error in failed:
+            self.logger.warning('branch not dispatched', branch=index, error=str(error))
+            branch.execution.delete()
+            if self.fan_in_store.record_failure(self.execution_id, fan_in_id, index, 'States.Runtime'):
+                first_failure = True
+        if not first_failure:
+            # another branch failed first, and fails the state
+            return None
+        self.fan_in_store.delete_fan_in(self.execution_id, fan_in_id)
+        index, _, error = failed[0]
+        if self._past_deadline():
+            return self._time_out()
+        return self._catch(state_id, 'States.Runtime',
+                           'Branch {} could not be dispatched: {}'.format(index, error), raw_input)
+    
+    def _run_pass(self, state_id, input):
+        try:
+            result = self.compiled.states[state_id].get_result(self._effective_input(state_id, input))
+        except paths.PathNotFound as e:
+            return self._fail_runtime(e)
+        return self._complete(state_id, input, result)
+    
+    def _run_choice(self, state_id, input):
+        try:
+            input = self._effective_input(state_id, input)
+            next_id = self.compiled.choosers[state_id](input)
+            output = self.compiled.io[state_id].filter_output(input)
+        except paths.PathNotFound as e:
+            return self._fail_runtime(e)
+        if next_id is None:
+            self._finish(components.Result(components.Result.STATUS_FAILED,
+                                           error='States.NoChoiceMatched',
+                                           cause='No choice rule matched and there is no Default'))
+            return None
+        return next_id, output
+    
+    def _run_wait(self, state_id, input):
+        """Hand the execution to the task dispatcher to be resumed after the wait."""
+        state_def = self.compiled.states[state_id]
+        io = self.compiled.io[state_id]
+        try:
+            input = self._effective_input(state_id, input)
+            delay = state_def.get_delay(input, self.task_dispatcher.time())
+            output = io.filter_output(input)
+        except (paths.PathNotFound, ValueError) as e:
+            return self._fail_runtime(e)
+        if delay <= 0:
+            return self._advance(state_id, output)
+        if self.deadline is not None and self.task_dispatcher.time() + delay >= self.deadline:
+            return self._time_out()
+        if not self.task_dispatcher.can_schedule():
+            # an execution started with a dispatcher that could
+            return self._fail_runtime(ValueError("The task dispatcher can't schedule the Wait"))
+        self._enter_state(state_id)
+        self.logger.debug('waiting', seconds=delay)
+        self._flush()
+        self.task_dispatcher.resume_later(output, self.get_context(), delay)
+    
+    def resume(self, output):
+        """Continue a waiting execution past its current (Wait) state."""
+        self.logger.debug('resume')
+        current_state, result = self.execution.get_current_state_and_result()
+        if current_state is None:
+            self.logger.warning('no state to resume', result=result.to_json() if result else None)
+            return
+        state_id = self.compiled.state_id(current_state.name)
+        self._current_state_id = state_id
+        self._continue(self._advance(state_id, output))
+    
+    def _complete(self, state_id, raw_input, result):
+        """Build the output of state_id from its input and result (ResultSelector,
+        ResultPath, OutputPath), and return the next step like _advance."""
+        context_object = self._context_object(state_id)
+        io = self.compiled.io[state_id]
+        if isinstance(result, components.DataRef) and not io.is_identity:
+            result = self._load_data(result)
+        try:
+            output = io.output(raw_input, result, context_object)
+        except paths.PathMatchFailure as e:
+            return self._catch(state_id, 'States.ResultPathMatchFailure', str(e), raw_input)
+        except paths.PathNotFound as e:
+            return self._fail_runtime(e)
+        return self._advance(state_id, output)
+    
+    def _catch(self, state_id, error, cause, raw_input):
+        """Return the next step for a matching catcher, with the error output at its
+        ResultPath in the state's input, or fail the execution if none matches."""
+        catch = self.compiled.find_catch(state_id, error)
+        if catch is None:
+            self._finish(components.Result(components.Result.STATUS_FAILED, error=error, cause=cause))
+            return None
+        next_id, result_path = catch
+        try:
+            output = dataflow.apply_result_path(result_path, raw_input, {"Error": error, "Cause": cause})
+        except paths.PathMatchFailure as e:
+            self._finish(components.Result(components.Result.STATUS_FAILED,
+                                           error='States.ResultPathMatchFailure', cause=str(e)))
+            return None
+        return next_id, output
+    
+    def _advance(self, state_id, output):
+        """Like _transition, but returns the next step to the _run loop instead of recursing."""
+        next_id = self.compiled.next_ids[state_id]
+        if isinstance(output, components.DataRef) and not self._takes_data_ref(next_id):
+            output = self._load_data(output)
+        if next_id is None:
+            self._finish(components.Result(components.Result.STATUS_SUCCEEDED, output))
+            return None
+        return next_id, output
+    
+    def _takes_data_ref(self, state_id):
+        """Whether state_id can be handed its input by reference: a Task that
+        passes its input to its resource as it is."""
+        compiled = self.compiled
+        return (state_id is not None
+                and compiled.kinds[state_id] == compiled_states.KIND_TASK
+                and compiled.io[state_id].is_identity
+                and not compiled.needs_raw_input[state_id])
+    
+    _STATE_HANDLERS = {
+        compiled_states.KIND_SUCCEED: _run_succeed,
+        compiled_states.KIND_FAIL: _run_fail,
+        compiled_states.KIND_TASK: _run_task,
+        compiled_states.KIND_PARALLEL: _run_parallel,
+        compiled_states.KIND_MAP: _run_map,
+        compiled_states.KIND_PASS: _run_pass,
+        compiled_states.KIND_CHOICE: _run_choice,
+        compiled_states.KIND_WAIT: _run_wait,
+    }
+    
+    def _spawn_branch(self, frame, parent_frames=None):
+        if parent_frames is None:
+            parent_frames = self.frames
+        execution_id = uuid.uuid4().hex
+        execution = self.execution_store.execution_factory(execution_id, self.definition_store)
+        execution.initialize(self.root_definition)
+        return self.__class__(execution_id, execution, frames=parent_frames + [frame], deadline=self.deadline,
+                              **self._components())
+    
+    def _start_pending_branch(self):
+        """Start the next branch of this branch's fan-out state that is waiting for a slot, if any."""
+        frame = self.frames[-1]
+        claimed = self.fan_in_store.claim_pending(frame['Execution'], frame['FanIn'])
+        if claimed is None:
+            return
+        index, input = claimed
+        sibling_frame = dict(frame)
+        sibling_frame['Branch'] = index
+        self._spawn_branch(sibling_frame, parent_frames=self.frames[:-1]).dispatch(input)
+    
+    def _resume_parent(self):
+        """Create an executor for the execution that owns this branch's fan-out state,
+        positioned at that state."""
+        frame = self.frames[-1]
+        execution = self.execution_store.execution_factory(frame['Execution'], self.definition_store)
+        execution.attach(self.root_definition)
+        parent = self.__class__(frame['Execution'], execution, frames=self.frames[:-1], deadline=self.deadline,
+                                **self._components())
+        parent._enter_state(parent.compiled.state_id(frame['State']))
+        return parent
+    
+    def _finish(self, result):
+        """Record the result of this execution. If it is a branch of a fan-out state,
+        record it in the fan-in, and if this is the last branch, continue the owning execution."""
+        self.execution.set_result(result)
+        self.log_state()
+        if not self.frames:
+            self.execution.flush()
+            self.logger.info('execution finished', status=result.status, error=result.error)
+            if self.metrics.enabled:
+                self.metrics.increment('Executions', dimensions={"Status": result.status})
+            return
+        
+        frame = self.frames[-1]
+        owner_id, fan_in_id = frame['Execution'], frame['FanIn']
+        if result.status == components.Result.STATUS_SUCCEEDED:
+            remaining = self.fan_in_store.record_output(owner_id, fan_in_id, frame['Branch'], result.output)
+            # the fan-in keeps the branch's output, so its execution isn't needed any more
+            self.execution.delete()
+            self.logger.debug('branch {} finished, {} remaining', frame['Branch'], remaining)
+            if remaining != 0:
+                if remaining is not None:
+                    self._start_pending_branch()
+                return
+            parent = self._resume_parent()
+            state_id = parent._current_state_id
+            # a large result is kept in the blob store, and passed on by reference
+            result = self.fan_in_store.collect_outputs(owner_id, fan_in_id,
+                                                       parent.compiled.states[state_id].collate_outputs)
+            raw_input = parent._fan_in_owner_input(state_id, owner_id, fan_in_id)
+            self.fan_in_store.delete_fan_in(owner_id, fan_in_id)
+            parent._transition(state_id, result, raw_input)
+        else:
+            first_failure = self.fan_in_store.record_failure(owner_id, fan_in_id, frame['Branch'], result.error)
+            self.execution.delete()
+            if not first_failure:
+                return
+            parent = self._resume_parent()
+            state_id = parent._current_state_id
+            raw_input = parent._fan_in_owner_input(state_id, owner_id, fan_in_id)
+            # the first failure decides the state; branches still running stop at the missing fan-in
+            self.fan_in_store.delete_fan_in(owner_id, fan_in_id)
+            parent._handle_error(state_id, result.error or 'States.BranchFailed', result.cause, raw_input)
+    
+    def _fan_in_owner_input(self, state_id, owner_id, fan_in_id):
+        if not self.compiled.needs_raw_input[state_id]:
+            return None
+        return self.fan_in_store.get_owner_input(owner_id, fan_in_id)
+    
+    def _transition(self, state_id, result, raw_input=None):
+        """Continue after state_id has completed with the given result."""
+        self._continue(self._complete(state_id, raw_input, result))
+    
+    def _handle_error(self, state_id, error, cause=None, raw_input=None):
+        if self._past_deadline():
+            return self._time_out()
+        self._continue(self._catch(state_id, error, cause, raw_input))
+    
+    def _continue(self, next_step):
+        if next_step is not None:
+            next_id, output = next_step
+            self._enter_state(next_id)
+            self._run(next_id, output)
+    
+    def _run_fused(self, state_id, input):
+        """Claim the Task for inline execution if fusion allows it.
+        Tasks started while collecting a fan-out's dispatches are never fused,
+        nor are Tasks whose input is in the blob store."""
+        if (self.fusion is None or self._pending_dispatches is not None
+                or isinstance(input, components.DataRef)):
+            return False
+        resource = self.compiled.states[state_id].resource
+        task = self.fusion.claim(resource)
+        if task is None:
+            return False
+        self.logger.debug('fusing task', resource=resource)
+        if self.metrics.enabled:
+            self.metrics.increment('FusedTasks', dimensions={"Resource": resource})
+        self._fused_task = (task, input)
+        return True
+    
+    def run_task(self, task_function, exception_handler, fusion=None, task_input=NO_INPUT, remaining_time=None):
         """Process the current task and dispatch.
-        Assumes the current state is a Task state."""
-        print '[run task] {}'.format(self.executor_id[-4:])
+        Assumes the current state is a Task state.
+        task_input is what the task was invoked with; the task can only be
+        retried if it is given.
+        With a TaskFusion, following Tasks it allows are run here, one after
+        another, before the next one is dispatched.
+        The task is cut off with States.Timeout at the Task's TimeoutSeconds, or
+        before remaining_time (a function returning the seconds left to the
+        invocation) runs out. It isn't run if the execution has timed out."""
+        self.fusion = fusion
+        while True:
+            if not self.metrics.enabled:
+                result = self._hop(task_function, exception_handler, task_input, remaining_time)
+            else:
+                start = time.time()
+                try:
+                    result = self._hop(task_function, exception_handler, task_input, remaining_time)
+                finally:
+                    self.metrics.observe('HopLatency', (time.time() - start) * 1000)
+            
+            fused, self._fused_task = self._fused_task, None
+            if fused is None:
+                return result
+            task, task_input = fused
+            # a fused Task has its input at hand
+            self._input_ref = None
+            task_function = self._fused_task_function(task, task_input)
+    
+    def _fused_task_function(self, task, input):
+        fusion = self.fusion
+        def fused_task():
+            fusion.step_started()
+            try:
+                return task(copy_task_input(input))
+            finally:
+                fusion.step_finished()
+        return fused_task
+    
+    def _timed_task(self, task_function, state_name):
+        dimensions = {"State": state_name}
+        def timed_task():
+            start = time.time()
+            try:
+                return task_function()
+            except Exception:
+                self.metrics.increment('TaskErrors', dimensions=dimensions)
+                raise
+            finally:
+                self.metrics.observe('TaskTime', (time.time() - start) * 1000, dimensions=dimensions)
+        return timed_task
+    
+    def _hop(self, task_function, exception_handler, task_input=NO_INPUT, remaining_time=None):
+        self.logger.debug('run task')
         
         current_state, result = self.execution.get_current_state_and_result()
         
         self.log_state()
         
-        state_def = self.definition.states[current_state.name]
-        print 'state def', state_def.to_json()
+        state_id = self.compiled.state_id(current_state.name)
+        self._current_state_id = state_id
+        if self._past_deadline():
+            self._time_out()
+            return result
+        raw_input = current_state.data if self.compiled.needs_raw_input[state_id] else None
+        if self.metrics.enabled:
+            task_function = self._timed_task(task_function, current_state.name)
         try:
-            output = task_function()
+            task_result = call_with_time_limit(task_function, self._time_limit(remaining_time))
+        except TaskTimedOut:
+            if self._past_deadline():
+                self._time_out()
+                return result
+            next_step = self._handle_task_error(state_id, current_state, 'States.Timeout',
+                                                'Task did not finish in time', task_input, raw_input)
         except Exception as e:
-            exception = exception_handler(e)
-            for catcher in state_def.catch or []:
-                if catcher.matches(exception):
-                    self.execution.change_state(catcher.next)
-                    output = {}
-                    break
-            else:
-#                 self.result = {
-#                     "type": "Fail",
-#                     "name": current_state.name,
-#                     "Error": "States.TaskFailed",
-#                     "Cause": "No matching catcher",
-#                 }
-                self.execution.set_result(components.Result(components.Result.STATUS_FAILED))
-                self.log_state()
-                return
+            next_step = self._handle_task_error(state_id, current_state, exception_handler(e),
+                                                str(e), task_input, raw_input)
         else:
-            if state_def.is_end():
-                print 'task is end state'
-                self.execution.set_result(components.Result(components.Result.STATUS_SUCCEEDED, output))
-            else:
-                self.execution.change_state(state_def.next)
-        self.dispatch(result)
-        return result
\ No newline at end of file
+            next_step = self._complete(state_id, raw_input, task_result)
+        if next_step is None:
+            self.logger.debug('nothing to dispatch after task')
+            return result
+        next_id, output = next_step
+        self._enter_state(next_id)
+        self.dispatch(output)
+        return result
+    
+    def _handle_task_error(self, state_id, state, error, cause, task_input, raw_input):
+        if self._retry(state_id, state, error, task_input):
+            return None
+        return self._catch(state_id, error, cause, raw_input)
+    
+    def _time_limit(self, remaining_time):
+        """The seconds the current task may run, or None for no limit."""
+        now = self.task_dispatcher.time()
+        limits = [deadline - now for deadline in (self.deadline, self._task_deadline) if deadline is not None]
+        if remaining_time is not None:
+            limits.append(remaining_time() - self.INVOCATION_MARGIN_SECONDS)
+        return min(limits) if limits else None
+    
+    def _retry(self, state_id, state, error, task_input):
+        """Dispatch the Task again after its retry delay, if a retrier matches the
+        error and has attempts left. The attempt counts are kept with the state."""
+        if task_input is NO_INPUT or not self.task_dispatcher.can_schedule():
+            return False
+        found = self.compiled.find_retrier(state_id, error)
+        if found is None:
+            return False
+        index, retrier = found
+        retries = list(state.retries or [0] * len(self.compiled.retriers[state_id]))
+        attempt = retries[index]
+        if attempt >= retrier.max_attempts:
+            return False
+        delay = retrier.get_delay(attempt, self._jitter(state.name, attempt))
+        now = self.task_dispatcher.time()
+        if self.deadline is not None and now + delay >= self.deadline:
+            self._time_out()
+            return True
+        retries[index] = attempt + 1
+        self.execution.update_state_retries(retries)
+        self._flush()
+        if self._input_ref is not None:
+            # dispatched again by reference, not with the loaded data
+            task_input = components.DataRef(self._input_ref)
+        time_limit = self.compiled.states[state_id].get_time_limit()
+        self._task_deadline = now + delay + time_limit if time_limit is not None else None
+        
+        self.logger.debug('retrying', error=error, attempt=attempt + 1, delay=delay)
+        if self.metrics.enabled:
+            self.metrics.increment('TaskRetries', dimensions={"State": state.name})
+        task_input, context = self._outgoing(task_input)
+        self.task_dispatcher.dispatch_later(self.compiled.states[state_id].resource,
+                                            task_input, context, delay)
+        return True
+    
+    def _jitter(self, state_name, attempt):
+        """A fraction in [0, 1) for jittered retry delays, derived from the
+        execution, state and attempt, so that runs can be reproduced."""
+        key = u'{}:{}:{}'.format(self.execution_id, state_name, attempt)
+        return (zlib.crc32(key.encode('utf-8')) & 0xffffffff) / float(1 << 32)
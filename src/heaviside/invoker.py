@@ -7,6 +7,14 @@ Lambda handler that accepts a request in the format:
 
 starts the state machine and returns an id for it.
 
+bulk_handler accepts
+{
+  "StateMachine": <json definition>,
+  "Inputs": [<input to each execution>, ...]
+}
+and starts an execution for each input, returning their ids, with null for
+those that couldn't be started, and the errors for those.
+
 Created on Oct 28, 2017
 
 @author: bkehoe
@@ -21,12 +29,16 @@ import boto3
 
 from . import executor, aws
 
-def handler(event, context):
-    """Create the state machine from the definition and dispatch. Return the id."""
-    
+def _get_definition(event):
     definition = event["StateMachine"]
     if isinstance(definition, basestring):
         definition = json.loads(definition)
+    return definition
+
+def handler(event, context):
+    """Create the state machine from the definition and dispatch. Return the id."""
+    
+    definition = _get_definition(event)
         
     definition_bucket_name = os.environ["StateMachineBucket"]
     state_table_name = os.environ["StateTable"]
@@ -35,8 +47,48 @@ def handler(event, context):
     
     ex = executor.Executor.create(definition, **components)
 
-    ex.dispatch(event["Input"])
+    # states before the first Task run here, and log and record metrics
+    try:
+        ex.dispatch(event["Input"])
+    finally:
+        ex.logger.flush()
+        components["metrics"].flush()
+    
+    return {
+        "id": ex.execution_id,
+    }
+
+def bulk_handler(event, context):
+    """Start an execution of the definition for each input. Return the ids, in
+    the order of the inputs, and the errors of the executions that failed to start."""
+    
+    definition = _get_definition(event)
+    
+    definition_bucket_name = os.environ["StateMachineBucket"]
+    
+    # components are kept across invocations, so the definition is uploaded once per container
+    components = aws.get_components(definition_bucket_name)
+    
+    try:
+        results = executor.Executor.start_many(definition, event["Inputs"], **components)
+    finally:
+        components["metrics"].flush()
+    
+    ids = []
+    errors = []
+    for index, (execution_id, error) in enumerate(results):
+        if error is None:
+            ids.append(execution_id)
+        else:
+            ids.append(None)
+            errors.append({
+                "Index": index,
+                "ExecutionId": execution_id,
+                "Error": type(error).__name__,
+                "Cause": str(error),
+            })
     
     return {
-        "id": ex.id,
+        "ids": ids,
+        "errors": errors,
     }
\ No newline at end of file
@@ -6,26 +6,51 @@ Created on Oct 29, 2017
 
 from __future__ import absolute_import
 
+import os
+import re
+import shutil
+import collections
+import json
+import math
+import base64
+import io
+import tempfile
 import threading
 import time
+import traceback
+import Queue
+import BaseHTTPServer
+import SocketServer
 
-from . import components
+from . import components, codec
+from .executor import TaskFusion, copy_task_input
 
-def create_components(executor_class, central_execution_store=False):
-    definition_store = LocalDefinitionStore()
+def create_components(executor_class, central_execution_store=False, resources=None, workers=None, metrics=None,
+                      fusion_steps=0):
+    metrics = metrics or components.NULL_METRICS
+    
+    definition_store = LocalDefinitionStore(metrics=metrics)
+    
+    blob_store = LocalBlobStore()
     
     if central_execution_store:
         execution_store = LocalExecutionCentralStore()
     else:
-        execution_store = LocalExecutionContextStore()
+        execution_store = LocalExecutionContextStore(blob_store=blob_store, metrics=metrics)
     
     logger_factory = LocalLoggerFactory()
     
+    fan_in_store = LocalFanInStore(blob_store=blob_store, metrics=metrics)
     
     task_dispatcher = LocalTaskDispatcher(executor_class,
                                            definition_store, 
                                            execution_store,
-                                           logger_factory)
+                                           logger_factory,
+                                           fan_in_store=fan_in_store,
+                                           resources=resources,
+                                           workers=workers or LocalTaskDispatcher.DEFAULT_WORKERS,
+                                           metrics=metrics,
+                                           fusion_steps=fusion_steps)
     
     
     return {
@@ -33,11 +58,17 @@ def create_components(executor_class, central_execution_store=False):
         "execution_store": execution_store,
         "logger_factory": logger_factory,
         "task_dispatcher": task_dispatcher,
+        "fan_in_store": fan_in_store,
+        "metrics": metrics,
     }
 
 class LocalDefinitionStore(components.DefinitionStore):
-    def __init__(self):
+    """In-memory definition store. Given a DefinitionCache, it reads through the
+    cache the same way S3DefinitionStore does, so cache sizing can be exercised locally."""
+    def __init__(self, definition_cache=None, metrics=None):
         self.store = {}
+        self.definition_cache = definition_cache
+        self.metrics = metrics or components.NULL_METRICS
     
     def get_context(self):
         return {}
@@ -48,13 +79,57 @@ class LocalDefinitionStore(components.DefinitionStore):
     def put_anonymous(self, definition):
         hash = definition.get_hash()
         self.store[hash] = definition
+        if self.definition_cache is not None:
+            self.definition_cache.put(hash, definition, verify=False)
         return hash
     
     def hydrate_definition(self, definition_id):
-        return self.store[definition_id]
+        if self.definition_cache is None:
+            return self.store[definition_id]
+        definition = self.definition_cache.get(definition_id)
+        if definition is None:
+            self.metrics.increment('DefinitionCacheMisses')
+            definition = self.store[definition_id]
+            self.definition_cache.put(definition_id, definition)
+        else:
+            self.metrics.increment('DefinitionCacheHits')
+        return definition
+
 
+class LocalBlobStore(components.BlobStore):
+    """Filesystem stand-in for S3BlobStore. References are keys relative to the directory."""
+    def __init__(self, directory=None):
+        self.directory = directory
+    
+    def _path(self, key):
+        if self.directory is None:
+            self.directory = tempfile.mkdtemp(prefix='heaviside-blobs-')
+        return os.path.join(self.directory, *key.split('/'))
+    
+    def put(self, key, body):
+        return self.put_file(key, io.BytesIO(body))
+    
+    def put_file(self, key, fileobj):
+        path = self._path(key)
+        dirname = os.path.dirname(path)
+        if not os.path.isdir(dirname):
+            try:
+                os.makedirs(dirname)
+            except OSError:
+                if not os.path.isdir(dirname):
+                    raise
+        fd, tmp_path = tempfile.mkstemp(dir=dirname)
+        with os.fdopen(fd, 'wb') as fp:
+            shutil.copyfileobj(fileobj, fp)
+        os.rename(tmp_path, path)
+        return key
+    
+    def get(self, ref):
+        with open(self._path(ref), 'rb') as fp:
+            return fp.read()
 
 class LocalExecutionCentralStore(components.ExecutionStore):
+    """Keeps executions in a dict shared by all executors, instead of in the context."""
     def __init__(self):
         self.store = {}
     
@@ -64,8 +139,8 @@ class LocalExecutionCentralStore(components.ExecutionStore):
     class Execution(components.Execution):
         def __init__(self, execution_id, definition_store, store):
             components.Execution.__init__(self, execution_id, definition_store)
-            self.store = None
-    
+            self.store = store
+        
         def get_context(self):
             return {}
         
@@ -81,45 +156,60 @@ class LocalExecutionCentralStore(components.ExecutionStore):
                 'definition_id': def_id,
             }
         
+        def attach(self, definition):
+            if self.execution_id not in self.store:
+                self.initialize(definition)
+        
         def get_definition(self):
             return self.definition_store.hydrate_definition(self.store[self.execution_id]['definition_id'])
         
         def change_state(self, new_state_name, data=None):
-            print 'changing state to', new_state_name
+            component_logger().debug('changing state to {}', new_state_name)
             self.store[self.execution_id]['current_state'] = components.State(new_state_name, data=data)
         
         def update_state_data(self, data):
             self.store[self.execution_id]['current_state'].data = data
         
+        def update_state_retries(self, retries):
+            self.store[self.execution_id]['current_state'].retries = retries
+        
         def set_result(self, result):
-            print 'setting result'
+            component_logger().debug('setting result')
             self.store[self.execution_id]['current_state'] = None
             self.store[self.execution_id]['result'] = result
         
+        def delete(self):
+            self.store.pop(self.execution_id, None)
+        
         def get_current_state_and_result(self):
             data = self.store[self.execution_id]
             return (data['current_state'], data['result']) 
 
 class LocalExecutionContextStore(components.ExecutionStore):
+    def __init__(self, blob_store=None, overflow_threshold=components.StateDataOverflow.DEFAULT_THRESHOLD, metrics=None):
+        self.overflow = components.StateDataOverflow(blob_store, overflow_threshold, metrics=metrics)
+    
     def execution_factory(self, execution_id, definition_store):
-        return self.Execution(execution_id, definition_store)
+        return self.Execution(execution_id, definition_store, self.overflow)
     
     class Execution(components.Execution):
-        def __init__(self, execution_id, definition_store):
+        def __init__(self, execution_id, definition_store, overflow=None):
             components.Execution.__init__(self, execution_id, definition_store)
             
+            self.overflow = overflow or components.StateDataOverflow()
+            
             self.current_state = None
             self.result = None
             self.definition_id = None
         
         def get_context(self):
             return {
-                components.Execution.CONTEXT_CURRENT_STATE_KEY: self.current_state.to_json(),
+                components.Execution.CONTEXT_CURRENT_STATE_KEY: self.overflow.state_to_json(self.execution_id, self.current_state),
                 components.Execution.CONTEXT_DEFINITION_ID_KEY: self.definition_id,
             }
         
         def hydrate(self, context):
-            self.current_state = components.State.from_json(context[self.CONTEXT_CURRENT_STATE_KEY])
+            self.current_state = self.overflow.state_from_json(context[self.CONTEXT_CURRENT_STATE_KEY])
             self.definition_id = context[self.CONTEXT_DEFINITION_ID_KEY]
         
         def initialize(self, definition):
@@ -136,6 +226,9 @@ class LocalExecutionContextStore(components.ExecutionStore):
         def update_state_data(self, data):
             self.current_state.data = data
         
+        def update_state_retries(self, retries):
+            self.current_state.retries = retries
+        
         def set_result(self, result):
             self.current_state = None
             self.result = result
@@ -143,7 +236,162 @@ class LocalExecutionContextStore(components.ExecutionStore):
         def get_current_state_and_result(self):
             return self.current_state, self.result
 
-class LocalLogger(components.ExecutorComponent):
+class FakeDynamoDBTable(object):
+    """In-memory stand-in for a boto3 DynamoDB Table resource, for the execution
+    store in tests and benchmarks. Supports put_item, get_item and delete_item,
+    with condition expressions made of attribute_exists, attribute_not_exists
+    and equality joined by AND, and counts the reads and writes made."""
+    def __init__(self, hash_key='state_machine_id', range_key='state_id'):
+        self.hash_key = hash_key
+        self.range_key = range_key
+        self.items = {}
+        self.lock = threading.Lock()
+        
+        self.reads = 0
+        self.writes = 0
+        self.condition_failures = 0
+    
+    def _key(self, key):
+        return (key[self.hash_key], key.get(self.range_key))
+    
+    def put_item(self, Item, ConditionExpression=None, ExpressionAttributeNames=None, ExpressionAttributeValues=None):
+        with self.lock:
+            self.writes += 1
+            key = self._key(Item)
+            self._check(self.items.get(key), ConditionExpression, ExpressionAttributeNames, ExpressionAttributeValues)
+            self.items[key] = dict(Item)
+        return {}
+    
+    def get_item(self, Key, ConsistentRead=False, ProjectionExpression=None):
+        with self.lock:
+            self.reads += 1
+            item = self.items.get(self._key(Key))
+        if item is None:
+            return {}
+        if ProjectionExpression is not None:
+            names = [name.strip() for name in ProjectionExpression.split(',')]
+            item = dict((name, item[name]) for name in names if name in item)
+        return {'Item': dict(item)}
+    
+    def delete_item(self, Key, ConditionExpression=None, ExpressionAttributeNames=None, ExpressionAttributeValues=None):
+        with self.lock:
+            self.writes += 1
+            key = self._key(Key)
+            self._check(self.items.get(key), ConditionExpression, ExpressionAttributeNames, ExpressionAttributeValues)
+            self.items.pop(key, None)
+        return {}
+    
+    _EXISTS = re.compile(r'attribute_(not_)?exists\((#?\w+)\)$')
+    _EQUALS = re.compile(r'(#?\w+)\s*=\s*(:\w+)$')
+    
+    def _check(self, item, expression, names, values):
+        if expression is None:
+            return
+        names = names or {}
+        values = values or {}
+        for clause in re.split(r'\s+AND\s+', expression.strip()):
+            match = self._EXISTS.match(clause)
+            if match:
+                exists = item is not None and names.get(match.group(2), match.group(2)) in item
+                ok = exists != bool(match.group(1))
+            else:
+                match = self._EQUALS.match(clause)
+                if not match:
+                    raise ValueError("Unsupported condition {!r}".format(clause))
+                name = names.get(match.group(1), match.group(1))
+                ok = item is not None and name in item and item[name] == values[match.group(2)]
+            if not ok:
+                self.condition_failures += 1
+                import botocore.exceptions
+                raise botocore.exceptions.ClientError(
+                    {'Error': {'Code': 'ConditionalCheckFailedException', 'Message': 'The conditional request failed'}},
+                    'ConditionCheck')
+    
+    def stats(self):
+        with self.lock:
+            return {
+                "items": len(self.items),
+                "reads": self.reads,
+                "writes": self.writes,
+                "condition_failures": self.condition_failures,
+            }
+
+class LocalFanInStore(components.FanInStore):
+    """In-memory stand-in for DynamoDBFanInStore, with the same atomicity.
+    Counts the writes the DynamoDB store would make."""
+    def __init__(self, blob_store=None, metrics=None):
+        self.fan_ins = {}
+        self.lock = threading.Lock()
+        self.writes = 0
+        if blob_store is not None:
+            self.overflow = components.StateDataOverflow(blob_store, self.OUTPUT_THRESHOLD, metrics=metrics)
+    
+    def create_fan_in(self, owner_id, fan_in_id, count, pending_inputs=None, owner_input=None):
+        pending_inputs = pending_inputs or []
+        with self.lock:
+            self.fan_ins[(owner_id, fan_in_id)] = {
+                'remaining': count,
+                'owner_input': owner_input,
+                'outputs': {},
+                'failed': None,
+                'next_index': count - len(pending_inputs),
+                'pending': dict((count - len(pending_inputs) + offset, input)
+                                for offset, input in enumerate(pending_inputs)),
+            }
+            self.writes += 1 + len(pending_inputs)
+    
+    def claim_pending(self, owner_id, fan_in_id):
+        with self.lock:
+            # a deleted fan-in behaves like DynamoDB's missing counter item, failing every condition
+            fan_in = self.fan_ins.get((owner_id, fan_in_id))
+            if fan_in is None or fan_in['failed'] is not None or not fan_in['pending']:
+                return None
+            index = fan_in['next_index']
+            fan_in['next_index'] += 1
+            self.writes += 2
+            return index, fan_in['pending'].pop(index)
+    
+    def record_output(self, owner_id, fan_in_id, index, output):
+        with self.lock:
+            fan_in = self.fan_ins.get((owner_id, fan_in_id))
+            self.writes += 2
+            if (fan_in is None or fan_in['failed'] is not None or index in fan_in['outputs']
+                    or fan_in['remaining'] <= 0):
+                return None
+            fan_in['outputs'][index] = output
+            fan_in['remaining'] -= 1
+            return fan_in['remaining']
+    
+    def record_failure(self, owner_id, fan_in_id, index, error):
+        with self.lock:
+            fan_in = self.fan_ins.get((owner_id, fan_in_id))
+            self.writes += 1
+            if fan_in is None or fan_in['failed'] is not None:
+                return False
+            fan_in['failed'] = error or True
+            return True
+    
+    def iter_outputs(self, owner_id, fan_in_id):
+        with self.lock:
+            outputs = self.fan_ins[(owner_id, fan_in_id)]['outputs']
+            indexes = sorted(outputs)
+        for index in indexes:
+            yield outputs[index]
+    
+    def get_owner_input(self, owner_id, fan_in_id):
+        with self.lock:
+            return self.fan_ins[(owner_id, fan_in_id)]['owner_input']
+    
+    def delete_fan_in(self, owner_id, fan_in_id):
+        with self.lock:
+            self.fan_ins.pop((owner_id, fan_in_id), None)
+
+class LocalLogger(components.Logger):
+    def __init__(self, execution_id=None, executor_id=None, level=components.Logger.INFO):
+        self.execution_id = execution_id
+        self.executor_id = executor_id
+        self.level = level
+    
     def get_context(self):
         return {}
     
@@ -156,38 +404,653 @@ class LocalLogger(components.ExecutorComponent):
     def initialize(self):
         pass
 
-class LocalLoggerFactory(object):
+class LocalLoggerFactory(components.LoggerFactory):
     def logger_factory(self, execution_id, executor_id):
-        return LocalLogger()
+        return LocalLogger(execution_id, executor_id, level=self.get_level(execution_id))
+
+_COMPONENT_LOGGER = None
+
+def component_logger():
+    """The logger for components that aren't tied to an execution, like stores and dispatchers.
+    Configured from the environment, like LocalLoggerFactory."""
+    global _COMPONENT_LOGGER
+    if _COMPONENT_LOGGER is None:
+        _COMPONENT_LOGGER = LocalLoggerFactory().logger_factory(None, None)
+    return _COMPONENT_LOGGER
+
+def set_component_logger(logger):
+    global _COMPONENT_LOGGER
+    _COMPONENT_LOGGER = logger
 
 class LocalTaskDispatcher(components.TaskDispatcher):
+    """Runs tasks in-process on a bounded pool of worker threads fed by a queue.
+    
+    resources maps Resource names to callables that take the task input and
+    return its output. A Resource ARN also matches the function name in it.
+    Resources that aren't registered run default_task, which by default
+    passes its input through, so control flow can be exercised on its own.
+    With fusion_steps, up to that many following Tasks for registered
+    resources run inline in the same hop, as with the decorator's task fusion.
+    Delayed dispatches (retries) and waiting executions are kept in a
+    TimerWheel, advanced by a single timer thread, not by the workers.
+    """
+    DEFAULT_WORKERS = 8
+    
     def __init__(self, executor_class,
                definition_store,
                execution_store,
-               logger_factory):
+               logger_factory,
+               fan_in_store=None,
+               resources=None,
+               workers=DEFAULT_WORKERS,
+               default_task=None,
+               exception_handler=None,
+               metrics=None,
+               fusion_steps=0):
         self.executor_class = executor_class
         
         self.definition_store=definition_store
         self.execution_store=execution_store
         self.logger_factory=logger_factory
+        self.fan_in_store=fan_in_store
+        self.metrics = metrics or components.NULL_METRICS
+        
+        self.resources = dict(resources or {})
+        self.default_task = default_task or (lambda input: input)
+        self.exception_handler = exception_handler or (lambda e: 'States.TaskFailed')
+        self.fusion_steps = fusion_steps
+        
+        self.workers = workers
+        self.queue = Queue.Queue()
+        self._threads = []
+        self._lock = threading.Lock()
+        
+        self._timers = TimerWheel()
+        self._timer_condition = threading.Condition()
+        self._timer_thread = None
+        
+        self.dispatched = 0
+        self.completed = 0
+        self.errors = 0
+        self.max_queue_depth = 0
+        self.first_dispatch_time = None
+        self.last_completion_time = None
+    
+    def register(self, resource, function):
+        self.resources[resource] = function
+    
+    def find_task(self, resource):
+        """Return the registered task for a resource, or None."""
+        if resource in self.resources:
+            return self.resources[resource]
+        if resource.startswith('arn:') and ':function:' in resource:
+            name = resource.split(':function:', 1)[1].split(':', 1)[0]
+            if name in self.resources:
+                return self.resources[name]
+        return None
+    
+    def get_task(self, resource):
+        return self.find_task(resource) or self.default_task
+    
+    def _start(self):
+        with self._lock:
+            while len(self._threads) < self.workers:
+                thread = threading.Thread(target=self._work)
+                thread.daemon = True
+                thread.start()
+                self._threads.append(thread)
     
     def dispatch(self, resource, input, context):
-        def task_thread():
-            executor_kwargs = {
-               "context": context,
-               "definition_store": self.definition_store,
-               "execution_store": self.execution_store,
-               "logger_factory": self.logger_factory,
-               "task_dispatcher": self,
+        self._enqueue(resource, input, context)
+        if self.metrics.enabled:
+            self.metrics.increment('Dispatches', dimensions={"Resource": resource})
+    
+    def _enqueue(self, resource, input, context):
+        if len(self._threads) < self.workers:
+            self._start()
+        self.queue.put((resource, input, context))
+        with self._lock:
+            self.dispatched += 1
+            if self.first_dispatch_time is None:
+                self.first_dispatch_time = time.time()
+            self.max_queue_depth = max(self.max_queue_depth, self.queue.qsize())
+    
+    def can_schedule(self):
+        return True
+    
+    def dispatch_later(self, resource, input, context, delay):
+        if delay <= 0:
+            return self.dispatch(resource, input, context)
+        self._schedule(delay, (resource, input, context))
+    
+    def resume_later(self, input, context, delay):
+        # a resource of None resumes the execution instead of running a task
+        self._schedule(delay, (None, input, context))
+    
+    def _schedule(self, delay, dispatch):
+        with self._timer_condition:
+            self._timers.schedule(delay, dispatch, now=time.time())
+            if self._timer_thread is None:
+                self._timer_thread = threading.Thread(target=self._run_timers)
+                self._timer_thread.daemon = True
+                self._timer_thread.start()
+            self._timer_condition.notify_all()
+    
+    def _run_timers(self):
+        with self._timer_condition:
+            while True:
+                if not self._timers:
+                    self._timer_condition.wait()
+                    continue
+                self._timer_condition.wait(self._timers.tick)
+                for resource, input, context in self._timers.advance(time.time()):
+                    if resource is None:
+                        self._enqueue(resource, input, context)
+                    else:
+                        self.dispatch(resource, input, context)
+                self._timer_condition.notify_all()
+    
+    def _work(self):
+        while True:
+            resource, input, context = self.queue.get()
+            try:
+                self._run(resource, input, context)
+            except Exception:
+                with self._lock:
+                    self.errors += 1
+                self.metrics.increment('DispatchErrors', dimensions={"Resource": resource})
+                traceback.print_exc()
+            finally:
+                with self._lock:
+                    self.completed += 1
+                    self.last_completion_time = time.time()
+                self.queue.task_done()
+    
+    def _run(self, resource, input, context):
+        if resource is None:
+            return self._resume(input, context)
+        
+        executor_kwargs = {
+           "context": context,
+           "definition_store": self.definition_store,
+           "execution_store": self.execution_store,
+           "logger_factory": self.logger_factory,
+           "task_dispatcher": self,
+           "fan_in_store": self.fan_in_store,
+           "metrics": self.metrics,
+        }
+        
+        logger = component_logger()
+        logger.debug('task started', resource=resource)
+        executor = self.executor_class.hydrate(**executor_kwargs)
+        input = executor.task_input(input)
+        
+        task = self.get_task(resource)
+        task_runner = lambda: task(copy_task_input(input))
+        
+        fusion = None
+        if self.fusion_steps:
+            fusion = TaskFusion(self.find_task, max_steps=self.fusion_steps)
+        
+        try:
+            executor.run_task(task_runner, self.exception_handler, fusion=fusion, task_input=input)
+        finally:
+            executor.logger.flush()
+        logger.debug('task finished', resource=resource)
+    
+    def _resume(self, output, context):
+        executor = self.executor_class.hydrate(context,
+            definition_store=self.definition_store,
+            execution_store=self.execution_store,
+            logger_factory=self.logger_factory,
+            task_dispatcher=self,
+            fan_in_store=self.fan_in_store,
+            metrics=self.metrics)
+        try:
+            executor.resume(output)
+        finally:
+            executor.logger.flush()
+    
+    def join(self):
+        """Wait until every dispatched task, including ones dispatched by other tasks
+        or scheduled for later, has run."""
+        while True:
+            self.queue.join()
+            with self._timer_condition:
+                if not self._timers:
+                    return
+                # a timer is moved onto the queue before it leaves the heap
+                while self._timers:
+                    self._timer_condition.wait()
+    
+    def stats(self):
+        with self._lock:
+            elapsed = None
+            if self.first_dispatch_time is not None and self.last_completion_time is not None:
+                elapsed = self.last_completion_time - self.first_dispatch_time
+            return {
+                "dispatched": self.dispatched,
+                "completed": self.completed,
+                "errors": self.errors,
+                "queue_depth": self.queue.qsize(),
+                "scheduled": len(self._timers),
+                "max_queue_depth": self.max_queue_depth,
+                "workers": len(self._threads),
+                "throughput": self.completed / elapsed if elapsed else None,
             }
+
+class TimerWheel(object):
+    """Hierarchical timing wheel: levels of slots, each slot of a level spanning
+    a whole turn of the level below. Scheduling and expiring a timer are
+    constant time, whatever the number of timers, and a timer is just an entry
+    in a slot's list, so hundreds of thousands of waiting executions cost little
+    memory and no work until they are due. Timers are due on the first tick
+    at or after their time; ticks are tick seconds apart. Timers beyond the top
+    level's range are put in its last slot and rescheduled when it comes round.
+    Not thread safe."""
+    DEFAULT_TICK = 0.05
+    DEFAULT_SLOTS = 64
+    DEFAULT_LEVELS = 4
+    
+    def __init__(self, tick=DEFAULT_TICK, slots=DEFAULT_SLOTS, levels=DEFAULT_LEVELS, start_time=None):
+        self.tick = tick
+        self.slots = slots
+        self.levels = levels
+        self.start_time = start_time
+        self.current_tick = 0
+        self._wheels = [[[] for _ in xrange(slots)] for _ in xrange(levels)]
+        self._spans = [slots ** level for level in xrange(levels + 1)]
+        self._count = 0
+    
+    def __len__(self):
+        return self._count
+    
+    def _tick_for(self, when):
+        return int(math.ceil((when - self.start_time) / self.tick))
+    
+    def schedule(self, delay, item, now=None):
+        """Schedule item to be returned by advance() once delay seconds after now have passed."""
+        now = time.time() if now is None else now
+        if self.start_time is None:
+            self.start_time = now
+            self.current_tick = 0
+        expiry = max(self._tick_for(now + delay), self.current_tick + 1)
+        self._insert(expiry, item)
+        self._count += 1
+    
+    def _insert(self, expiry, item):
+        remaining = expiry - self.current_tick
+        level = 0
+        while level < self.levels - 1 and remaining >= self._spans[level + 1]:
+            level += 1
+        if remaining >= self._spans[self.levels]:
+            # further out than the wheel reaches: park it in the slot that comes round last
+            slot = (self.current_tick // self._spans[level]) % self.slots
+        else:
+            slot = (expiry // self._spans[level]) % self.slots
+        self._wheels[level][slot].append((expiry, item))
+    
+    def advance(self, now=None):
+        """Move the wheel to now, returning the items that have become due, in order of expiry."""
+        now = time.time() if now is None else now
+        if self.start_time is None:
+            return []
+        target = int((now - self.start_time) / self.tick)
+        due = []
+        while self.current_tick < target:
+            if not self._count:
+                self.current_tick = target
+                break
+            self.current_tick += 1
+            tick = self.current_tick
+            if tick % self.slots == 0:
+                self._cascade(tick)
+            slot = self._wheels[0][tick % self.slots]
+            if slot:
+                self._wheels[0][tick % self.slots] = []
+                for expiry, item in slot:
+                    if expiry <= tick:
+                        due.append((expiry, item))
+                    else:
+                        self._insert(expiry, item)
+        self._count -= len(due)
+        due.sort(key=lambda entry: entry[0])
+        return [item for _, item in due]
+    
+    def _cascade(self, tick):
+        """Redistribute the timers of the higher level slots that start at tick."""
+        for level in xrange(1, self.levels):
+            index = (tick // self._spans[level]) % self.slots
+            slot, self._wheels[level][index] = self._wheels[level][index], []
+            for expiry, item in slot:
+                self._insert(expiry, item)
+            if index != 0:
+                break
+
+class Histogram(object):
+    """Count, sum, min and max of observed values, plus counts in logarithmic
+    buckets (each about 9% wide) for estimating percentiles. Histograms of the
+    same metric from different processes can be merged."""
+    BUCKETS_PER_DOUBLING = 8
+    
+    def __init__(self):
+        self.count = 0
+        self.sum = 0.
+        self.min = None
+        self.max = None
+        self.buckets = collections.Counter()
+    
+    def _bucket(self, value):
+        if value <= 0:
+            return None
+        return int(math.floor(math.log(value, 2) * self.BUCKETS_PER_DOUBLING))
+    
+    def _bucket_value(self, bucket):
+        if bucket is None:
+            return 0.
+        return 2 ** ((bucket + 0.5) / self.BUCKETS_PER_DOUBLING)
+    
+    def observe(self, value):
+        self.count += 1
+        self.sum += value
+        self.min = value if self.min is None else min(self.min, value)
+        self.max = value if self.max is None else max(self.max, value)
+        self.buckets[self._bucket(value)] += 1
+    
+    def merge(self, other):
+        self.count += other.count
+        self.sum += other.sum
+        for value in (other.min, other.max):
+            if value is not None:
+                self.min = value if self.min is None else min(self.min, value)
+                self.max = value if self.max is None else max(self.max, value)
+        self.buckets.update(other.buckets)
+    
+    @property
+    def mean(self):
+        return self.sum / self.count if self.count else None
+    
+    def percentile(self, p):
+        """Estimate the value below which p percent of the observations fall."""
+        if not self.count:
+            return None
+        rank = p / 100. * self.count
+        seen = 0
+        for bucket in sorted(self.buckets, key=lambda b: -1 if b is None else b):
+            seen += self.buckets[bucket]
+            if seen >= rank:
+                return min(max(self._bucket_value(bucket), self.min), self.max)
+        return self.max
+    
+    def to_json(self):
+        return {
+            "Count": self.count,
+            "Sum": self.sum,
+            "Min": self.min,
+            "Max": self.max,
+            "Mean": self.mean,
+            "P50": self.percentile(50),
+            "P90": self.percentile(90),
+            "P99": self.percentile(99),
+        }
+
+class MetricsRegistry(components.MetricsSink):
+    """In-memory metrics sink, for tests and local runs. Counters and histograms
+    are kept per metric name and dimensions, and can be read back, or totaled
+    across dimensions."""
+    def __init__(self):
+        self.counters = collections.Counter()
+        self.histograms = {}
+        self.units = {}
+        self._lock = threading.Lock()
+    
+    @classmethod
+    def _key(cls, name, dimensions):
+        return (name, tuple(sorted(dimensions.iteritems())) if dimensions else ())
+    
+    def increment(self, name, value=1, dimensions=None):
+        key = self._key(name, dimensions)
+        with self._lock:
+            self.counters[key] += value
+    
+    def observe(self, name, value, unit=components.MetricsSink.UNIT_MILLISECONDS, dimensions=None):
+        key = self._key(name, dimensions)
+        with self._lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram()
+                self.units[name] = unit
+            histogram.observe(value)
+    
+    def counter(self, name, **dimensions):
+        return self.counters[self._key(name, dimensions)]
+    
+    def histogram(self, name, **dimensions):
+        return self.histograms.get(self._key(name, dimensions))
+    
+    def total(self, name):
+        """The sum of a counter over all its dimensions."""
+        with self._lock:
+            return sum(value for (n, _), value in self.counters.iteritems() if n == name)
+    
+    def merged_histogram(self, name):
+        """A histogram of all the observations of a metric, over all its dimensions."""
+        merged = Histogram()
+        with self._lock:
+            for (n, _), histogram in self.histograms.iteritems():
+                if n == name:
+                    merged.merge(histogram)
+        return merged
+    
+    def reset(self):
+        with self._lock:
+            self.counters.clear()
+            self.histograms.clear()
+    
+    def snapshot(self):
+        with self._lock:
+            metrics = []
+            for (name, dimensions), value in sorted(self.counters.iteritems()):
+                metrics.append({
+                    "Name": name,
+                    "Dimensions": dict(dimensions),
+                    "Unit": components.MetricsSink.UNIT_COUNT,
+                    "Value": value,
+                })
+            for (name, dimensions), histogram in sorted(self.histograms.iteritems()):
+                metric = histogram.to_json()
+                metric.update({
+                    "Name": name,
+                    "Dimensions": dict(dimensions),
+                    "Unit": self.units.get(name),
+                })
+                metrics.append(metric)
+            return metrics
+
+class FakeServer(object):
+    """A local HTTP endpoint for an AWS service, answering POSTs with handle()."""
+    def __init__(self):
+        fake = self
+        
+        class RequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
             
-            print '\ntask thread started for resource', resource
-            executor = self.executor_class.hydrate(**executor_kwargs)
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers.getheader('content-length') or 0))
+                status, result = fake.handle(self.path, self.headers, body)
+                self._respond(status, result)
             
-            task_runner = lambda: time.sleep(2)
-            exception_handler = lambda e: 'States.TaskFailed'
+            def _respond(self, status, result):
+                body = json.dumps(result) if result is not None else ''
+                self.send_response(status)
+                self.send_header('Content-Type', fake.CONTENT_TYPE)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
             
-            executor.run_task(task_runner, exception_handler)
-            print 'task thread finished for resource', resource
+            def log_message(self, *args):
+                pass
+        
+        class Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+            daemon_threads = True
+        
+        self.server = Server(('127.0.0.1', 0), RequestHandler)
+        self.thread = None
+    
+    CONTENT_TYPE = 'application/json'
+    
+    def handle(self, path, headers, body):
+        raise NotImplementedError
+    
+    @property
+    def endpoint_url(self):
+        return 'http://{}:{}'.format(*self.server.server_address)
+    
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+    
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+class FakeLambdaServer(FakeServer):
+    """A local HTTP endpoint that accepts Lambda Invoke calls, for exercising
+    LambdaTaskDispatcher without AWS. Pass endpoint_url to the dispatcher.
+    
+    Invocations are recorded with their decoded heaviside context. If a handler
+    is registered for the function name, it is called with (input, context)
+    and its return value is the RequestResponse result.
+    """
+    INVOKE_PATH = re.compile(r'^/2015-03-31/functions/([^/]+)/invocations')
+    
+    def __init__(self, handlers=None, latency=0):
+        super(FakeLambdaServer, self).__init__()
+        self.handlers = handlers or {}
+        self.latency = latency
+        self.invocations = []
+        self._lock = threading.Lock()
+    
+    def handle(self, path, headers, body):
+        match = self.INVOKE_PATH.match(path)
+        if not match:
+            return 404, {'Message': 'Unknown path {}'.format(path)}
+        return self._invoke(
+            match.group(1),
+            headers.getheader('x-amz-invocation-type') or 'RequestResponse',
+            body,
+            headers.getheader('x-amz-client-context'))
+    
+    def _invoke(self, function_name, invocation_type, body, client_context):
+        if self.latency:
+            time.sleep(self.latency)
+        input, custom = codec.unwrap_payload(json.loads(body) if body else None)
+        if custom is None and client_context:
+            custom = json.loads(base64.b64decode(client_context)).get('custom')
+        context = codec.decode_context(custom) if custom is not None else None
+        with self._lock:
+            self.invocations.append({
+                'FunctionName': function_name,
+                'InvocationType': invocation_type,
+                'Input': input,
+                'Context': context,
+            })
+        handler = self.handlers.get(function_name)
+        result = handler(input, context) if handler else None
+        if invocation_type == 'Event':
+            return 202, None
+        return 200, result
+
+class FakeLogsServer(FakeServer):
+    """A local HTTP endpoint for the CloudWatch Logs calls BufferedCloudWatchLogger
+    makes: CreateLogGroup, CreateLogStream and PutLogEvents. Pass endpoint_url
+    to CloudWatchLoggerFactory.
+    
+    It enforces the batch limits, event ordering and sequence tokens like the
+    service does, and counts calls by operation, so batching can be checked.
+    Events are kept in streams[(group, stream)].
+    """
+    CONTENT_TYPE = 'application/x-amz-json-1.1'
+    
+    MAX_BATCH_EVENTS = 10000
+    MAX_BATCH_BYTES = 1048576
+    EVENT_OVERHEAD_BYTES = 26
+    
+    def __init__(self):
+        super(FakeLogsServer, self).__init__()
+        self.groups = set()
+        self.streams = {}
+        self.calls = collections.Counter()
+        self._tokens = {}
+        self._last_batches = {}
+        self._next_token = 1
+        self._lock = threading.Lock()
+    
+    def handle(self, path, headers, body):
+        operation = (headers.getheader('x-amz-target') or '').split('.')[-1]
+        request = json.loads(body) if body else {}
+        with self._lock:
+            self.calls[operation] += 1
+            method = getattr(self, '_' + operation, None)
+            if method is None:
+                return self._error('UnknownOperationException', operation)
+            return method(request)
+    
+    def _error(self, error_type, message, **fields):
+        body = {'__type': error_type, 'message': message}
+        body.update(fields)
+        return 400, body
+    
+    def _CreateLogGroup(self, request):
+        name = request['logGroupName']
+        if name in self.groups:
+            return self._error('ResourceAlreadyExistsException', 'The specified log group already exists')
+        self.groups.add(name)
+        return 200, {}
+    
+    def _CreateLogStream(self, request):
+        key = (request['logGroupName'], request['logStreamName'])
+        if key[0] not in self.groups:
+            return self._error('ResourceNotFoundException', 'The specified log group does not exist.')
+        if key in self.streams:
+            return self._error('ResourceAlreadyExistsException', 'The specified log stream already exists')
+        self.streams[key] = []
+        self._tokens[key] = None
+        return 200, {}
+    
+    def _PutLogEvents(self, request):
+        key = (request['logGroupName'], request['logStreamName'])
+        if key not in self.streams:
+            return self._error('ResourceNotFoundException', 'The specified log stream does not exist.')
+        
+        events = request['logEvents']
+        size = sum(len(e['message'].encode('utf-8')) + self.EVENT_OVERHEAD_BYTES for e in events)
+        if not events or len(events) > self.MAX_BATCH_EVENTS or size > self.MAX_BATCH_BYTES:
+            return self._error('InvalidParameterException',
+                               'Batch of {} events, {} bytes is outside the limits'.format(len(events), size))
+        timestamps = [e['timestamp'] for e in events]
+        if timestamps != sorted(timestamps):
+            return self._error('InvalidParameterException',
+                               'Log events in a single PutLogEvents request must be in chronological order.')
+        
+        token = request.get('sequenceToken')
+        expected = self._tokens[key]
+        last_batch = self._last_batches.get(key)
+        if last_batch is not None and last_batch == (token, events):
+            return self._error('DataAlreadyAcceptedException',
+                               'The given batch of log events has already been accepted. '
+                               'The next batch can be sent with sequenceToken: {}'.format(expected or 'null'),
+                               expectedSequenceToken=expected)
+        if token != expected:
+            return self._error('InvalidSequenceTokenException',
+                               'The given sequenceToken is invalid. '
+                               'The next expected sequenceToken is: {}'.format(expected or 'null'),
+                               expectedSequenceToken=expected)
         
-        threading.Thread(target=task_thread).start()
+        self.streams[key].extend(events)
+        self._last_batches[key] = (token, events)
+        self._tokens[key] = '{:056d}'.format(self._next_token)
+        self._next_token += 1
+        return 200, {'nextSequenceToken': self._tokens[key]}
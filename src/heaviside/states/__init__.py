@@ -2,22 +2,28 @@
 Classes to represent state machine definitions in the states language. https://states-language.net/spec.html
 """
 
+import copy
 import json
 import hashlib
 
+from .paths import compile_path
+from .choices import parse_timestamp
+from . import dataflow
+
 class StateMachine(object):
     @classmethod
     def from_json(cls, obj):
         if isinstance(obj, basestring):
             obj = json.loads(obj)
-        return cls(
+        machine = cls(
             states = dict((key, state_from_json(value)) for key, value in obj["States"].iteritems()),
             start_at = obj["StartAt"],
             comment = obj.get("Comment"),
             version = obj.get("Version"),
             timeout_seconds = obj.get("TimeoutSeconds"),
         )
-        
+        machine.compile()
+        return machine
     
     def __init__(self, states, start_at, comment=None, version=None, timeout_seconds=None):
         self.states = states
@@ -25,6 +31,34 @@ class StateMachine(object):
         self.comment = comment
         self.version = version or "1.0"
         self.timeout_seconds = timeout_seconds
+        
+        self._compiled = None
+        self._hash = None
+    
+    def compile(self):
+        """Return the compiled form of this definition, building it on first use.
+        It is kept on the definition, so cached definitions are never recompiled."""
+        if self._compiled is None:
+            from .compiled import CompiledStateMachine
+            self._compiled = CompiledStateMachine(self)
+        return self._compiled
+    
+    def __getstate__(self):
+        # the compiled form is made of closures; it is rebuilt when the definition is next compiled
+        state = self.__dict__.copy()
+        state['_compiled'] = None
+        return state
+    
+    def needs_scheduling(self):
+        """Whether the definition, or a branch of it, has Wait states or Retry
+        fields, which need a task dispatcher that can schedule."""
+        for state in self.states.itervalues():
+            if state.type == "Wait" or getattr(state, 'retry', None):
+                return True
+            branches = getattr(state, 'branches', None) or [getattr(state, 'iterator', None)]
+            if any(branch is not None and branch.needs_scheduling() for branch in branches):
+                return True
+        return False
     
     def to_json(self):
         data = {
@@ -38,20 +72,42 @@ class StateMachine(object):
             data["TimeoutSeconds"] = self.timeout_seconds
         return data
     
+    def get_canonical_json(self):
+        """Serialize with sorted keys and no whitespace, so equivalent definitions serialize identically."""
+        return json.dumps(self.to_json(), sort_keys=True, separators=(',', ':'))
+    
     def get_hash(self):
-        json_str = json.dumps(self.to_json())
-        hasher = hashlib.sha256()
-        hasher.update(json_str)
-        return hasher.hexdigest()
+        """Content hash of the canonical serialization. Computed once, as definitions are not modified after creation."""
+        if self._hash is None:
+            hasher = hashlib.sha256()
+            hasher.update(self.get_canonical_json())
+            self._hash = hasher.hexdigest()
+        return self._hash
 
 class State(object):
     @classmethod
     def from_json(cls, obj):
         raise NotImplementedError
     
-    def __init__(self, type, comment=None):
+    def __init__(self, type, comment=None, io_fields=None):
+        """io_fields are the InputPath, Parameters, ResultSelector, ResultPath
+        and OutputPath fields the state has, as in its JSON."""
         self.type = type
         self.comment = comment
+        self.io_fields = io_fields or {}
+        self._io = None
+    
+    @property
+    def io(self):
+        """The compiled input and output processing of the state."""
+        if self._io is None:
+            self._io = dataflow.compile_io(self.io_fields)
+        return self._io
+    
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_io'] = None
+        return state
     
     def is_end(self):
         raise NotImplementedError
@@ -62,9 +118,16 @@ class State(object):
         }
         if self.comment is not None:
             data["Comment"] = self.comment
+        data.update(self.io_fields)
         return data
 
 class Catcher(object):
+    @classmethod
+    def from_json(cls, obj):
+        if isinstance(obj, Catcher):
+            return obj
+        return cls(obj["ErrorEquals"], obj["Next"], result_path=obj.get("ResultPath", dataflow.ROOT))
+    
     @classmethod
     def TaskFailed(cls, next):
         return cls(["States.TaskFailed"], next)
@@ -73,12 +136,78 @@ class Catcher(object):
     def ALL(cls, next):
         return cls(["States.ALL"], next)
     
-    def __init__(self, error_equals, next):
+    def __init__(self, error_equals, next, result_path=dataflow.ROOT):
+        """result_path is where the error output goes in the state's input;
+        by default it replaces it, and None discards it."""
         self.error_equals = error_equals
         self.next = next
+        self.result_path = result_path
+    
+    def matches(self, error):
+        return error in self.error_equals or 'States.ALL' in self.error_equals
+    
+    def to_json(self):
+        data = {
+            "ErrorEquals": self.error_equals,
+            "Next": self.next,
+        }
+        if self.result_path != dataflow.ROOT:
+            data["ResultPath"] = self.result_path
+        return data
+
+class Retrier(object):
+    JITTER_NONE = "NONE"
+    JITTER_FULL = "FULL"
+    
+    @classmethod
+    def from_json(cls, obj):
+        if isinstance(obj, Retrier):
+            return obj
+        return cls(obj["ErrorEquals"],
+                   interval_seconds = obj.get("IntervalSeconds", 1),
+                   max_attempts = obj.get("MaxAttempts", 3),
+                   backoff_rate = obj.get("BackoffRate", 2.0),
+                   max_delay_seconds = obj.get("MaxDelaySeconds"),
+                   jitter_strategy = obj.get("JitterStrategy"))
+    
+    def __init__(self, error_equals, interval_seconds=1, max_attempts=3, backoff_rate=2.0,
+                 max_delay_seconds=None, jitter_strategy=None):
+        """With jitter_strategy FULL, each delay is drawn uniformly between 0 and
+        the backed-off interval, so retries of many executions don't line up."""
+        if jitter_strategy not in (None, self.JITTER_NONE, self.JITTER_FULL):
+            raise ValueError("Unknown JitterStrategy {}".format(jitter_strategy))
+        self.error_equals = error_equals
+        self.interval_seconds = interval_seconds
+        self.max_attempts = max_attempts
+        self.backoff_rate = backoff_rate
+        self.max_delay_seconds = max_delay_seconds
+        self.jitter_strategy = jitter_strategy
     
     def matches(self, error):
         return error in self.error_equals or 'States.ALL' in self.error_equals
+    
+    def get_delay(self, attempt, jitter=None):
+        """The seconds to wait before retry number attempt (counting from 0).
+        jitter is a number in [0, 1), used with the FULL jitter strategy."""
+        delay = self.interval_seconds * self.backoff_rate ** attempt
+        if self.max_delay_seconds is not None:
+            delay = min(delay, self.max_delay_seconds)
+        if self.jitter_strategy == self.JITTER_FULL and jitter is not None:
+            delay *= jitter
+        return delay
+    
+    def to_json(self):
+        data = {
+            "ErrorEquals": self.error_equals,
+            "IntervalSeconds": self.interval_seconds,
+            "MaxAttempts": self.max_attempts,
+            "BackoffRate": self.backoff_rate,
+        }
+        if self.max_delay_seconds is not None:
+            data["MaxDelaySeconds"] = self.max_delay_seconds
+        if self.jitter_strategy is not None:
+            data["JitterStrategy"] = self.jitter_strategy
+        return data
 
 class TaskState(State):
     @classmethod
@@ -88,14 +217,31 @@ class TaskState(State):
         return cls(
             obj["Resource"],
             obj.get("Next"),
-            catch = obj.get("Catch"),
-            comment = obj.get("Comment"))
+            catch = [Catcher.from_json(c) for c in obj["Catch"]] if obj.get("Catch") is not None else None,
+            retry = [Retrier.from_json(r) for r in obj["Retry"]] if obj.get("Retry") is not None else None,
+            timeout_seconds = obj.get("TimeoutSeconds"),
+            heartbeat_seconds = obj.get("HeartbeatSeconds"),
+            comment = obj.get("Comment"),
+            io_fields = dataflow.get_fields(obj, dataflow.ALL_FIELDS))
     
-    def __init__(self, resource, next, catch=None, comment=None):
-        super(TaskState, self).__init__("Task", comment=comment)
+    def __init__(self, resource, next, catch=None, retry=None, timeout_seconds=None, heartbeat_seconds=None,
+                 comment=None, io_fields=None):
+        super(TaskState, self).__init__("Task", comment=comment, io_fields=io_fields)
+        if (timeout_seconds is not None and heartbeat_seconds is not None
+                and heartbeat_seconds >= timeout_seconds):
+            raise ValueError("HeartbeatSeconds must be smaller than TimeoutSeconds")
         self.resource = resource
         self.next = next
         self.catch = catch
+        self.retry = retry
+        self.timeout_seconds = timeout_seconds
+        self.heartbeat_seconds = heartbeat_seconds
+    
+    def get_time_limit(self):
+        """The seconds the task may run, or None. Tasks run to completion within a
+        hop and can't send heartbeats, so HeartbeatSeconds also bounds them."""
+        limits = [limit for limit in (self.timeout_seconds, self.heartbeat_seconds) if limit is not None]
+        return min(limits) if limits else None
     
     def is_end(self):
         return self.next is None
@@ -108,7 +254,140 @@ class TaskState(State):
         else:
             data["Next"] = self.next
         if self.catch is not None:
-            data["Catch"] = self.catch
+            data["Catch"] = [catcher.to_json() for catcher in self.catch]
+        if self.retry is not None:
+            data["Retry"] = [retrier.to_json() for retrier in self.retry]
+        if self.timeout_seconds is not None:
+            data["TimeoutSeconds"] = self.timeout_seconds
+        if self.heartbeat_seconds is not None:
+            data["HeartbeatSeconds"] = self.heartbeat_seconds
+        return data
+
+class ParallelState(State):
+    @classmethod
+    def from_json(cls, obj):
+        if obj["Type"] != "Parallel":
+            raise TypeError("Data is not a Parallel state")
+        return cls(
+            [StateMachine.from_json(branch) for branch in obj["Branches"]],
+            obj.get("Next"),
+            catch = [Catcher.from_json(c) for c in obj["Catch"]] if obj.get("Catch") is not None else None,
+            comment = obj.get("Comment"),
+            io_fields = dataflow.get_fields(obj, dataflow.ALL_FIELDS))
+    
+    def __init__(self, branches, next, catch=None, comment=None, io_fields=None):
+        super(ParallelState, self).__init__("Parallel", comment=comment, io_fields=io_fields)
+        self.branches = branches
+        self.next = next
+        self.catch = catch
+    
+    def is_end(self):
+        return self.next is None
+    
+    def branch_definition(self, index):
+        return self.branches[index]
+    
+    def collate_outputs(self, outputs):
+        """Return an iterator of the state's result items, from an iterator of the branch outputs."""
+        return outputs
+    
+    def to_json(self):
+        data = super(ParallelState, self).to_json()
+        data["Branches"] = [branch.to_json() for branch in self.branches]
+        if self.next is None:
+            data["End"] = True
+        else:
+            data["Next"] = self.next
+        if self.catch is not None:
+            data["Catch"] = [catcher.to_json() for catcher in self.catch]
+        return data
+
+class MapState(State):
+    """Runs the Iterator state machine over each item of the input array.
+    
+    MaxConcurrency bounds how many iterations run at once (0 means no bound).
+    With ItemBatcher.MaxItemsPerBatch, each iteration gets a batch of items as
+    {"Items": [...]} instead of a single item, and is expected to output an
+    array; the batch outputs are concatenated.
+    """
+    @classmethod
+    def from_json(cls, obj):
+        if obj["Type"] != "Map":
+            raise TypeError("Data is not a Map state")
+        for field in ("Parameters", "ItemSelector"):
+            # they apply to each item; ignoring them would run the definition differently
+            if field in obj:
+                raise ValueError("{} is not supported on Map states".format(field))
+        iterator = obj.get("Iterator", obj.get("ItemProcessor"))
+        return cls(
+            StateMachine.from_json(iterator),
+            obj.get("Next"),
+            items_path = obj.get("ItemsPath"),
+            max_concurrency = obj.get("MaxConcurrency"),
+            max_items_per_batch = obj.get("ItemBatcher", {}).get("MaxItemsPerBatch"),
+            catch = [Catcher.from_json(c) for c in obj["Catch"]] if obj.get("Catch") is not None else None,
+            comment = obj.get("Comment"),
+            io_fields = dataflow.get_fields(obj, dataflow.MAP_FIELDS))
+    
+    def __init__(self, iterator, next, items_path=None, max_concurrency=None, max_items_per_batch=None,
+                 catch=None, comment=None, io_fields=None):
+        super(MapState, self).__init__("Map", comment=comment, io_fields=io_fields)
+        self.iterator = iterator
+        self.next = next
+        self.items_path = items_path
+        self.max_concurrency = max_concurrency
+        self.max_items_per_batch = max_items_per_batch
+        self.catch = catch
+    
+    def is_end(self):
+        return self.next is None
+    
+    def branch_definition(self, index):
+        return self.iterator
+    
+    def get_items(self, input):
+        items = input
+        if self.items_path is not None:
+            items = compile_path(self.items_path).get(input)
+        if not isinstance(items, list):
+            raise ValueError("Map input is not an array")
+        return items
+    
+    def get_iteration_inputs(self, input):
+        items = self.get_items(input)
+        if not self.max_items_per_batch:
+            return items
+        size = self.max_items_per_batch
+        return [{"Items": items[start:start + size]} for start in xrange(0, len(items), size)]
+    
+    def collate_outputs(self, outputs):
+        if not self.max_items_per_batch:
+            return outputs
+        return self._flatten_batches(outputs)
+    
+    def _flatten_batches(self, outputs):
+        for output in outputs:
+            if isinstance(output, list):
+                for item in output:
+                    yield item
+            else:
+                yield output
+    
+    def to_json(self):
+        data = super(MapState, self).to_json()
+        data["Iterator"] = self.iterator.to_json()
+        if self.items_path is not None:
+            data["ItemsPath"] = self.items_path
+        if self.max_concurrency is not None:
+            data["MaxConcurrency"] = self.max_concurrency
+        if self.max_items_per_batch is not None:
+            data["ItemBatcher"] = {"MaxItemsPerBatch": self.max_items_per_batch}
+        if self.next is None:
+            data["End"] = True
+        else:
+            data["Next"] = self.next
+        if self.catch is not None:
+            data["Catch"] = [catcher.to_json() for catcher in self.catch]
         return data
 
 class SucceedState(State):
@@ -117,10 +396,11 @@ class SucceedState(State):
         if obj["Type"] != "Succeed":
             raise TypeError("Data is not a Succeed state")
         return cls(
-            comment = obj.get("Comment"))
+            comment = obj.get("Comment"),
+            io_fields = dataflow.get_fields(obj, dataflow.INPUT_OUTPUT_FIELDS))
     
-    def __init__(self, comment=None):
-        super(SucceedState, self).__init__("Succeed", comment=comment)
+    def __init__(self, comment=None, io_fields=None):
+        super(SucceedState, self).__init__("Succeed", comment=comment, io_fields=io_fields)
     
     def is_end(self):
         return True
@@ -153,6 +433,142 @@ class FailState(State):
         data["Cause"] = self.cause
         return data
 
+class PassState(State):
+    """Passes its input to its output, or outputs Result if it has one,
+    subject to the usual path processing."""
+    @classmethod
+    def from_json(cls, obj):
+        if obj["Type"] != "Pass":
+            raise TypeError("Data is not a Pass state")
+        return cls(
+            obj.get("Next"),
+            result = obj.get("Result"),
+            has_result = "Result" in obj,
+            comment = obj.get("Comment"),
+            io_fields = dataflow.get_fields(obj, dataflow.PASS_FIELDS))
+    
+    def __init__(self, next, result=None, has_result=None, comment=None, io_fields=None):
+        super(PassState, self).__init__("Pass", comment=comment, io_fields=io_fields)
+        self.next = next
+        self.result = result
+        self.has_result = has_result if has_result is not None else result is not None
+    
+    def is_end(self):
+        return self.next is None
+    
+    def get_result(self, input):
+        """The result of the state, for its effective input. Result is copied, so
+        nothing downstream can change the definition."""
+        return copy.deepcopy(self.result) if self.has_result else input
+    
+    def to_json(self):
+        data = super(PassState, self).to_json()
+        if self.has_result:
+            data["Result"] = self.result
+        if self.next is None:
+            data["End"] = True
+        else:
+            data["Next"] = self.next
+        return data
+
+class ChoiceState(State):
+    """Goes to the Next of the first of its Choices rules that matches the input,
+    or to Default. The rules are kept as JSON and compiled with the definition."""
+    @classmethod
+    def from_json(cls, obj):
+        if obj["Type"] != "Choice":
+            raise TypeError("Data is not a Choice state")
+        return cls(
+            obj["Choices"],
+            default = obj.get("Default"),
+            comment = obj.get("Comment"),
+            io_fields = dataflow.get_fields(obj, dataflow.INPUT_OUTPUT_FIELDS))
+    
+    def __init__(self, choices, default=None, comment=None, io_fields=None):
+        super(ChoiceState, self).__init__("Choice", comment=comment, io_fields=io_fields)
+        if not choices:
+            raise ValueError("Choice state has no Choices")
+        self.choices = choices
+        self.default = default
+    
+    def is_end(self):
+        return False
+    
+    def get_targets(self):
+        targets = [rule["Next"] for rule in self.choices]
+        if self.default is not None:
+            targets.append(self.default)
+        return targets
+    
+    def to_json(self):
+        data = super(ChoiceState, self).to_json()
+        data["Choices"] = self.choices
+        if self.default is not None:
+            data["Default"] = self.default
+        return data
+
+class WaitState(State):
+    """Waits for Seconds, until Timestamp, or for the seconds or until the
+    timestamp at SecondsPath or TimestampPath in the input."""
+    WAIT_FIELDS = ("Seconds", "Timestamp", "SecondsPath", "TimestampPath")
+    
+    @classmethod
+    def from_json(cls, obj):
+        if obj["Type"] != "Wait":
+            raise TypeError("Data is not a Wait state")
+        return cls(
+            obj.get("Next"),
+            seconds = obj.get("Seconds"),
+            timestamp = obj.get("Timestamp"),
+            seconds_path = obj.get("SecondsPath"),
+            timestamp_path = obj.get("TimestampPath"),
+            comment = obj.get("Comment"),
+            io_fields = dataflow.get_fields(obj, dataflow.INPUT_OUTPUT_FIELDS))
+    
+    def __init__(self, next, seconds=None, timestamp=None, seconds_path=None, timestamp_path=None,
+                 comment=None, io_fields=None):
+        super(WaitState, self).__init__("Wait", comment=comment, io_fields=io_fields)
+        if sum(value is not None for value in (seconds, timestamp, seconds_path, timestamp_path)) != 1:
+            raise ValueError("Wait state needs exactly one of {}".format(", ".join(self.WAIT_FIELDS)))
+        if timestamp is not None and parse_timestamp(timestamp) is None:
+            raise ValueError("Invalid Timestamp {!r}".format(timestamp))
+        self.next = next
+        self.seconds = seconds
+        self.timestamp = timestamp
+        self.seconds_path = seconds_path
+        self.timestamp_path = timestamp_path
+    
+    def is_end(self):
+        return self.next is None
+    
+    def get_delay(self, input, now):
+        """The seconds to wait from now (seconds since the epoch) for the given input.
+        Raises PathNotFound, or ValueError if the value at the path is invalid."""
+        if self.seconds is not None:
+            return self.seconds
+        if self.timestamp is not None:
+            return parse_timestamp(self.timestamp) - now
+        if self.seconds_path is not None:
+            seconds = compile_path(self.seconds_path).get(input)
+            if isinstance(seconds, bool) or not isinstance(seconds, (int, long, float)) or seconds < 0:
+                raise ValueError("Invalid seconds {!r} at {}".format(seconds, self.seconds_path))
+            return seconds
+        timestamp = parse_timestamp(compile_path(self.timestamp_path).get(input))
+        if timestamp is None:
+            raise ValueError("Invalid timestamp at {}".format(self.timestamp_path))
+        return timestamp - now
+    
+    def to_json(self):
+        data = super(WaitState, self).to_json()
+        for key, value in zip(self.WAIT_FIELDS, (self.seconds, self.timestamp, self.seconds_path, self.timestamp_path)):
+            if value is not None:
+                data[key] = value
+        if self.next is None:
+            data["End"] = True
+        else:
+            data["Next"] = self.next
+        return data
+
 def state_from_json(obj):
     if obj["Type"] == "Task":
         return TaskState.from_json(obj)
@@ -160,5 +576,15 @@ def state_from_json(obj):
         return SucceedState.from_json(obj)
     elif obj["Type"] == "Fail":
         return FailState.from_json(obj)
+    elif obj["Type"] == "Parallel":
+        return ParallelState.from_json(obj)
+    elif obj["Type"] == "Map":
+        return MapState.from_json(obj)
+    elif obj["Type"] == "Pass":
+        return PassState.from_json(obj)
+    elif obj["Type"] == "Choice":
+        return ChoiceState.from_json(obj)
+    elif obj["Type"] == "Wait":
+        return WaitState.from_json(obj)
     else:
         raise TypeError("Unknown type {}".format(obj["Type"]))
\ No newline at end of file
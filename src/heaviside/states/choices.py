@@ -0,0 +1,230 @@
+"""
+Compiles the rules of a Choice state into a function of the state input.
+
+Each rule becomes a closure over its pre-parsed variable path and comparison,
+and the state becomes a list of steps tried in order. A run of consecutive
+StringEquals (or NumericEquals) rules on the same variable is turned into a
+single dict lookup, so a Choice with hundreds of equality rules costs one
+path evaluation and one lookup instead of a scan.
+"""
+
+import calendar
+import datetime
+import operator
+import re
+
+from .paths import compile_path, PathNotFound
+
+INDEX_MIN_RULES = 4
+
+_NO_MATCH = object()
+
+def _is_string(value):
+    return isinstance(value, basestring)
+
+def _is_number(value):
+    return isinstance(value, (int, long, float)) and not isinstance(value, bool)
+
+def _is_boolean(value):
+    return isinstance(value, bool)
+
+_TIMESTAMP = re.compile(
+    r'^(\d{4})-(\d{2})-(\d{2})[Tt](\d{2}):(\d{2}):(\d{2})(\.\d+)?([Zz]|[+-]\d{2}:\d{2})$')
+
+def parse_timestamp(value):
+    """Return an RFC3339 timestamp as seconds since the epoch, or None if it isn't one."""
+    if not _is_string(value):
+        return None
+    match = _TIMESTAMP.match(value)
+    if not match:
+        return None
+    year, month, day, hour, minute, second = (int(g) for g in match.groups()[:6])
+    try:
+        seconds = calendar.timegm(datetime.datetime(year, month, day, hour, minute, second).timetuple())
+    except ValueError:
+        return None
+    if match.group(7):
+        seconds += float(match.group(7))
+    offset = match.group(8)
+    if offset not in ('Z', 'z'):
+        sign = 1 if offset[0] == '+' else -1
+        seconds -= sign * (int(offset[1:3]) * 3600 + int(offset[4:6]) * 60)
+    return seconds
+
+def _string_matcher(pattern):
+    """StringMatches patterns: * matches any run of characters, \\* a literal *."""
+    regex = []
+    escaped = False
+    for char in pattern:
+        if escaped:
+            regex.append(re.escape(char))
+            escaped = False
+        elif char == '\\':
+            escaped = True
+        elif char == '*':
+            regex.append('.*')
+        else:
+            regex.append(re.escape(char))
+    return re.compile(''.join(regex) + r'\Z', re.DOTALL).match
+
+# operator name -> (type check, value conversion, comparison)
+_COMPARISONS = {}
+
+for _prefix, _check, _convert in [
+        ('String', _is_string, None),
+        ('Numeric', _is_number, None),
+        ('Timestamp', lambda value: parse_timestamp(value) is not None, parse_timestamp)]:
+    for _suffix, _compare in [
+            ('Equals', operator.eq),
+            ('LessThan', operator.lt),
+            ('GreaterThan', operator.gt),
+            ('LessThanEquals', operator.le),
+            ('GreaterThanEquals', operator.ge)]:
+        _COMPARISONS[_prefix + _suffix] = (_check, _convert, _compare)
+
+_COMPARISONS['BooleanEquals'] = (_is_boolean, None, operator.eq)
+
+_TYPE_TESTS = {
+    'IsNull': lambda value: value is None,
+    'IsString': _is_string,
+    'IsNumeric': _is_number,
+    'IsBoolean': _is_boolean,
+    'IsTimestamp': lambda value: parse_timestamp(value) is not None,
+}
+
+def _comparison_operator(rule):
+    for key in rule:
+        if key in ('Variable', 'Next', 'Comment'):
+            continue
+        return key
+    raise ValueError("Choice rule has no comparison: {}".format(rule))
+
+def compile_rule(rule):
+    """Return a predicate of the input for a (possibly nested) choice rule."""
+    if 'And' in rule:
+        predicates = [compile_rule(r) for r in rule['And']]
+        return lambda input: all(predicate(input) for predicate in predicates)
+    if 'Or' in rule:
+        predicates = [compile_rule(r) for r in rule['Or']]
+        return lambda input: any(predicate(input) for predicate in predicates)
+    if 'Not' in rule:
+        predicate = compile_rule(rule['Not'])
+        return lambda input: not predicate(input)
+    
+    if 'Variable' not in rule:
+        raise ValueError("Choice rule has no Variable: {}".format(rule))
+    variable = compile_path(rule['Variable'])
+    name = _comparison_operator(rule)
+    expected = rule[name]
+    
+    if name == 'IsPresent':
+        return lambda input: variable.exists(input) == expected
+    
+    if name in _TYPE_TESTS:
+        test = _TYPE_TESTS[name]
+        def type_test(input):
+            try:
+                value = variable.get(input)
+            except PathNotFound:
+                return False
+            return test(value) == expected
+        return type_test
+    
+    if name == 'StringMatches':
+        match = _string_matcher(expected)
+        return lambda input: _matches(variable.get(input), match)
+    
+    if name.endswith('Path') and name[:-len('Path')] in _COMPARISONS:
+        check, convert, compare = _COMPARISONS[name[:-len('Path')]]
+        other = compile_path(expected)
+        def compare_paths(input):
+            value, other_value = variable.get(input), other.get(input)
+            if not (check(value) and check(other_value)):
+                return False
+            if convert is not None:
+                value, other_value = convert(value), convert(other_value)
+            return compare(value, other_value)
+        return compare_paths
+    
+    if name in _COMPARISONS:
+        check, convert, compare = _COMPARISONS[name]
+        if not check(expected):
+            raise ValueError("Invalid value for {}: {!r}".format(name, expected))
+        if convert is not None:
+            expected = convert(expected)
+        def compare_value(input):
+            value = variable.get(input)
+            if not check(value):
+                return False
+            if convert is not None:
+                value = convert(value)
+            return compare(value, expected)
+        return compare_value
+    
+    raise ValueError("Unknown choice rule operator {}".format(name))
+
+def _matches(value, match):
+    return _is_string(value) and match(value) is not None
+
+def _index_key(rule):
+    """The (variable, operator) a top-level rule can be indexed under, or None."""
+    if 'Variable' not in rule:
+        return None
+    try:
+        name = _comparison_operator(rule)
+    except ValueError:
+        return None
+    if name == 'StringEquals' and _is_string(rule[name]):
+        return (rule['Variable'], name)
+    if name == 'NumericEquals' and _is_number(rule[name]):
+        return (rule['Variable'], name)
+    return None
+
+def _indexed_step(rules, resolve):
+    variable = compile_path(rules[0]['Variable'])
+    name = _comparison_operator(rules[0])
+    check = _COMPARISONS[name][0]
+    table = {}
+    for rule in rules:
+        # the first rule for a value wins, as it would in a scan
+        table.setdefault(rule[name], resolve(rule['Next']))
+    def step(input):
+        value = variable.get(input)
+        if not check(value):
+            return _NO_MATCH
+        return table.get(value, _NO_MATCH)
+    return step
+
+def _rule_step(rule, resolve):
+    predicate = compile_rule(rule)
+    target = resolve(rule['Next'])
+    return lambda input: target if predicate(input) else _NO_MATCH
+
+def compile_choices(choices, default=None, resolve=None):
+    """Return a function of the input that returns the resolved Next of the first
+    matching rule, the resolved default, or None if nothing matches and there's
+    no default. It raises PathNotFound if a compared variable isn't in the input."""
+    resolve = resolve or (lambda name: name)
+    steps = []
+    i = 0
+    while i < len(choices):
+        key = _index_key(choices[i])
+        end = i + 1
+        if key is not None:
+            while end < len(choices) and _index_key(choices[end]) == key:
+                end += 1
+        if end - i >= INDEX_MIN_RULES:
+            steps.append(_indexed_step(choices[i:end], resolve))
+        else:
+            steps.extend(_rule_step(rule, resolve) for rule in choices[i:end])
+        i = end
+    
+    default_target = resolve(default) if default is not None else None
+    
+    def choose(input):
+        for step in steps:
+            target = step(input)
+            if target is not _NO_MATCH:
+                return target
+        return default_target
+    return choose
@@ -0,0 +1,97 @@
+"""
+Compiled form of a StateMachine definition, used by the executor loop.
+
+States are numbered, Next targets are resolved to state ids, catchers and
+retriers are flattened into per-state tables, and Choice rules are compiled into functions
+of the input, so that running the machine needs no name lookups or type
+checks once a state has been entered.
+"""
+
+from .choices import compile_choices
+from . import dataflow
+
+KIND_TASK = 0
+KIND_SUCCEED = 1
+KIND_FAIL = 2
+KIND_PARALLEL = 3
+KIND_MAP = 4
+KIND_PASS = 5
+KIND_CHOICE = 6
+KIND_WAIT = 7
+
+KIND_BY_TYPE = {
+    "Task": KIND_TASK,
+    "Succeed": KIND_SUCCEED,
+    "Fail": KIND_FAIL,
+    "Parallel": KIND_PARALLEL,
+    "Map": KIND_MAP,
+    "Pass": KIND_PASS,
+    "Choice": KIND_CHOICE,
+    "Wait": KIND_WAIT,
+}
+
+class CompiledStateMachine(object):
+    def __init__(self, definition):
+        self.names = sorted(definition.states.iterkeys())
+        self.ids = dict((name, state_id) for state_id, name in enumerate(self.names))
+        self.states = [definition.states[name] for name in self.names]
+        
+        try:
+            self.kinds = [KIND_BY_TYPE[state.type] for state in self.states]
+        except KeyError as e:
+            raise TypeError("Unknown type {}".format(e.args[0]))
+        
+        self.start_id = self._resolve(definition.start_at, 'StartAt')
+        self.next_ids = [self._resolve(getattr(state, 'next', None), name)
+                         for name, state in zip(self.names, self.states)]
+        self.catchers = [self._compile_catchers(getattr(state, 'catch', None), name)
+                         for name, state in zip(self.names, self.states)]
+        self.retriers = [tuple(getattr(state, 'retry', None) or ()) for state in self.states]
+        self.choosers = [self._compile_choices(state, name) if kind == KIND_CHOICE else None
+                         for name, state, kind in zip(self.names, self.states, self.kinds)]
+        self.io = [state.io for state in self.states]
+        # whether a state's input must be kept until it completes, to build its output
+        self.needs_raw_input = [io.needs_raw_input or any(catcher[3] != dataflow.ROOT for catcher in catchers)
+                                for io, catchers in zip(self.io, self.catchers)]
+    
+    def _resolve(self, name, source):
+        if name is None:
+            return None
+        try:
+            return self.ids[name]
+        except KeyError:
+            raise ValueError("{} refers to unknown state {}".format(source, name))
+    
+    def _compile_catchers(self, catchers, source):
+        if not catchers:
+            return ()
+        return tuple((frozenset(catcher.error_equals),
+                      'States.ALL' in catcher.error_equals,
+                      self._resolve(catcher.next, source),
+                      dataflow.compile_result_path(catcher.result_path))
+                     for catcher in catchers)
+    
+    def _compile_choices(self, state, source):
+        return compile_choices(state.choices, state.default, lambda name: self._resolve(name, source))
+    
+    def state_id(self, name):
+        return self.ids[name]
+    
+    def find_retrier(self, state_id, error):
+        """Return the index and Retrier of the first retrier matching the error, or None."""
+        for index, retrier in enumerate(self.retriers[state_id]):
+            if retrier.matches(error):
+                return index, retrier
+        return None
+    
+    def find_catcher(self, state_id, error):
+        """Return the state id the first matching catcher goes to, or None."""
+        catch = self.find_catch(state_id, error)
+        return catch[0] if catch is not None else None
+    
+    def find_catch(self, state_id, error):
+        """Return the state id and compiled ResultPath of the first matching catcher, or None."""
+        for error_equals, catches_all, next_id, result_path in self.catchers[state_id]:
+            if catches_all or error in error_equals:
+                return next_id, result_path
+        return None
@@ -0,0 +1,104 @@
+"""
+Input and output processing of a state (https://states-language.net/spec.html#filters):
+InputPath, Parameters, ResultSelector, ResultPath and OutputPath, compiled once
+per state when the definition is loaded.
+
+Paths select from the data without copying it, and ResultPath copies only
+the objects along its path, so a large document passes through states that
+touch a small part of it without being rebuilt.
+"""
+
+from .paths import compile_path, compile_template
+
+ROOT = "$"
+
+class StateIO(object):
+    def __init__(self, input_path=ROOT, parameters=None, result_selector=None, result_path=ROOT, output_path=ROOT):
+        """A path of None is JSON null: for InputPath and OutputPath it selects an empty
+        object, and for ResultPath it discards the result, passing the input through."""
+        self.input_path = self._compile(input_path)
+        self.parameters = compile_template(parameters) if parameters is not None else None
+        self.result_selector = compile_template(result_selector) if result_selector is not None else None
+        self.discard_result = result_path is None
+        self.result_path = self._compile(result_path)
+        self.output_path = self._compile(output_path)
+        
+        self.is_identity = (input_path == ROOT and parameters is None and result_selector is None
+                            and result_path == ROOT and output_path == ROOT)
+    
+    @classmethod
+    def _compile(cls, path):
+        if path is None or path == ROOT:
+            return path
+        return compile_path(path)
+    
+    @classmethod
+    def _select(cls, path, data):
+        if path == ROOT:
+            return data
+        if path is None:
+            return {}
+        return path.get(data)
+    
+    @property
+    def needs_raw_input(self):
+        """Whether the output is built from the state's input as well as its result."""
+        return self.discard_result or self.result_path != ROOT
+    
+    def effective_input(self, raw_input, context_object=None):
+        """The input after InputPath and Parameters: what a Task is invoked with."""
+        data = self._select(self.input_path, raw_input)
+        if self.parameters is not None:
+            data = self.parameters(data, context_object)
+        return data
+    
+    def output(self, raw_input, result, context_object=None):
+        """The output after ResultSelector, ResultPath and OutputPath."""
+        if self.is_identity:
+            return result
+        if self.result_selector is not None:
+            result = self.result_selector(result, context_object)
+        if self.discard_result:
+            data = raw_input
+        else:
+            data = apply_result_path(self.result_path, raw_input, result)
+        return self._select(self.output_path, data)
+    
+    def filter_output(self, data):
+        """OutputPath alone, for states without a result (Choice, Succeed)."""
+        return self._select(self.output_path, data)
+
+IDENTITY = StateIO()
+
+# the fields each type of state has
+INPUT_OUTPUT_FIELDS = ("InputPath", "OutputPath")
+ALL_FIELDS = INPUT_OUTPUT_FIELDS + ("Parameters", "ResultSelector", "ResultPath")
+PASS_FIELDS = INPUT_OUTPUT_FIELDS + ("Parameters", "ResultPath")
+# Map's Parameters apply to each item, which isn't supported; MapState refuses them
+MAP_FIELDS = INPUT_OUTPUT_FIELDS + ("ResultSelector", "ResultPath")
+
+def get_fields(obj, fields):
+    """The fields of a state's JSON that it has, out of the given ones."""
+    return dict((key, obj[key]) for key in fields if key in obj)
+
+def compile_io(fields):
+    if not fields:
+        return IDENTITY
+    return StateIO(
+        input_path = fields.get("InputPath", ROOT),
+        parameters = fields.get("Parameters"),
+        result_selector = fields.get("ResultSelector"),
+        result_path = fields.get("ResultPath", ROOT),
+        output_path = fields.get("OutputPath", ROOT))
+
+def compile_result_path(path):
+    """A catcher's ResultPath: ROOT, None (discard), or a compiled path."""
+    return StateIO._compile(path)
+
+def apply_result_path(result_path, raw_input, result):
+    """Put the result at a compiled ResultPath in the raw input."""
+    if result_path == ROOT:
+        return result
+    if result_path is None:
+        return raw_input
+    return result_path.set(raw_input, result)
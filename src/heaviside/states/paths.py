@@ -0,0 +1,169 @@
+"""
+Reference paths (https://states-language.net/spec.html#path), compiled once.
+
+A path like $.orders[0]['ship to'].zip is parsed into its segments when the
+definition is loaded, so evaluating it against state data is a loop of
+lookups with no string handling. Compiled paths are shared by their text.
+
+Nothing here copies the data it is given. Setting a value at a path copies
+only the containers along the path; everything else is shared with the
+original, so state data is never modified in place and must not be.
+"""
+
+import re
+from copy import deepcopy
+
+class PathNotFound(KeyError):
+    """The data doesn't contain the path."""
+    def __init__(self, path):
+        super(PathNotFound, self).__init__(path)
+        self.path = path
+    
+    def __str__(self):
+        return "Path {} not found in data".format(self.path)
+
+class PathMatchFailure(ValueError):
+    """A value can't be set at the path, because the data along it isn't an object or array."""
+    pass
+
+_FIELD = re.compile(r'\.([^.\[\]]+)')
+_INDEX = re.compile(r'\[(-?\d+)\]')
+_QUOTED_FIELD = re.compile(r"\[\s*'((?:[^'\\]|\\.)*)'\s*\]|\[\s*\"((?:[^\"\\]|\\.)*)\"\s*\]")
+
+def parse(path):
+    """Return the segments of a reference path: strings for fields, ints for array indexes."""
+    if not isinstance(path, basestring) or not path.startswith('$'):
+        raise ValueError("Invalid path {!r}: paths start with $".format(path))
+    segments = []
+    position = 1
+    while position < len(path):
+        match = _FIELD.match(path, position)
+        if match:
+            segments.append(match.group(1))
+        else:
+            match = _INDEX.match(path, position)
+            if match:
+                segments.append(int(match.group(1)))
+            else:
+                match = _QUOTED_FIELD.match(path, position)
+                if not match:
+                    raise ValueError("Invalid path {!r} at position {}".format(path, position))
+                field = match.group(1) if match.group(1) is not None else match.group(2)
+                segments.append(re.sub(r'\\(.)', r'\1', field))
+        position = match.end()
+    return tuple(segments)
+
+class ReferencePath(object):
+    def __init__(self, path):
+        self.path = path
+        self.segments = parse(path)
+    
+    def is_root(self):
+        return not self.segments
+    
+    def get(self, data):
+        """Return the value at the path, raising PathNotFound if it isn't there."""
+        for segment in self.segments:
+            try:
+                if isinstance(segment, int):
+                    if not isinstance(data, list):
+                        raise PathNotFound(self.path)
+                    data = data[segment]
+                else:
+                    if not isinstance(data, dict):
+                        raise PathNotFound(self.path)
+                    data = data[segment]
+            except (KeyError, IndexError):
+                raise PathNotFound(self.path)
+        return data
+    
+    def set(self, data, value):
+        """Return a copy of data with value at the path. Only the objects and
+        arrays along the path are copied; missing objects are created."""
+        if not self.segments:
+            return value
+        return self._set(data, 0, value)
+    
+    def _set(self, data, position, value):
+        if position == len(self.segments):
+            return value
+        segment = self.segments[position]
+        if isinstance(segment, int):
+            if not isinstance(data, list) or not -len(data) <= segment < len(data):
+                raise PathMatchFailure("Can't set {} in data".format(self.path))
+            copy = list(data)
+        elif data is None:
+            copy = {}
+        elif isinstance(data, dict):
+            copy = dict(data)
+        else:
+            raise PathMatchFailure("Can't set {} in data".format(self.path))
+        child = copy[segment] if isinstance(segment, int) else copy.get(segment)
+        copy[segment] = self._set(child, position + 1, value)
+        return copy
+    
+    def exists(self, data):
+        try:
+            self.get(data)
+        except PathNotFound:
+            return False
+        return True
+    
+    def __repr__(self):
+        return 'ReferencePath({!r})'.format(self.path)
+
+_COMPILED = {}
+
+def compile_path(path):
+    """Return the compiled ReferencePath for a path, reusing one compiled before."""
+    compiled = _COMPILED.get(path)
+    if compiled is None:
+        compiled = _COMPILED[path] = ReferencePath(path)
+    return compiled
+
+def compile_template(template):
+    """Compile a payload template (Parameters, ResultSelector) into a function of
+    (input, context_object). Fields whose names end in .$ take the value at their
+    path in the input, or, for paths starting with $$, in the context object,
+    which is a function that is only called if the template uses it. Parts of
+    the template with no paths are deep-copied rather than rebuilt field by field;
+    they are never shared, as a task may change its input."""
+    function, _ = _compile_template(template)
+    return function
+
+def _compile_template(template):
+    """Return (function, is_constant)."""
+    if isinstance(template, dict):
+        fields = []
+        constant = True
+        for key, value in template.iteritems():
+            if key.endswith('.$'):
+                if not isinstance(value, basestring) or not value.startswith('$'):
+                    raise ValueError("Unsupported value for {}: {!r}".format(key, value))
+                if value.startswith('$$'):
+                    fields.append((key[:-2], _context_getter(compile_path(value[1:]))))
+                else:
+                    fields.append((key[:-2], _input_getter(compile_path(value))))
+                constant = False
+            else:
+                function, is_constant = _compile_template(value)
+                fields.append((key, function))
+                constant = constant and is_constant
+        if constant:
+            return (lambda input, context_object: deepcopy(template)), True
+        return (lambda input, context_object:
+                dict((key, function(input, context_object)) for key, function in fields)), False
+    if isinstance(template, list):
+        compiled = [_compile_template(value) for value in template]
+        if all(is_constant for _, is_constant in compiled):
+            return (lambda input, context_object: deepcopy(template)), True
+        functions = [function for function, _ in compiled]
+        return (lambda input, context_object:
+                [function(input, context_object) for function in functions]), False
+    return (lambda input, context_object: template), True
+
+def _input_getter(path):
+    return lambda input, context_object: path.get(input)
+
+def _context_getter(path):
+    return lambda input, context_object: path.get(context_object())